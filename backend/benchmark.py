@@ -0,0 +1,286 @@
+"""
+Micro-benchmarks for the ImageLab Studio backend hot paths
+
+Usage:
+    python benchmark.py                 # run every benchmark
+    python benchmark.py decode          # run selected benchmarks
+    python benchmark.py decode --repeat 10 --sizes 2 12 24
+    python benchmark.py color --sizes 12 24 48
+    python benchmark.py channels --workers 4
+    python benchmark.py denoise --sizes 2 --repeat 1
+    python benchmark.py edge --kernels 5 15 31
+    python benchmark.py transform --sizes 12 24
+"""
+
+import argparse
+import base64
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from main import (
+    DENOISE_TIERS, OPERATIONS, apply_operation, decode_base64_image, draw_shape, encode_image, encode_images,
+    edge_preserving_filter, hsv_channel_images, op_color_manipulation, op_denoise, op_draw_shapes,
+    operation_arguments, rgb_channel_images, run_geometry_operations, run_point_operations, shape_style
+)
+
+
+def synthetic_image(megapixels: float, seed: int = 0) -> np.ndarray:
+    """Smooth random BGR image with a 3:2 aspect ratio, so codecs see realistic content"""
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(0, 12, image.shape, dtype=np.uint8)
+    return cv2.add(image, noise)
+
+
+def timeit(fn, repeat: int) -> float:
+    """Best wall time of ``repeat`` runs, in milliseconds"""
+    fn()  # warm-up
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def report(rows):
+    name_width = max(len(row[0]) for row in rows)
+    for name, baseline, candidate in rows:
+        print(f"  {name:<{name_width}}  {baseline:9.1f} ms  ->  {candidate:9.1f} ms   x{baseline / candidate:5.2f}")
+
+
+def legacy_decode_base64_image(base64_string: str) -> np.ndarray:
+    """Previous decode path: base64 -> PIL -> np.array -> RGB2BGR"""
+    image_data = base64.b64decode(base64_string)
+    pil_image = Image.open(BytesIO(image_data))
+    return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+
+
+def bench_decode(args):
+    """Base64 decode: PIL round-trip vs cv2.imdecode (and reduced-resolution preview decode)"""
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        rows = []
+        for ext in (".png", ".jpg"):
+            payload = base64.b64encode(cv2.imencode(ext, image)[1].tobytes()).decode()
+            legacy = timeit(lambda: legacy_decode_base64_image(payload), args.repeat)
+            rows.append((f"{ext[1:]} full", legacy, timeit(lambda: decode_base64_image(payload), args.repeat)))
+            rows.append((f"{ext[1:]} 1/4 preview", legacy, timeit(lambda: decode_base64_image(payload, 4), args.repeat)))
+        print(f"decode {megapixels} MP ({image.shape[1]}x{image.shape[0]})")
+        report(rows)
+
+
+def legacy_color_manipulation(image: np.ndarray, hue_shift: int, saturation_factor: float, value_factor: float) -> np.ndarray:
+    """Previous color manipulation: float32 HSV frame with per-channel clip and cast"""
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
+    hsv_image[:, :, 0] = (hsv_image[:, :, 0] + hue_shift) % 180
+    hsv_image[:, :, 1] = np.clip(hsv_image[:, :, 1] * saturation_factor, 0, 255)
+    hsv_image[:, :, 2] = np.clip(hsv_image[:, :, 2] * value_factor, 0, 255)
+    return cv2.cvtColor(hsv_image.astype(np.uint8), cv2.COLOR_HSV2BGR)
+
+
+def bench_color(args):
+    """Color manipulation: float32 HSV math vs cached uint8 cv2.LUT"""
+    params = (25, 1.4, 0.8)
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        expected = legacy_color_manipulation(image, *params)
+        assert np.array_equal(op_color_manipulation(image, *params)[0], expected), "LUT output differs"
+        rows = [(
+            "hue/sat/value",
+            timeit(lambda: legacy_color_manipulation(image, *params), args.repeat),
+            timeit(lambda: op_color_manipulation(image, *params), args.repeat)
+        )]
+        print(f"color {megapixels} MP ({image.shape[1]}x{image.shape[0]})")
+        report(rows)
+
+
+POINT_CHAIN = [
+    ("arithmetic", {"operation": "add", "value": 40}),
+    ("arithmetic", {"operation": "multiply", "value": 120}),
+    ("bitwise", {"operation": "not"}),
+    ("grayscale", {}),
+    ("threshold", {"threshold_value": 100, "threshold_type": "trunc"})
+]
+
+
+def bench_point(args):
+    """Chain of per-pixel operations: one full pass per step vs one fused lookup table"""
+    steps = [(OPERATIONS[name], operation_arguments(OPERATIONS[name], **params)) for name, params in POINT_CHAIN]
+
+    def step_by_step(image):
+        for fn, arguments in steps:
+            image, _ = fn(image, **arguments)
+        return image
+
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        assert np.array_equal(run_point_operations(image, steps)[0], step_by_step(image)), "fused output differs"
+        rows = [(
+            f"{len(steps)} point ops",
+            timeit(lambda: step_by_step(image), args.repeat),
+            timeit(lambda: run_point_operations(image, steps), args.repeat)
+        )]
+        print(f"point {megapixels} MP ({image.shape[1]}x{image.shape[0]})")
+        report(rows)
+
+
+def bench_channels(args):
+    """Multi-output channel endpoints: sequential 3-channel encodes vs parallel and compact planes"""
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    def parallel_encode(images):
+        return list(executor.map(encode_image, images.values()))
+
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        print(f"channels {megapixels} MP ({image.shape[1]}x{image.shape[0]}), {args.workers} encode workers")
+        rows = []
+        for name, split in (("rgb", rgb_channel_images), ("hsv", hsv_channel_images)):
+            full, compact = split(image), split(image, compact=True)
+            sequential = timeit(lambda: encode_images(full), args.repeat)
+            rows.append((f"{name} parallel", sequential, timeit(lambda: parallel_encode(full), args.repeat)))
+            rows.append((f"{name} parallel compact", sequential, timeit(lambda: parallel_encode(compact), args.repeat)))
+            full_size = sum(len(data) for data in encode_images(full).values())
+            compact_size = sum(len(data) for data in encode_images(compact).values())
+            print(f"  {name} payload {full_size / 1e6:.1f} MB -> {compact_size / 1e6:.1f} MB compact")
+        report(rows)
+
+
+def bench_denoise(args):
+    """NL-means quality tiers: full resolution vs downscaled with guided upsampling (PSNR against the clean image)"""
+    rng = np.random.default_rng(0)
+    for megapixels in args.sizes:
+        clean = synthetic_image(megapixels)
+        noisy = np.clip(clean + rng.normal(0, 15, clean.shape), 0, 255).astype(np.uint8)
+        full = timeit(lambda: apply_operation(op_denoise, noisy), args.repeat)
+        print(f"denoise {megapixels} MP ({noisy.shape[1]}x{noisy.shape[0]})")
+        rows = []
+        for tier in DENOISE_TIERS:
+            result, _ = apply_operation(op_denoise, noisy, quality=tier)
+            print(f"  {tier:<8} PSNR {cv2.PSNR(result, clean):5.2f} dB")
+            rows.append((tier, full, full if tier == "full" else timeit(lambda: apply_operation(op_denoise, noisy, quality=tier), args.repeat)))
+        report(rows)
+
+
+def bench_edge(args):
+    """Bilateral blur: cv2.bilateralFilter vs the box-filter guided engine across kernel sizes"""
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        rows = [
+            (
+                f"kernel {kernel_size}",
+                timeit(lambda: edge_preserving_filter(image, kernel_size, 80, "exact"), args.repeat),
+                timeit(lambda: edge_preserving_filter(image, kernel_size, 80, "guided"), args.repeat)
+            )
+            for kernel_size in args.kernels
+        ]
+        print(f"edge {megapixels} MP ({image.shape[1]}x{image.shape[0]})")
+        report(rows)
+
+
+def annotation_shapes(count: int, width: int, height: int, seed: int = 0) -> list:
+    """Annotation-style overlay: runs of same-coloured boxes, line segments and filled markers"""
+    rng = np.random.default_rng(seed)
+    xs, ys = rng.integers(0, width, count), rng.integers(0, height, count)
+    shapes = []
+    for index, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+        kind = ("rectangle", "line", "polygon")[index * 3 // count]
+        if kind == "polygon":
+            shapes.append({"type": kind, "center_x": x, "center_y": y, "size": 12, "filled": True, "color": [0, 0, 255]})
+        else:
+            shapes.append({"type": kind, "x1": x, "y1": y, "x2": x + 40, "y2": y + 25, "color": [255, 0, 0], "thickness": 2})
+    return shapes
+
+
+def legacy_draw_shapes(image: np.ndarray, shapes: list) -> np.ndarray:
+    """Previous draw-shapes loop: validate and draw each shape with its own OpenCV call"""
+    result_image = image.copy()
+    for shape in shapes:
+        draw_shape(result_image, shape, *shape_style(shape))
+    return result_image
+
+
+def bench_shapes(args):
+    """Draw-shapes: one OpenCV call per shape vs batched runs (legacy per-shape INFO logging excluded)"""
+    # Skipped-shape warnings and draw summaries would drown the report
+    logging.getLogger("main").setLevel(logging.ERROR)
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        rows = []
+        for count in (1000, 10000):
+            shapes = annotation_shapes(count, image.shape[1], image.shape[0])
+            assert np.array_equal(op_draw_shapes(image, shapes)[0], legacy_draw_shapes(image, shapes)), "batched output differs"
+            rows.append((
+                f"{count} shapes",
+                timeit(lambda: legacy_draw_shapes(image, shapes), args.repeat),
+                timeit(lambda: op_draw_shapes(image, shapes), args.repeat)
+            ))
+        print(f"shapes {megapixels} MP ({image.shape[1]}x{image.shape[0]})")
+        report(rows)
+
+
+TRANSFORM_CHAIN = [
+    ("rotate", {"angle": 15}),
+    ("flip", {"flip_code": 1}),
+    ("resize", {"scale_factor": 0.5}),
+    ("crop", {"x": 200, "y": 150, "width": 1600, "height": 900})
+]
+
+
+def bench_transform(args):
+    """Geometric chain: one resampling pass per step vs one composed warp over the cropped window"""
+    steps = [(OPERATIONS[name], operation_arguments(OPERATIONS[name], **params)) for name, params in TRANSFORM_CHAIN]
+
+    def step_by_step(image):
+        for fn, arguments in steps:
+            image, _ = fn(image, **arguments)
+        return image
+
+    for megapixels in args.sizes:
+        image = synthetic_image(megapixels)
+        rows = [(
+            f"{len(steps)} geometric ops",
+            timeit(lambda: step_by_step(image), args.repeat),
+            timeit(lambda: run_geometry_operations(image, steps), args.repeat)
+        )]
+        print(f"transform {megapixels} MP ({image.shape[1]}x{image.shape[0]})")
+        report(rows)
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "color": bench_color,
+    "point": bench_point,
+    "channels": bench_channels,
+    "denoise": bench_denoise,
+    "edge": bench_edge,
+    "shapes": bench_shapes,
+    "transform": bench_transform
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sizes", type=float, nargs="+", default=[2, 12, 24], help="image sizes in megapixels")
+    parser.add_argument("--workers", type=int, default=4, help="encode workers for the channels benchmark")
+    parser.add_argument("--kernels", type=int, nargs="+", default=[5, 9, 15, 23, 31], help="kernel sizes for the edge benchmark")
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args)
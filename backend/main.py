@@ -3,15 +3,32 @@ FastAPI Backend for OpenCV Image Processing Studio
 Vue.js Frontend Compatible Version
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse
 import cv2
 import numpy as np
 import base64
 from io import BytesIO
 from PIL import Image
 import json
+import hashlib
+import math
+import inspect
+import itertools
+import os
+import time
+import uuid
+import asyncio
+import atexit
+import copyreg
+import functools
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 from typing import List, Optional
 import uvicorn
 import logging
@@ -26,6 +43,183 @@ app = FastAPI(
     description="Professional OpenCV Image Processing with Vue.js Frontend Support"
 )
 
+# Session image store limits (decoded images kept server-side between requests)
+IMAGE_STORE_MAX_MB = int(os.environ.get("IMAGELAB_STORE_MAX_MB", "1024"))
+IMAGE_STORE_TTL_SECONDS = int(os.environ.get("IMAGELAB_STORE_TTL", "1800"))
+
+# Frames at least this large are kept in memory-mapped scratch files instead of RAM (0 disables)
+MEMMAP_THRESHOLD_MB = int(os.environ.get("IMAGELAB_MEMMAP_THRESHOLD_MB", "64"))
+SCRATCH_DIR = os.environ.get("IMAGELAB_SCRATCH_DIR", tempfile.gettempdir())
+SCRATCH_MAX_MB = int(os.environ.get("IMAGELAB_SCRATCH_MAX_MB", "16384"))
+
+# CPU work pool limits (blocking OpenCV work runs here instead of on the event loop)
+CPU_WORKERS = int(os.environ.get("IMAGELAB_CPU_WORKERS", str(os.cpu_count() or 2)))
+CPU_QUEUE_DEPTH = int(os.environ.get("IMAGELAB_CPU_QUEUE_DEPTH", str(2 * CPU_WORKERS)))
+CPU_EXECUTOR = os.environ.get("IMAGELAB_CPU_EXECUTOR", "thread")  # "thread" or "process"
+BUSY_RETRY_AFTER_SECONDS = int(os.environ.get("IMAGELAB_RETRY_AFTER", "1"))
+
+# Images at least this large are processed in tiles by operations that declare a halo
+TILE_THRESHOLD_MP = float(os.environ.get("IMAGELAB_TILE_THRESHOLD_MP", "16"))
+TILE_SIZE = int(os.environ.get("IMAGELAB_TILE_SIZE", "1024"))
+
+# Longest side of the proxy image used by preview requests from interactive sliders
+PREVIEW_MAX_SIZE = int(os.environ.get("IMAGELAB_PREVIEW_MAX_SIZE", "1280"))
+
+# Longest side of thumbnails returned by /api/thumbnail and batch thumbnail mode
+THUMBNAIL_MAX_SIZE = int(os.environ.get("IMAGELAB_THUMBNAIL_MAX_SIZE", "256"))
+
+# Encoded operation results kept for repeated requests (0 disables the cache)
+RESULT_CACHE_MAX_MB = int(os.environ.get("IMAGELAB_RESULT_CACHE_MB", "256"))
+
+
+class CpuPool:
+    """Bounded executor for blocking OpenCV work.
+
+    At most ``workers`` jobs run at once and at most ``queue_depth`` more
+    wait in the executor. Further ``run`` calls, such as the fan-out of one
+    variants or batch request, wait for a slot on the event loop, while
+    ``submit`` (which cannot wait) is refused with a 503. OpenCV releases
+    the GIL, so the default thread pool scales across cores; a process pool
+    can be selected for pure-Python heavy work at the cost of pickling images.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, kind: str = "thread"):
+        executor_cls = ProcessPoolExecutor if kind == "process" else ThreadPoolExecutor
+        self.executor = executor_cls(max_workers=workers)
+        self.kind = kind
+        self.workers = workers
+        self.queue_depth = queue_depth
+        # Admitted processing requests, executor jobs and rejections, only touched from the event loop
+        self.in_flight = 0
+        self.jobs = 0
+        self.rejected = 0
+        self._waiters = deque()
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_depth
+
+    @property
+    def saturated(self) -> bool:
+        return self.in_flight >= self.capacity or self.jobs >= self.capacity
+
+    async def run(self, fn, *args, **kwargs):
+        await self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._release()
+
+    async def run_local(self, fn, *args, **kwargs):
+        """Run blocking work that must stay in this process, such as store bookkeeping.
+
+        It shares the pool (and its slots) when the pool is made of threads,
+        and otherwise runs on the event loop's default thread executor.
+        """
+        if self.kind != "process":
+            return await self.run(fn, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a job and return its concurrent future, which can still be cancelled until the job starts.
+
+        Raises a 503 when every slot is taken, since the caller cannot wait for one.
+        """
+        if self.jobs >= self.capacity:
+            self.rejected += 1
+            raise busy_error()
+        self.jobs += 1
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        return future
+
+    async def _acquire(self):
+        while self.jobs >= self.capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.jobs += 1
+
+    def _release(self):
+        self.jobs -= 1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "jobs": self.jobs,
+            "waiting": len(self._waiters),
+            "rejected": self.rejected
+        }
+
+
+def busy_error() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": str(BUSY_RETRY_AFTER_SECONDS)}
+    )
+
+
+cpu_pool = CpuPool(CPU_WORKERS, CPU_QUEUE_DEPTH, CPU_EXECUTOR)
+
+# HTTPException does not survive a pickle round trip, and a process pool
+# whose worker cannot send back a job's exception is broken for good
+copyreg.pickle(HTTPException, lambda e: (HTTPException, (e.status_code, e.detail, e.headers)))
+
+
+class ProcessingLimitMiddleware:
+    """Reject processing requests with 503 + Retry-After once the CPU pool is saturated,
+    by admitted requests or by the jobs already handed to it.
+
+    The check runs before the request body is read, so an overloaded server
+    answers immediately instead of buffering uploads it cannot process.
+    Non-processing routes such as /health are never limited.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        if cpu_pool.saturated:
+            cpu_pool.rejected += 1
+            busy = busy_error()
+            response = JSONResponse({"detail": busy.detail}, status_code=busy.status_code, headers=busy.headers)
+            await response(scope, receive, send)
+            return
+
+        cpu_pool.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            cpu_pool.in_flight -= 1
+
+
+# Added before CORS so that CORS wraps it and 503 responses stay readable by the browser
+app.add_middleware(ProcessingLimitMiddleware)
+
 # Enable CORS for Vue.js frontend
 app.add_middleware(
     CORSMiddleware,
@@ -33,47 +227,1224 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Image-Metadata", "X-Operation", "X-Image-Format", "X-Encoded-Size", "X-Cache"],
     max_age=3600,
 )
 
 # Helper functions
-def decode_base64_image(base64_string: str) -> np.ndarray:
+
+# decode_scale -> cv2.imread flag. The reduced flags let the JPEG decoder skip
+# DCT coefficients instead of decoding at full size and resizing afterwards.
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def decode_image_bytes(image_bytes, decode_scale: int = 1) -> np.ndarray:
+    """Convert encoded image bytes (PNG, JPEG, WebP, ...) to an 8-bit BGR OpenCV image.
+
+    The buffer is wrapped without copying and decoded by OpenCV directly into
+    the 3-channel 8-bit BGR layout every operation expects: grayscale and
+    palette images are expanded, the alpha channel is dropped and 16-bit
+    samples are scaled down to 8 bits by the decoder in the same pass.
+    """
+    if decode_scale not in DECODE_FLAGS:
+        raise HTTPException(status_code=400, detail="decode_scale must be one of 1, 2, 4 or 8")
+
+    # imdecode raises on an empty buffer instead of returning None
+    if not len(image_bytes):
+        raise HTTPException(status_code=400, detail="Invalid image data: empty image")
+    try:
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), DECODE_FLAGS[decode_scale])
+    except cv2.error as e:
+        logger.error(f"Error decoding image: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
+    if image is None:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    return image
+
+def thumbnail_decode_scale(image_bytes, max_size: int) -> int:
+    """Largest DECODE_FLAGS scale whose decode still covers ``max_size`` pixels on the longest side.
+
+    Only the header is parsed (by PIL, which reads dimensions without
+    decoding); unreadable headers fall back to a full decode.
+    """
+    try:
+        width, height = Image.open(BytesIO(image_bytes)).size
+    except Exception:
+        return 1
+    return next((scale for scale in (8, 4, 2) if max(width, height) / scale >= max_size), 1)
+
+def fit_image(image: np.ndarray, max_size: int) -> np.ndarray:
+    """Shrink an image with INTER_AREA so its longest side is at most max_size (never enlarges)"""
+    height, width = image.shape[:2]
+    scale = max(height, width) / max_size
+    if scale <= 1:
+        return image
+    size = (max(1, round(width / scale)), max(1, round(height / scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def make_thumbnail(image_bytes, max_size: int) -> tuple:
+    """(thumbnail, decode_scale) of an encoded image, decoded at the smallest sufficient scale"""
+    decode_scale = thumbnail_decode_scale(image_bytes, max_size)
+    return fit_image(decode_image_bytes(image_bytes, decode_scale), max_size), decode_scale
+
+def content_digest(data) -> str:
+    """Hash of an encoded image payload (file bytes or base64 text), used to address cached results"""
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def decode_base64_image(base64_string: str, decode_scale: int = 1) -> np.ndarray:
     """Convert base64 string to OpenCV image"""
     try:
         # Remove data URL prefix if present
         if base64_string.startswith('data:image'):
-            base64_string = base64_string.split(',')[1]
+            base64_string = base64_string.partition(',')[2]
         
-        # Decode base64
         image_data = base64.b64decode(base64_string)
-        
-        # Convert to PIL Image then to OpenCV format
-        pil_image = Image.open(BytesIO(image_data))
-        opencv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-        
-        return opencv_image
     except Exception as e:
         logger.error(f"Error decoding base64 image: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
 
-def encode_image_to_base64(image: np.ndarray) -> str:
-    """Convert OpenCV image to base64 string"""
+    return decode_image_bytes(image_data, decode_scale)
+
+class OutputPolicy:
+    """How result images are encoded: codec plus PNG zlib level or lossy quality"""
+
+    # output_format -> (imencode extension, media type)
+    FORMATS = {
+        "png": (".png", "image/png"),
+        "webp_lossless": (".webp", "image/webp"),
+        "webp": (".webp", "image/webp"),
+        "jpeg": (".jpg", "image/jpeg")
+    }
+
+    def __init__(self, output_format: str = "png", quality: int = 90, png_compression: int = 1):
+        output_format = output_format.lower()
+        if output_format not in self.FORMATS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid output_format, expected one of: {', '.join(self.FORMATS)}"
+            )
+        self.output_format = output_format
+        self.quality = max(1, min(int(quality), 100))
+        self.png_compression = max(0, min(int(png_compression), 9))
+
+    @property
+    def extension(self) -> str:
+        return self.FORMATS[self.output_format][0]
+
+    @property
+    def media_type(self) -> str:
+        return self.FORMATS[self.output_format][1]
+
+    def encode_params(self) -> list:
+        if self.output_format == "png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        if self.output_format == "webp_lossless":
+            # OpenCV switches WebP to lossless mode for quality above 100
+            return [cv2.IMWRITE_WEBP_QUALITY, 101]
+        if self.output_format == "webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+
+    def describe(self) -> dict:
+        info = {"format": self.output_format, "media_type": self.media_type}
+        if self.output_format == "png":
+            info["png_compression"] = self.png_compression
+        elif self.output_format != "webp_lossless":
+            info["quality"] = self.quality
+        return info
+
+
+# Server-wide output policy, overridable per request with the output_* form fields
+DEFAULT_OUTPUT_POLICY = OutputPolicy(
+    os.environ.get("IMAGELAB_OUTPUT_FORMAT", "png"),
+    int(os.environ.get("IMAGELAB_OUTPUT_QUALITY", "90")),
+    int(os.environ.get("IMAGELAB_PNG_COMPRESSION", "1"))
+)
+
+
+def encode_image(image: np.ndarray, policy: Optional[OutputPolicy] = None) -> bytes:
+    """Encode OpenCV (BGR) image straight to the policy's codec with cv2.imencode"""
+    policy = policy or DEFAULT_OUTPUT_POLICY
     try:
-        # Convert BGR to RGB
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Convert to PIL Image
-        pil_image = Image.fromarray(image_rgb)
-        
-        # Convert to base64
-        buffer = BytesIO()
-        pil_image.save(buffer, format='PNG')
-        
-        return base64.b64encode(buffer.getvalue()).decode()
+        if policy.output_format == "jpeg" and image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+
+        success, buffer = cv2.imencode(policy.extension, image, policy.encode_params())
+        if not success:
+            raise ValueError(f"{policy.output_format} encoder failed")
+
+        return buffer.tobytes()
     except Exception as e:
-        logger.error(f"Error encoding image to base64: {str(e)}")
+        logger.error(f"Error encoding image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
+def encode_images(images: dict, policy: Optional[OutputPolicy] = None) -> dict:
+    """Encode named images, keeping their names"""
+    return {name: encode_image(img, policy) for name, img in images.items()}
+
+def encode_image_to_base64(image: np.ndarray, policy: Optional[OutputPolicy] = None) -> str:
+    """Convert OpenCV image to base64 string"""
+    return base64.b64encode(encode_image(image, policy)).decode()
+
+
+# RESPONSE NEGOTIATION
+
+# Accept media types that select the binary transport instead of base64-in-JSON
+BINARY_MEDIA_TYPES = {"image/png", "image/webp", "image/jpeg", "image/*", "application/octet-stream"}
+MULTIPART_MEDIA_TYPE = "multipart/mixed"
+
+
+def negotiate_transport(request: Request) -> str:
+    """Pick "json", "image" or "multipart" from the request's Accept header.
+
+    JSON wins ties (including */*), so clients that do not ask for a binary
+    response, like the Vue ImageProcessingService, keep the base64 contract.
+    """
+    best, best_q = "json", 0.0
+    for item in request.headers.get("accept", "").split(","):
+        media_type, _, params = item.strip().partition(";")
+        media_type = media_type.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        if media_type in ("application/json", "*/*"):
+            transport = "json"
+        elif media_type in BINARY_MEDIA_TYPES:
+            transport = "image"
+        elif media_type == MULTIPART_MEDIA_TYPE:
+            transport = "multipart"
+        else:
+            continue
+
+        if q > best_q or (q == best_q and transport == "json"):
+            best, best_q = transport, q
+    return best
+
+
+def json_header(metadata: dict) -> str:
+    return json.dumps(metadata, separators=(",", ":"), default=str)
+
+
+class ImageOutput:
+    """Builds an endpoint response from named result images and their metadata.
+
+    By default images are returned base64 encoded inside the JSON body. Clients
+    sending ``Accept: image/png`` get the raw bytes of a single-image result with
+    the metadata in the ``X-Image-Metadata`` header; ``Accept: multipart/mixed``
+    (or a binary Accept on a multi-image endpoint) returns a multipart body with
+    a JSON metadata part followed by one part per image. Images are encoded with
+    the request's output policy, and the codec and encoded sizes are reported.
+
+    ``run_operation`` serves repeated requests for the same input, operation,
+    parameters and output policy from the result cache, skipping both the
+    operation and the encode; ``X-Cache`` reports HIT or MISS. With a region
+    of interest, operations only process and change the selection (see
+    ``run_on_region``).
+    """
+
+    def __init__(self, request: Request, response: Response, policy: OutputPolicy,
+                 roi: Optional["RegionOfInterest"] = None):
+        self.request = request
+        self.response = response
+        self.policy = policy
+        self.roi = roi
+
+    async def run_operation(self, name: str, image: np.ndarray, preview_size: Optional[int] = None, **params):
+        """Run a registered operation and respond with its 3-channel result.
+
+        With ``preview_size`` the operation runs on a proxy whose longest side
+        is at most that many pixels (see ``preview_operation``).
+        """
+        fn, kwargs = bind_operation(name, params)
+
+        cache_key = self.cache_key(name, kwargs, preview_size)
+        if cache_key is not None:
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                return self.build(*cached, cache_status="HIT")
+
+        if preview_size:
+            source_size = (image.shape[1], image.shape[0])
+            image_id = getattr(self.request.state, "image_id", None)
+            if image_id is not None:
+                # Start from the smallest cached pyramid level that still covers the proxy
+                level = image_store.closest_level(image_id, preview_size)
+                if level > self.request.state.input_level:
+                    image = await stored_level(image_id, level)
+            result_image, info = await self.run(
+                preview_operation, fn, image, preview_size, source_size, roi=self.roi, **kwargs
+            )
+        else:
+            result_image, info = await self.run(display_operation, fn, image, roi=self.roi, **kwargs)
+        return await self.respond({"processed_image": result_image}, info, cache_key)
+
+    async def run(self, fn, *args, **kwargs):
+        """Run work on the CPU pool, reporting a region of interest it cannot apply as a 400"""
+        try:
+            return await cpu_pool.run(fn, *args, **kwargs)
+        except RegionOfInterestError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def reject_roi(self, endpoint: str):
+        """400 for endpoints whose outputs are not frames an operation can be limited to"""
+        if self.roi is not None:
+            raise HTTPException(status_code=400, detail=f"{endpoint} does not accept a region of interest")
+
+    def cache_key(self, name: str, kwargs: dict, preview_size: Optional[int] = None) -> Optional[str]:
+        """Result cache key for an operation on this request's input, or None when not cacheable"""
+        return operation_cache_key(
+            getattr(self.request.state, "input_digest", None), name, kwargs, self.policy, preview_size, self.roi
+        )
+
+    async def respond(self, images: dict, metadata: dict, cache_key: Optional[str] = None):
+        started = time.perf_counter()
+        if len(images) > 1:
+            # Outputs are independent, so each one is encoded as its own pool job
+            encoded = dict(zip(images, await asyncio.gather(*(
+                cpu_pool.run(encode_image, image, self.policy) for image in images.values()
+            ))))
+        else:
+            encoded = await cpu_pool.run(encode_images, images, self.policy)
+        encoding = {
+            **self.policy.describe(),
+            "sizes": {name: len(data) for name, data in encoded.items()},
+            "encode_ms": round((time.perf_counter() - started) * 1000, 2)
+        }
+
+        if cache_key is None:
+            return self.build(encoded, metadata, encoding)
+
+        result_cache.put(cache_key, encoded, metadata, encoding)
+        return self.build(encoded, metadata, encoding, cache_status="MISS")
+
+    def build(self, encoded: dict, metadata: dict, encoding: dict, cache_status: Optional[str] = None):
+        """Assemble the negotiated response from already-encoded images"""
+        transport = negotiate_transport(self.request)
+
+        if transport == "json":
+            if cache_status:
+                self.response.headers["X-Cache"] = cache_status
+            payload = {name: base64.b64encode(data).decode() for name, data in encoded.items()}
+            payload.update(metadata)
+            payload["encoding"] = encoding
+            return payload
+
+        headers = {
+            "X-Image-Metadata": json_header({**metadata, "images": list(encoded), "encoding": encoding}),
+            "X-Operation": str(metadata.get("operation", "")),
+            "X-Image-Format": self.policy.output_format,
+            "X-Encoded-Size": str(sum(encoding["sizes"].values()))
+        }
+        if cache_status:
+            headers["X-Cache"] = cache_status
+
+        if transport == "image" and len(encoded) == 1:
+            return Response(content=next(iter(encoded.values())), media_type=self.policy.media_type, headers=headers)
+
+        boundary = uuid.uuid4().hex
+        body = BytesIO()
+        body.write(
+            f"--{boundary}\r\nContent-Type: application/json\r\n"
+            f'Content-Disposition: inline; name="metadata"\r\n\r\n'.encode()
+        )
+        body.write(json_header({**metadata, "encoding": encoding}).encode())
+        for name, data in encoded.items():
+            body.write(
+                f"\r\n--{boundary}\r\nContent-Type: {self.policy.media_type}\r\n"
+                f'Content-Disposition: inline; name="{name}"; filename="{name}{self.policy.extension}"\r\n\r\n'.encode()
+            )
+            body.write(data)
+        body.write(f"\r\n--{boundary}--\r\n".encode())
+
+        return Response(
+            content=body.getvalue(),
+            media_type=f"{MULTIPART_MEDIA_TYPE}; boundary={boundary}",
+            headers=headers
+        )
+
+
+def operation_cache_key(input_digest: Optional[str], name: str, kwargs: dict, policy: OutputPolicy,
+                        preview_size: Optional[int] = None, roi: Optional["RegionOfInterest"] = None) -> Optional[str]:
+    """Result cache key for a registered operation, or None when not cacheable.
+
+    Defaults are filled in, so requests that spell out default parameters and
+    requests that leave them out share entries.
+    """
+    if input_digest is None or not result_cache.enabled:
+        return None
+    if preview_size:
+        input_digest = f"{input_digest}/preview{preview_size}"
+    if roi is not None:
+        input_digest = f"{input_digest}/roi{json_header(roi.describe())}"
+    return result_cache.key(input_digest, name, operation_arguments(OPERATIONS[name], **kwargs), policy)
+
+
+async def image_output(
+    request: Request,
+    response: Response,
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    png_compression: Optional[int] = Form(None),
+    roi: Optional[str] = Form(None),  # JSON {"x", "y", "width", "height"} in input pixels
+    roi_mask: Optional[str] = Form(None)  # base64 grayscale mask, white selects
+) -> ImageOutput:
+    """Per-request response builder; unset output_* fields fall back to the server-wide policy.
+
+    ``roi`` and ``roi_mask`` restrict the request's operation to a selection.
+    """
+    policy = DEFAULT_OUTPUT_POLICY
+    if output_format is not None or output_quality is not None or png_compression is not None:
+        policy = OutputPolicy(
+            output_format if output_format is not None else policy.output_format,
+            output_quality if output_quality is not None else policy.quality,
+            png_compression if png_compression is not None else policy.png_compression
+        )
+
+    region = None
+    if roi or roi_mask:
+        mask = await cpu_pool.run(decode_roi_mask, roi_mask) if roi_mask else None
+        region = RegionOfInterest(
+            parse_roi_rect(roi) if roi else None, mask, content_digest(roi_mask) if roi_mask else None
+        )
+    return ImageOutput(request, response, policy, region)
+
+
+async def preview_options(preview: bool = Form(False), preview_max_size: int = Form(PREVIEW_MAX_SIZE)) -> Optional[int]:
+    """Proxy size for a slider preview request, or None for a full-resolution (commit) request"""
+    if not preview:
+        return None
+    if preview_max_size < 16:
+        raise HTTPException(status_code=400, detail="preview_max_size must be at least 16")
+    return preview_max_size
+
+
+# RESULT CACHE
+
+
+class ResultCache:
+    """LRU cache of encoded operation results, bounded by their encoded size.
+
+    Keys are content addressed: the input image digest, the operation name,
+    its bound parameters and the output policy, so a repeated request hits
+    whether the input is re-sent or referenced by an image_id.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (encoded, metadata, encoding)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(input_digest: str, operation_name: str, params: dict, policy: OutputPolicy) -> str:
+        normalised = json.dumps(
+            [input_digest, operation_name, params, policy.describe()],
+            sort_keys=True, separators=(",", ":"), default=str
+        )
+        return hashlib.blake2b(normalised.encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, encoded: dict, metadata: dict, encoding: dict):
+        size = sum(len(data) for data in encoded.values())
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= sum(len(data) for data in previous[0].values())
+            self._entries[key] = (encoded, metadata, encoding)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self._bytes -= sum(len(data) for data in evicted.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_MB * 1024 * 1024)
+
+
+# SESSION IMAGE STORE
+
+class ScratchSpace:
+    """Memory-mapped files for large frames, in a per-process scratch directory.
+
+    Arrays from ``allocate`` and ``spill`` are ``np.memmap`` views that the OS
+    pages in and out on demand, so resident memory follows the frames being
+    worked on. Each file is removed once its array is garbage collected, and
+    the whole directory at interpreter exit.
+    """
+
+    def __init__(self, root: str, threshold_bytes: int):
+        self.root = root
+        self.threshold_bytes = threshold_bytes
+        self._directory = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_bytes > 0
+
+    def wants(self, nbytes: int) -> bool:
+        return self.enabled and nbytes >= self.threshold_bytes
+
+    def allocate(self, shape: tuple, dtype) -> np.ndarray:
+        """Uninitialised writable array, file backed when it is above the threshold"""
+        if not self.wants(int(np.prod(shape)) * np.dtype(dtype).itemsize):
+            return np.empty(shape, dtype=dtype)
+        array, path = self._create(shape, dtype)
+        weakref.finalize(array, self._remove, path)
+        return array
+
+    def spill(self, image: np.ndarray) -> np.ndarray:
+        """Move an image above the threshold to a read-only memory-mapped file"""
+        if isinstance(image, np.memmap) or not self.wants(image.nbytes):
+            return image
+        array, path = self._create(image.shape, image.dtype)
+        array[...] = image
+        array.flush()
+        del array
+        mapped = np.memmap(path, dtype=image.dtype, mode="r", shape=image.shape)
+        weakref.finalize(mapped, self._remove, path)
+        return mapped
+
+    def cleanup(self):
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _create(self, shape: tuple, dtype):
+        with self._lock:
+            if self._directory is None:
+                os.makedirs(self.root, exist_ok=True)
+                self._directory = tempfile.mkdtemp(prefix="imagelab-", dir=self.root)
+        path = os.path.join(self._directory, f"{uuid.uuid4().hex}.dat")
+        return np.memmap(path, dtype=dtype, mode="w+", shape=shape), path
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            # Still mapped elsewhere on platforms that refuse to unlink open files; removed at exit
+            pass
+
+
+scratch_space = ScratchSpace(SCRATCH_DIR, MEMMAP_THRESHOLD_MB * 1024 * 1024)
+atexit.register(scratch_space.cleanup)
+
+
+# Deepest pyramid level an operation can request (1/256 of the original size)
+MAX_PYRAMID_LEVEL = 8
+
+
+def pyramid_level(image: np.ndarray, level: int) -> np.ndarray:
+    """Reduce an image by 2**level with repeated cv2.pyrDown, stopping at one pixel"""
+    for _ in range(level):
+        if min(image.shape[:2]) < 2:
+            break
+        image = cv2.pyrDown(image)
+    return image
+
+
+def pyramid_levels(image: np.ndarray, count: int) -> list:
+    """The next ``count`` Gaussian pyramid levels below an image, each half the size of the one before"""
+    levels = []
+    for _ in range(count):
+        image = cv2.pyrDown(image)
+        levels.append(image)
+    return levels
+
+
+async def stored_level(image_id: str, level: int) -> Optional[np.ndarray]:
+    """Pyramid level of a stored image (see ``ImageStore.cached_level``).
+
+    Missing levels are built in the CPU pool from plain arrays, and kept by
+    the store in this process, so process workers never see the store.
+    """
+    image, cached, level = image_store.cached_level(image_id, level)
+    if image is None or cached == level:
+        return image
+    levels = await cpu_pool.run(pyramid_levels, image, level - cached)
+    return await cpu_pool.run_local(image_store.add_levels, image_id, cached, levels)
+
+
+class ImageStore:
+    """Bounded store of decoded images, addressed by an opaque image_id.
+
+    Entries are evicted least-recently-used first once the byte budget is
+    exceeded, and expire after ``ttl_seconds`` without being accessed. Each
+    entry also caches the Gaussian pyramid levels (``cv2.pyrDown``) that have
+    been requested so far; they count towards the budget and go with it.
+    Frames above the scratch threshold are spilled to memory-mapped files and
+    count towards ``max_mapped_bytes`` instead of the in-memory budget.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, scratch: ScratchSpace, max_mapped_bytes: int):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.scratch = scratch
+        self.max_mapped_bytes = max_mapped_bytes
+        self._entries = OrderedDict()  # image_id -> (image, last_access)
+        self._digests = {}  # image_id -> content digest of the uploaded file
+        self._levels = {}  # image_id -> [level 1, level 2, ...] built so far
+        self._annotations = {}  # image_id -> AnnotationLayer, created on first use
+        self._bytes = 0
+        self._mapped_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, image: np.ndarray, digest: Optional[str] = None) -> str:
+        """Store a decoded image and return its handle"""
+        limit = self.max_mapped_bytes if self.scratch.wants(image.nbytes) else self.max_bytes
+        if image.nbytes > limit:
+            raise HTTPException(status_code=413, detail="Image exceeds the session store budget")
+
+        image = self.scratch.spill(image)
+        # Stored images are shared between requests, so guard against in-place edits
+        image.flags.writeable = False
+        image_id = uuid.uuid4().hex
+
+        with self._lock:
+            self._entries[image_id] = (image, time.monotonic())
+            self._digests[image_id] = digest or image_id
+            self._levels[image_id] = []
+            self._account([image], 1)
+            self._evict()
+
+        return image_id
+
+    def get(self, image_id: str) -> Optional[np.ndarray]:
+        """Return the stored image, or None if it is unknown or expired"""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(image_id)
+            if entry is None:
+                return None
+            self._entries[image_id] = (entry[0], time.monotonic())
+            self._entries.move_to_end(image_id)
+            return entry[0]
+
+    def cached_level(self, image_id: str, level: int) -> tuple:
+        """(image, cached, level) for pyramid level ``level`` (0 is full resolution, each level halves the size).
+
+        ``level`` is clamped to the deepest level that is still at least one
+        pixel on each side, and ``image`` is the deepest cached level
+        ``cached`` on the way to it; image is None if the handle is unknown.
+        Missing levels are built from it and handed back to ``add_levels``.
+        """
+        image = self.get(image_id)
+        if image is None or level <= 0:
+            return image, 0, 0
+
+        level = min(level, int(np.log2(min(image.shape[:2]))))
+        with self._lock:
+            levels = list(self._levels.get(image_id, ()))
+        cached = min(level, len(levels))
+        return (levels[cached - 1] if cached else image), cached, level
+
+    def add_levels(self, image_id: str, cached: int, built: list) -> np.ndarray:
+        """Keep levels built below level ``cached`` for later requests and return the deepest one"""
+        built = [self.scratch.spill(level) for level in built]
+        for level in built:
+            level.flags.writeable = False
+
+        with self._lock:
+            # Another request may have built the same levels meanwhile, or the image was evicted
+            if image_id in self._entries and len(self._levels[image_id]) == cached:
+                self._levels[image_id].extend(built)
+                self._account(built, 1)
+                self._evict()
+        return built[-1]
+
+    def closest_level(self, image_id: str, max_size: int) -> int:
+        """Deepest pyramid level whose longest side is still at least max_size"""
+        image = self.get(image_id)
+        if image is None:
+            return 0
+        longest = max(image.shape[:2])
+        return max(0, int(np.floor(np.log2(longest / max_size)))) if longest > max_size else 0
+
+    def digest(self, image_id: str) -> Optional[str]:
+        """Content digest recorded when the image was loaded"""
+        with self._lock:
+            return self._digests.get(image_id)
+
+    def annotations(self, image_id: str, create: bool = True):
+        """Annotation layer of a stored image (created on first use), or None if the image is unknown"""
+        image = self.get(image_id)
+        if image is None:
+            return None
+        with self._lock:
+            layer = self._annotations.get(image_id)
+            if layer is None and create and image_id in self._entries:
+                layer = self._annotations[image_id] = AnnotationLayer(*image.shape[:2])
+            return layer
+
+    def clear_annotations(self, image_id: str) -> bool:
+        with self._lock:
+            return self._annotations.pop(image_id, None) is not None
+
+    def delete(self, image_id: str) -> bool:
+        with self._lock:
+            if image_id not in self._entries:
+                return False
+            self._drop(image_id)
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire()
+            return {
+                "images": len(self._entries),
+                "pyramid_levels": sum(len(levels) for levels in self._levels.values()),
+                "annotation_layers": len(self._annotations),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "mapped_bytes": self._mapped_bytes,
+                "max_mapped_bytes": self.max_mapped_bytes,
+                "ttl_seconds": self.ttl_seconds
+            }
+
+    def _account(self, arrays: list, sign: int):
+        for array in arrays:
+            if isinstance(array, np.memmap):
+                self._mapped_bytes += sign * array.nbytes
+            else:
+                self._bytes += sign * array.nbytes
+
+    def _drop(self, image_id: str):
+        # Scratch files go away once requests still reading the arrays release them
+        image, _ = self._entries.pop(image_id)
+        self._digests.pop(image_id, None)
+        self._annotations.pop(image_id, None)
+        self._account([image, *self._levels.pop(image_id, ())], -1)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._entries:
+            image_id, (_, last_access) = next(iter(self._entries.items()))
+            if last_access >= cutoff:
+                break
+            self._drop(image_id)
+
+    def _evict(self):
+        self._expire()
+        while (self._bytes > self.max_bytes or self._mapped_bytes > self.max_mapped_bytes) and self._entries:
+            self._drop(next(iter(self._entries)))
+
+
+image_store = ImageStore(
+    IMAGE_STORE_MAX_MB * 1024 * 1024,
+    IMAGE_STORE_TTL_SECONDS,
+    scratch_space,
+    SCRATCH_MAX_MB * 1024 * 1024
+)
+
+
+async def input_image(
+    request: Request,
+    image_data: Optional[str] = Form(None),
+    image_id: Optional[str] = Form(None),
+    image_file: Optional[UploadFile] = File(None),
+    decode_scale: int = Form(1),
+    level: int = Form(0)
+) -> np.ndarray:
+    """Resolve an operation's input from an image_id handle, a binary upload or inline base64 data.
+
+    decode_scale (1, 2, 4 or 8) requests a reduced-resolution input for previews,
+    and level selects a Gaussian pyramid level (each level halves the size).
+    Stored images serve both from their cached pyramid. The input's content
+    digest is recorded on ``request.state`` for the result cache.
+    """
+    if decode_scale not in DECODE_FLAGS:
+        raise HTTPException(status_code=400, detail="decode_scale must be one of 1, 2, 4 or 8")
+    if not 0 <= level <= MAX_PYRAMID_LEVEL:
+        raise HTTPException(status_code=400, detail=f"level must be between 0 and {MAX_PYRAMID_LEVEL}")
+
+    if image_id:
+        if image_store.get(image_id) is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired image_id, please reload the image")
+        level += decode_scale.bit_length() - 1
+        request.state.image_id = image_id
+        request.state.input_level = level
+        request.state.input_digest = f"{image_store.digest(image_id)}@1/L{level}"
+        return await stored_level(image_id, level)
+
+    if image_file is not None:
+        contents = await image_file.read()
+        request.state.input_digest = f"{content_digest(contents)}@{decode_scale}/L{level}"
+        image = await cpu_pool.run(decode_image_bytes, contents, decode_scale)
+    elif image_data:
+        request.state.input_digest = f"{content_digest(image_data)}@{decode_scale}/L{level}"
+        image = await cpu_pool.run(decode_base64_image, image_data, decode_scale)
+    else:
+        raise HTTPException(status_code=422, detail="One of image_data, image_file or image_id is required")
+
+    if level:
+        image = await cpu_pool.run(pyramid_level, image, level)
+    return image
+
+
+# OPERATION REGISTRY
+
+# Chainable operations by name. Each takes a BGR or single-channel uint8 image
+# plus keyword parameters and returns (result_image, metadata); endpoints,
+# pipelines and batch processing all run the same implementations.
+OPERATIONS = {}
+MAX_PIPELINE_STEPS = 32
+
+
+def operation(
+    name: str,
+    scaled_params: tuple = (),
+    halo=None,
+    point=None,
+    gray_input: bool = False,
+    tile_threshold=None,
+    geometry=None
+):
+    """Register an operation implementation under its endpoint name.
+
+    ``scaled_params`` names the odd kernel/block size parameters measured in
+    pixels, which are rescaled when the operation runs on a reduced-size proxy.
+    ``halo`` maps the operation's arguments to the radius in pixels that an
+    output pixel depends on; operations that declare it can run tile by tile.
+    ``point`` maps the arguments to "channel" when each output value depends
+    only on the same input value and channel, to "gray" when the operation
+    is a grayscale conversion followed by such a map, and to None otherwise;
+    point operations run as lookup tables (see ``run_point_operations``).
+    ``gray_input`` marks operations that start by converting to grayscale, so
+    callers running several operations on one image can share that conversion.
+    ``tile_threshold`` maps the arguments to a lower tiling threshold in
+    megapixels (or None) for operations slow enough that spreading a
+    mid-sized image over the tile workers outweighs the halo overlap.
+    ``geometry`` maps the arguments and the input (width, height) to the
+    operation's 3x3 pixel coordinate transform, output size, interpolation
+    and metadata; consecutive geometric operations are composed into a single
+    warp (see ``run_geometry_operations``).
+    """
+    def register(fn):
+        fn.scaled_params = scaled_params
+        fn.halo = halo
+        fn.point = point
+        fn.gray_input = gray_input
+        fn.tile_threshold = tile_threshold
+        fn.geometry = geometry
+        OPERATIONS[name] = fn
+        return fn
+    return register
+
+
+def as_gray(image: np.ndarray) -> np.ndarray:
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def as_bgr(image: np.ndarray) -> np.ndarray:
+    return image if image.ndim == 3 else cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def display_operation(fn, image: np.ndarray, *args, roi: Optional["RegionOfInterest"] = None, **kwargs):
+    """Run an operation and expand its result to 3-channel BGR for display, on the region of interest only if given"""
+    if roi is not None:
+        def run(region: np.ndarray):
+            result_image, info = apply_operation(fn, region, *args, **kwargs)
+            return {"processed_image": result_image}, info
+
+        halo = operation_halo(fn, operation_arguments(fn, *args, **kwargs))
+        images, info, selection = run_on_region(run, image, roi, halo)
+        return images["processed_image"], {**info, "roi": selection}
+
+    result_image, info = apply_operation(fn, image, *args, **kwargs)
+    return as_bgr(result_image), info
+
+
+# TILED EXECUTION
+
+# Tile jobs get their own threads: they are submitted from inside CPU pool jobs,
+# which would deadlock waiting on a saturated CPU pool
+tile_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="tile")
+
+
+def operation_arguments(fn, *args, **kwargs) -> dict:
+    """All of an operation's parameters except the image, with defaults filled in"""
+    bound = inspect.signature(fn).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    del arguments["image"]
+    return arguments
+
+
+def apply_operation(fn, image: np.ndarray, *args, **kwargs):
+    """Run an operation as a lookup table when it is a point operation, otherwise
+    in tiles when the image is above the tiling threshold and the operation allows it"""
+    pixels = image.shape[0] * image.shape[1]
+    tiled = fn.halo is not None and pixels >= TILE_THRESHOLD_MP * 1_000_000
+    # Only worth looking at the operation's own threshold when there are workers to spread over
+    spread = fn.halo is not None and fn.tile_threshold is not None and CPU_WORKERS > 1 and not tiled
+    if fn.point is None and not tiled and not spread:
+        return fn(image, *args, **kwargs)
+
+    arguments = operation_arguments(fn, *args, **kwargs)
+    if fn.point is not None and fn.point(arguments):
+        result_image, (info,) = run_point_operations(image, [(fn, arguments)])
+        return result_image, info
+    if spread:
+        threshold = fn.tile_threshold(arguments)
+        spread = threshold is not None and pixels >= threshold * 1_000_000
+    if not tiled and not spread:
+        return fn(image, **arguments)
+
+    halo = int(fn.halo(arguments))
+
+    # Keep the halo a small fraction of each tile so overlap does not dominate the work;
+    # below the global threshold, size tiles so every worker gets one
+    tile_size = TILE_SIZE if tiled else min(TILE_SIZE, math.ceil(math.sqrt(pixels / CPU_WORKERS)))
+    return run_tiled(fn, image, halo, max(tile_size, 4 * halo), **arguments)
+
+
+# POINT OPERATIONS
+
+# Every 8-bit value once: a point operation applied to it yields its lookup table
+POINT_RAMP = np.arange(256, dtype=np.uint8).reshape(1, 256)
+POINT_RAMP.flags.writeable = False
+
+
+@functools.lru_cache(maxsize=512)
+def trace_point_operation(fn, channels: int, params: tuple):
+    """Lookup table and metadata of a point operation for a given channel count.
+
+    The operation's own implementation is run on a 256-pixel ramp, so the
+    table reproduces it exactly, including OpenCV's saturation and rounding.
+    """
+    ramp = POINT_RAMP if channels == 1 else cv2.merge([POINT_RAMP] * channels)
+    lut, info = fn(ramp, **dict(params))
+    return lut.reshape(1, 256, -1) if lut.ndim == 3 else lut.reshape(1, 256), info
+
+
+def run_point_operations(image: np.ndarray, steps: list):
+    """Apply a run of point operations (fn, arguments) in as few passes as possible.
+
+    Consecutive tables are composed into one, so the whole run costs a single
+    ``cv2.LUT`` pass per channel layout: at most one over the BGR frame, the
+    grayscale conversion if a step needs it, and one over the gray frame.
+    Returns the result and each step's metadata.
+    """
+    lut = None
+    infos = []
+    for fn, arguments in steps:
+        original_shape = image.shape
+        if fn.point(arguments) == "gray" and image.ndim == 3:
+            if lut is not None:
+                image = cv2.LUT(image, lut)
+                lut = None
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        table, info = trace_point_operation(fn, channels, tuple(sorted(arguments.items())))
+        # out[v] = table[lut[v]] per channel
+        lut = table if lut is None else np.take_along_axis(table, lut.astype(np.intp), axis=1)
+
+        if "processed_shape" in info:
+            # Traced on the ramp, so report the frame's real shapes instead
+            info = {**info, "original_shape": original_shape, "processed_shape": image.shape}
+        infos.append(dict(info))
+
+    if lut is not None and not (lut.reshape(256, -1) == POINT_RAMP.reshape(256, 1)).all():
+        image = cv2.LUT(image, lut)
+    return image, infos
+
+
+def run_tiled(fn, image: np.ndarray, halo: int, tile_size: int, **kwargs):
+    """Apply a local operation tile by tile and stitch the results without seams.
+
+    Each tile is processed with ``halo`` extra pixels of real neighbourhood on
+    every side that has one, and only its core is copied into the output, so
+    every output pixel sees the same neighbourhood as in a whole-image run;
+    tiles on the image edge keep the operation's own border handling. At most
+    two tiles per worker are in flight, so temporaries stay bounded by the
+    tile size rather than the image size, and a large output is allocated in
+    scratch space.
+    """
+    height, width = image.shape[:2]
+    origins = iter([(y, x) for y in range(0, height, tile_size) for x in range(0, width, tile_size)])
+
+    def process(y: int, x: int):
+        bottom, right = min(y + tile_size, height), min(x + tile_size, width)
+        top, left = max(0, y - halo), max(0, x - halo)
+        result, info = fn(image[top:min(height, bottom + halo), left:min(width, right + halo)], **kwargs)
+        return y, x, result[y - top:bottom - top, x - left:right - left], info
+
+    def submit_next(pending: set):
+        origin = next(origins, None)
+        if origin is not None:
+            pending.add(tile_executor.submit(process, *origin))
+
+    pending = set()
+    for _ in range(2 * CPU_WORKERS):
+        submit_next(pending)
+
+    output, info = None, {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            y, x, tile, info = future.result()
+            if output is None:
+                output = scratch_space.allocate((height, width) + tile.shape[2:], tile.dtype)
+            output[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+            submit_next(pending)
+
+    return output, info
+
+
+# REGIONS OF INTEREST
+
+
+class RegionOfInterestError(ValueError):
+    """A region of interest that cannot be applied to the image or operation (a client error)"""
+
+
+class RegionOfInterest:
+    """A selection that limits an operation to part of the frame.
+
+    ``rect`` is an (x, y, width, height) rectangle in input pixels, and
+    ``mask`` a single-channel uint8 weight map: 0 keeps the original pixel,
+    255 takes the result and values in between blend the two. A mask whose
+    size differs from the frame is stretched over it, so a selection painted
+    on a downscaled display still lines up. With both, the mask only applies
+    inside the rectangle.
+    """
+
+    def __init__(self, rect: Optional[tuple] = None, mask: Optional[np.ndarray] = None,
+                 mask_digest: Optional[str] = None, scale: float = 1.0):
+        self.rect = rect
+        self.mask = mask
+        self.mask_digest = mask_digest
+        self.scale = scale
+
+    def describe(self) -> dict:
+        info = {}
+        if self.rect is not None:
+            info["rect"] = list(self.rect)
+        if self.mask is not None:
+            info["mask"] = self.mask_digest
+        return info
+
+    def scaled(self, scale: float) -> "RegionOfInterest":
+        """The same selection on a copy of the frame resized by ``scale``"""
+        return RegionOfInterest(self.rect, self.mask, self.mask_digest, self.scale * scale)
+
+    def weights(self, width: int, height: int) -> Optional[np.ndarray]:
+        """The mask stretched to a width x height frame, or None for a plain rectangle"""
+        if self.mask is None or self.mask.shape[:2] == (height, width):
+            return self.mask
+        shrink = self.mask.shape[1] > width
+        return cv2.resize(self.mask, (width, height), interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR)
+
+    def bounds(self, width: int, height: int, weights: Optional[np.ndarray] = None) -> Optional[tuple]:
+        """Half-open (left, top, right, bottom) box of the selection clamped to the frame, or None when empty"""
+        left, top, right, bottom = 0, 0, width, height
+        if self.rect is not None:
+            x, y, w, h = self.rect
+            # Round outwards so a scaled selection still covers every pixel it touches
+            left = max(0, math.floor(x * self.scale))
+            top = max(0, math.floor(y * self.scale))
+            right = min(width, math.ceil((x + w) * self.scale))
+            bottom = min(height, math.ceil((y + h) * self.scale))
+        if weights is not None and right > left and bottom > top:
+            x, y, w, h = cv2.boundingRect(weights[top:bottom, left:right])
+            left, top, right, bottom = left + x, top + y, left + x + w, top + y + h
+        if right <= left or bottom <= top:
+            return None
+        return left, top, right, bottom
+
+
+def parse_roi_rect(value) -> tuple:
+    """(x, y, width, height) from a {"x", "y", "width", "height"} object or its JSON text"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid roi JSON: {e}")
+    try:
+        rect = tuple(int(value[key]) for key in ("x", "y", "width", "height"))
+    except (TypeError, KeyError, ValueError):
+        raise HTTPException(status_code=400, detail='roi must be an object with integer "x", "y", "width" and "height"')
+    if rect[2] < 1 or rect[3] < 1:
+        raise HTTPException(status_code=400, detail="roi width and height must be positive")
+    return rect
+
+
+def decode_roi_mask(data: str) -> np.ndarray:
+    return as_gray(decode_base64_image(data))
+
+
+def operation_halo(fn, arguments: dict) -> Optional[int]:
+    """Pixels of neighbourhood an output pixel depends on, or None when the operation is not local"""
+    if fn.halo is not None:
+        return int(fn.halo(arguments))
+    if fn.point is not None and fn.point(arguments):
+        return 0
+    return None
+
+
+def run_on_region(run, image: np.ndarray, roi: RegionOfInterest, halo: Optional[int]):
+    """Process only a region of interest and blend the results back into the frame.
+
+    ``run`` maps an image to (named result images, metadata). Like a tile in
+    ``run_tiled``, it is given the selection's bounding box plus ``halo``
+    pixels of real neighbourhood, so pixels inside the selection match a
+    whole-frame run while the work scales with the selection. Operations
+    that are not local (``halo`` None) run on the whole frame, and only the
+    selection of their result is kept. Returns the BGR frames, the metadata
+    and a description of the processed region.
+    """
+    height, width = image.shape[:2]
+    weights = roi.weights(width, height)
+    box = roi.bounds(width, height, weights)
+    if box is None:
+        raise RegionOfInterestError("The region of interest does not overlap the image")
+    left, top, right, bottom = box
+
+    if halo is None:
+        area = (0, 0, width, height)
+    else:
+        area = (max(0, left - halo), max(0, top - halo), min(width, right + halo), min(height, bottom + halo))
+    results, info = run(image[area[1]:area[3], area[0]:area[2]])
+
+    frame = as_bgr(image)
+    alpha = None if weights is None else weights[top:bottom, left:right, None].astype(np.uint16)
+    blended = {}
+    for name, result in results.items():
+        if result.shape[:2] != (area[3] - area[1], area[2] - area[0]):
+            raise RegionOfInterestError("A region of interest needs operations that keep the image size")
+        core = as_bgr(result[top - area[1]:bottom - area[1], left - area[0]:right - area[0]])
+        output = frame.copy()
+        target = output[top:bottom, left:right]
+        if alpha is None:
+            target[...] = core
+        else:
+            target[...] = (core * alpha + target * (255 - alpha) + 127) // 255
+        blended[name] = output
+
+    return blended, info, {
+        "x": left,
+        "y": top,
+        "width": right - left,
+        "height": bottom - top,
+        "processed": {"x": area[0], "y": area[1], "width": area[2] - area[0], "height": area[3] - area[1]},
+        "masked": weights is not None
+    }
+
+
+def preview_operation(fn, image: np.ndarray, max_size: int, source_size: Optional[tuple] = None,
+                      roi: Optional[RegionOfInterest] = None, **kwargs):
+    """Run an operation on a proxy downscaled to fit max_size, for fast slider previews.
+
+    Pixel-sized parameters listed in the operation's ``scaled_params`` are
+    divided by the same factor (kept odd), so kernels and blocks cover the
+    same part of the picture as they would at full resolution. ``image`` may
+    already be a reduced pyramid level of an image of ``source_size`` (w, h);
+    a region of interest is given in ``source_size`` pixels.
+    """
+    width, height = source_size or (image.shape[1], image.shape[0])
+    scale = max(height, width) / max_size
+    if scale > 1:
+        size = (max(1, round(width / scale)), max(1, round(height / scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        if fn.scaled_params:
+            # Bind defaults first, so parameters the caller left out are scaled too
+            kwargs = operation_arguments(fn, **kwargs)
+            for key in fn.scaled_params:
+                kwargs[key] = max(1, round(kwargs[key] / scale)) | 1
+        if roi is not None:
+            roi = roi.scaled(size[0] / width)
+    else:
+        scale = 1.0
+
+    result_image, info = display_operation(fn, image, roi=roi, **kwargs)
+    return result_image, {
+        **info,
+        "preview": {
+            "scale": round(scale, 4),
+            "width": result_image.shape[1],
+            "height": result_image.shape[0],
+            "source_width": width,
+            "source_height": height
+        }
+    }
+
+
+def bind_operation(name: str, params: Optional[dict] = None, strict: bool = True):
+    """Look up an operation and coerce its parameters to the annotated types.
+
+    Unknown parameters raise a 400 when ``strict``, and are ignored otherwise.
+    """
+    if not isinstance(name, str):
+        raise HTTPException(status_code=400, detail=f"Operation must be a name, got {name!r}")
+    if params is not None and not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail=f"Parameters for {name} must be an object, got {params!r}")
+    fn = OPERATIONS.get(name)
+    if fn is None:
+        raise HTTPException(status_code=400, detail=f"Unknown operation: {name}")
+
+    signature = inspect.signature(fn).parameters
+    kwargs = {}
+    for key, value in (params or {}).items():
+        if key == "image" or key not in signature:
+            if strict:
+                raise HTTPException(status_code=400, detail=f"Unknown parameter for {name}: {key}")
+            continue
+
+        annotation = signature[key].annotation
+        try:
+            if annotation is bool and isinstance(value, str):
+                value = value.strip().lower() in ("1", "true", "yes", "on")
+            elif annotation in (int, float, str, bool):
+                value = annotation(value)
+        except (TypeError, ValueError, OverflowError):
+            raise HTTPException(status_code=400, detail=f"Invalid value for {name}.{key}: {value!r}")
+        kwargs[key] = value
+
+    return fn, kwargs
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -90,7 +1461,12 @@ async def health_check():
     return {
         "status": "healthy", 
         "opencv_version": cv2.__version__,
-        "api_version": "1.0.0"
+        "api_version": "1.0.0",
+        "image_store": image_store.stats(),
+        "cpu_pool": cpu_pool.stats(),
+        "result_cache": result_cache.stats(),
+        "denoise_budget": denoise_budget.stats(),
+        "sessions": session_totals
     }
 
 
@@ -98,36 +1474,88 @@ async def health_check():
 
 
 @app.post("/api/load-image")
-async def load_image(file: UploadFile = File(...)):
-    """Load and return image information"""
+async def load_image(output: ImageOutput = Depends(image_output), file: UploadFile = File(...)):
+    """Load image, keep it in the session store and return its handle and information"""
+    output.reject_roi("/api/load-image")
     try:
         contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            raise HTTPException(status_code=400, detail="Invalid image file")
+        image = await cpu_pool.run(decode_image_bytes, contents)
         
         height, width, channels = image.shape
+        # The store lives in this process; only spilling a large frame to scratch space is slow
+        image_id = await cpu_pool.run_local(image_store.put, image, content_digest(contents))
         
-        return {
+        return await output.respond({
+            "image": image
+        }, {
+            "image_id": image_id,
             "width": int(width),
             "height": int(height),
             "channels": int(channels),
             "size": len(contents),
             "format": file.content_type,
-            "image": encode_image_to_base64(image),
             "status": "success"
-        }
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error loading image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def thumbnail_policy(
+    thumbnail_format: str = Form("jpeg"),  # jpeg or webp
+    thumbnail_quality: int = Form(80)
+) -> OutputPolicy:
+    if thumbnail_format not in ("jpeg", "webp"):
+        raise HTTPException(status_code=400, detail="thumbnail_format must be jpeg or webp")
+    return OutputPolicy(thumbnail_format, thumbnail_quality)
+
+
+@app.post("/api/thumbnail")
+async def create_thumbnail(
+    request: Request,
+    response: Response,
+    file: UploadFile = File(...),
+    max_size: int = Form(THUMBNAIL_MAX_SIZE),
+    policy: OutputPolicy = Depends(thumbnail_policy)
+):
+    """Small JPEG/WebP preview of an image file, decoded at reduced scale and cached by content hash"""
+    if not 16 <= max_size <= 2048:
+        raise HTTPException(status_code=400, detail="max_size must be between 16 and 2048")
+
+    output = ImageOutput(request, response, policy)
+    try:
+        contents = await file.read()
+        cache_key = result_cache.key(content_digest(contents), "thumbnail", {"max_size": max_size}, policy) if result_cache.enabled else None
+        cached = result_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return output.build(*cached, cache_status="HIT")
+
+        thumbnail, decode_scale = await cpu_pool.run(make_thumbnail, contents, max_size)
+        return await output.respond({"thumbnail": thumbnail}, {
+            "width": int(thumbnail.shape[1]),
+            "height": int(thumbnail.shape[0]),
+            "decode_scale": decode_scale,
+            "size": len(contents),
+            "operation": "thumbnail"
+        }, cache_key)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating thumbnail: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/images/{image_id}")
+async def release_image(image_id: str):
+    """Drop a loaded image from the session store"""
+    if not image_store.delete(image_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id")
+    return {"image_id": image_id, "status": "released"}
+
 @app.post("/api/dimensions")
-async def get_dimensions(image_data: str = Form(...)):
+async def get_dimensions(image: np.ndarray = Depends(input_image)):
     """Get image dimensions and properties"""
     try:
-        image = decode_base64_image(image_data)
         height, width = image.shape[:2]
         channels = image.shape[2] if len(image.shape) == 3 else 1
         
@@ -146,34 +1574,33 @@ async def get_dimensions(image_data: str = Form(...)):
 # GRAYSCALING
 
 
+@operation("grayscale", point=lambda args: "gray")
+def op_grayscale(image: np.ndarray):
+    """Convert image to grayscale"""
+    gray_image = as_gray(image)
+
+    return gray_image, {
+        "original_shape": image.shape,
+        "processed_shape": gray_image.shape,
+        "operation": "grayscale_conversion"
+    }
+
 @app.post("/api/grayscale")
-async def convert_grayscale(image_data: str = Form(...)):
+async def convert_grayscale(output: ImageOutput = Depends(image_output), image: np.ndarray = Depends(input_image)):
     """Convert image to grayscale"""
     try:
-        image = decode_base64_image(image_data)
-        
-        # Convert to grayscale
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Convert back to 3-channel for consistent display
-        gray_3channel = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(gray_3channel),
-            "original_shape": image.shape,
-            "processed_shape": gray_image.shape,
-            "operation": "grayscale_conversion"
-        }
+        return await output.run_operation("grayscale", image)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in grayscale conversion: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/compare-dimensions")
-async def compare_dimensions(image_data: str = Form(...)):
+async def compare_dimensions(image: np.ndarray = Depends(input_image)):
     """Compare color and grayscale image dimensions"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray_image = await cpu_pool.run(cv2.cvtColor, image, cv2.COLOR_BGR2GRAY)
         
         return {
             "color_dimensions": {
@@ -199,85 +1626,155 @@ async def compare_dimensions(image_data: str = Form(...)):
 # COLOR SPACES  
 
 
+# Client-side tint (RGB) for each compact channel plane: the plane is drawn as value * tint / 255
+RGB_CHANNEL_TINTS = {
+    "red_channel": [255, 0, 0],
+    "green_channel": [0, 255, 0],
+    "blue_channel": [0, 0, 255]
+}
+
+
+def rgb_channel_images(image: np.ndarray, compact: bool = False) -> dict:
+    """Extract individual RGB channels as 3-channel visualizations, or as bare planes when compact"""
+    # Split into BGR channels (OpenCV uses BGR)
+    b, g, r = cv2.split(image)
+
+    if compact:
+        return {"red_channel": r, "green_channel": g, "blue_channel": b}
+
+    # Create single-channel visualizations
+    zeros = np.zeros_like(b)
+    b_3channel = cv2.merge([b, zeros, zeros])
+    g_3channel = cv2.merge([zeros, g, zeros])
+    r_3channel = cv2.merge([zeros, zeros, r])
+
+    return {
+        "red_channel": r_3channel,
+        "green_channel": g_3channel,
+        "blue_channel": b_3channel
+    }
+
 @app.post("/api/rgb-channels")
-async def extract_rgb_channels(image_data: str = Form(...)):
+async def extract_rgb_channels(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    compact: bool = Form(False)  # single-channel planes, tinted by the client
+):
     """Extract individual RGB channels"""
+    output.reject_roi("/api/rgb-channels")
     try:
-        image = decode_base64_image(image_data)
-        
-        # Split into BGR channels (OpenCV uses BGR)
-        b, g, r = cv2.split(image)
-        
-        # Create single-channel visualizations
-        b_3channel = cv2.merge([b, np.zeros_like(b), np.zeros_like(b)])
-        g_3channel = cv2.merge([np.zeros_like(g), g, np.zeros_like(g)])
-        r_3channel = cv2.merge([np.zeros_like(r), np.zeros_like(r), r])
-        
-        return {
-            "red_channel": encode_image_to_base64(r_3channel),
-            "green_channel": encode_image_to_base64(g_3channel),
-            "blue_channel": encode_image_to_base64(b_3channel),
-            "operation": "rgb_channel_extraction"
-        }
+        channels = await cpu_pool.run(rgb_channel_images, image, compact)
+
+        metadata = {"operation": "rgb_channel_extraction"}
+        if compact:
+            metadata.update(compact=True, tints=RGB_CHANNEL_TINTS)
+        return await output.respond(channels, metadata)
     except Exception as e:
         logger.error(f"Error extracting RGB channels: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/hsv-convert")
-async def convert_hsv(image_data: str = Form(...)):
-    """Convert image to HSV color space"""
-    try:
-        image = decode_base64_image(image_data)
-        
-        # Convert to HSV
-        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
-        # Split HSV channels
-        h, s, v = cv2.split(hsv_image)
-        
+@functools.lru_cache(maxsize=1)
+def hue_palette() -> list:
+    """COLORMAP_HSV as 256 RGB entries, so clients can colour a compact hue plane"""
+    ramp = np.arange(256, dtype=np.uint8).reshape(1, 256)
+    return cv2.applyColorMap(ramp, cv2.COLORMAP_HSV)[0, :, ::-1].tolist()
+
+def hsv_channel_images(image: np.ndarray, compact: bool = False) -> dict:
+    """Convert image to HSV and visualize each channel, or return the bare planes when compact"""
+    # Convert to HSV
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+    # Split HSV channels
+    h, s, v = cv2.split(hsv_image)
+
+    if compact:
+        h_vis, s_vis, v_vis = h, s, v
+    else:
         # Create visualizations
         h_vis = cv2.applyColorMap(h, cv2.COLORMAP_HSV)
         s_vis = cv2.cvtColor(s, cv2.COLOR_GRAY2BGR)
         v_vis = cv2.cvtColor(v, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "hsv_image": encode_image_to_base64(cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)),
-            "hue_channel": encode_image_to_base64(h_vis),
-            "saturation_channel": encode_image_to_base64(s_vis),
-            "value_channel": encode_image_to_base64(v_vis),
-            "operation": "hsv_conversion"
-        }
+
+    return {
+        "hsv_image": cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR),
+        "hue_channel": h_vis,
+        "saturation_channel": s_vis,
+        "value_channel": v_vis
+    }
+
+@app.post("/api/hsv-convert")
+async def convert_hsv(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    compact: bool = Form(False)  # single-channel planes, coloured by the client
+):
+    """Convert image to HSV color space"""
+    output.reject_roi("/api/hsv-convert")
+    try:
+        channels = await cpu_pool.run(hsv_channel_images, image, compact)
+
+        metadata = {"operation": "hsv_conversion"}
+        if compact:
+            # Saturation and value are plain grayscale; hue is looked up in the palette
+            metadata.update(compact=True, palettes={"hue_channel": hue_palette()})
+        return await output.respond(channels, metadata)
     except Exception as e:
         logger.error(f"Error in HSV conversion: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@functools.lru_cache(maxsize=256)
+def hsv_adjustment_lut(hue_shift: int, saturation_factor: float, value_factor: float) -> np.ndarray:
+    """Per-channel 256-entry table for the HSV hue shift and saturation/value scaling.
+
+    Entries are computed with the same float32 arithmetic, clipping and
+    truncation the per-pixel version used, so results are bit-identical.
+    """
+    levels = np.arange(256, dtype=np.float32)
+    lut = np.stack([
+        (levels + hue_shift) % 180,
+        np.clip(levels * saturation_factor, 0, 255),
+        np.clip(levels * value_factor, 0, 255)
+    ], axis=-1).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut.reshape(1, 256, 3)
+
+@operation("color-manipulation", halo=lambda args: 0)
+def op_color_manipulation(
+    image: np.ndarray,
+    hue_shift: int = 0,
+    saturation_factor: float = 1.0,
+    value_factor: float = 1.0
+):
+    """Manipulate color channels"""
+    hsv_image = cv2.cvtColor(as_bgr(image), cv2.COLOR_BGR2HSV)
+
+    # Manipulate HSV channels in one uint8 pass, in place
+    cv2.LUT(hsv_image, hsv_adjustment_lut(hue_shift, saturation_factor, value_factor), dst=hsv_image)
+
+    # Convert back to BGR
+    result_image = cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)
+
+    return result_image, {
+        "hue_shift": hue_shift,
+        "saturation_factor": saturation_factor,
+        "value_factor": value_factor,
+        "operation": "color_manipulation"
+    }
+
 @app.post("/api/color-manipulation")
 async def manipulate_color(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     hue_shift: int = Form(0),
     saturation_factor: float = Form(1.0),
-    value_factor: float = Form(1.0)
+    value_factor: float = Form(1.0),
+    preview_size: Optional[int] = Depends(preview_options)
 ):
     """Manipulate color channels"""
     try:
-        image = decode_base64_image(image_data)
-        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
-        
-        # Manipulate HSV channels
-        hsv_image[:, :, 0] = (hsv_image[:, :, 0] + hue_shift) % 180
-        hsv_image[:, :, 1] = np.clip(hsv_image[:, :, 1] * saturation_factor, 0, 255)
-        hsv_image[:, :, 2] = np.clip(hsv_image[:, :, 2] * value_factor, 0, 255)
-        
-        # Convert back to BGR
-        result_image = cv2.cvtColor(hsv_image.astype(np.uint8), cv2.COLOR_HSV2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "hue_shift": hue_shift,
-            "saturation_factor": saturation_factor,
-            "value_factor": value_factor,
-            "operation": "color_manipulation"
-        }
+        return await output.run_operation("color-manipulation", image, preview_size=preview_size, hue_shift=hue_shift, saturation_factor=saturation_factor, value_factor=value_factor)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in color manipulation: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -287,20 +1784,373 @@ async def manipulate_color(
 
 # ...existing code...
 
+# Fields that decide how a shape is drawn, besides its geometry
+SHAPE_STYLE_FIELDS = ("type", "color", "thickness", "filled")
+
+
+def opaque_color(image: np.ndarray, bgr_color: tuple) -> tuple:
+    """Drawing colour for ``image``: BGR, plus full alpha on a BGRA layer"""
+    return bgr_color + (255,) if image.ndim == 3 and image.shape[2] == 4 else bgr_color
+
+
+def shape_style(shape: dict) -> tuple:
+    """Validated (type, BGR colour, thickness, filled) of a shape; consecutive
+    shapes with the same style are rendered together"""
+    color = shape.get("color", [255, 255, 255])
+    thickness = shape.get("thickness", 2)
+
+    # Validate color format
+    if not isinstance(color, list) or len(color) < 3:
+        logger.debug(f"Invalid color format: {color}, using default")
+        color = [255, 255, 255]
+
+    # Validate thickness
+    try:
+        thickness = int(thickness)
+        if thickness < 1:
+            thickness = 1
+    except (ValueError, TypeError):
+        logger.debug(f"Invalid thickness: {thickness}, using default")
+        thickness = 2
+
+    # Convert RGB to BGR for OpenCV
+    bgr_color = (int(color[2]), int(color[1]), int(color[0]))
+    return shape.get("type", "").lower(), bgr_color, thickness, bool(shape.get("filled", False))
+
+
+def draw_shape(result_image: np.ndarray, shape: dict, shape_type: str, bgr_color: tuple, thickness: int, filled: bool) -> Optional[str]:
+    """Draw a single shape; returns its description, or None when it is skipped"""
+    height, width = result_image.shape[:2]
+    line_thickness = -1 if filled else thickness
+
+    if shape_type == "rectangle":
+        # Get and validate coordinates
+        x1 = int(shape.get("x1", 0))
+        y1 = int(shape.get("y1", 0))  
+        x2 = int(shape.get("x2", 100))
+        y2 = int(shape.get("y2", 100))
+
+        # Ensure coordinates are within image bounds
+        x1 = max(0, min(x1, width - 1))
+        y1 = max(0, min(y1, height - 1))
+        x2 = max(0, min(x2, width - 1))
+        y2 = max(0, min(y2, height - 1))
+
+        # Ensure we have a valid rectangle (not just a line)
+        if abs(x2 - x1) > 0 and abs(y2 - y1) > 0:
+            cv2.rectangle(result_image, (x1, y1), (x2, y2), bgr_color, line_thickness)
+            return f"Rectangle: ({x1},{y1}) to ({x2},{y2})"
+        else:
+            logger.debug(f"Invalid rectangle dimensions: ({x1},{y1}) to ({x2},{y2})")
+            return None
+
+    elif shape_type == "circle":
+        center_x = int(shape.get("center_x", 50))
+        center_y = int(shape.get("center_y", 50))
+        radius = int(shape.get("radius", 25))
+
+        # Validate parameters
+        center_x = max(0, min(center_x, width - 1))
+        center_y = max(0, min(center_y, height - 1))
+        radius = max(1, min(radius, min(width, height) // 2))
+
+        cv2.circle(result_image, (center_x, center_y), radius, bgr_color, line_thickness)
+        return f"Circle: center({center_x},{center_y}), radius={radius}"
+
+    elif shape_type == "ellipse":
+        center_x = int(shape.get("center_x", 50))
+        center_y = int(shape.get("center_y", 50))
+        width_axis = int(shape.get("width", 50))
+        height_axis = int(shape.get("height", 30))
+        angle = float(shape.get("angle", 0))
+        start_angle = float(shape.get("start_angle", 0))
+        end_angle = float(shape.get("end_angle", 360))
+
+        # Validate parameters
+        center_x = max(0, min(center_x, width - 1))
+        center_y = max(0, min(center_y, height - 1))
+        width_axis = max(1, width_axis)
+        height_axis = max(1, height_axis)
+
+        cv2.ellipse(result_image, (center_x, center_y), (width_axis, height_axis), 
+                   angle, start_angle, end_angle, bgr_color, line_thickness)
+        return f"Ellipse: center({center_x},{center_y}), axes({width_axis},{height_axis})"
+
+    elif shape_type == "line":
+        x1 = int(shape.get("x1", 0))
+        y1 = int(shape.get("y1", 0))
+        x2 = int(shape.get("x2", 100))
+        y2 = int(shape.get("y2", 100))
+
+        # Validate coordinates
+        x1 = max(0, min(x1, width - 1))
+        y1 = max(0, min(y1, height - 1))
+        x2 = max(0, min(x2, width - 1))
+        y2 = max(0, min(y2, height - 1))
+
+        cv2.line(result_image, (x1, y1), (x2, y2), bgr_color, thickness)
+        return f"Line: ({x1},{y1}) to ({x2},{y2})"
+
+    elif shape_type == "polygon":
+        polygon_type = shape.get("polygon_type", "pentagon")
+        center_x = int(shape.get("center_x", 150))
+        center_y = int(shape.get("center_y", 150))
+        size = int(shape.get("size", 80))
+
+        # Validate center coordinates
+        center_x = max(size, min(center_x, width - size))
+        center_y = max(size, min(center_y, height - size))
+
+        try:
+            # Generate predefined polygon points based on type
+            if polygon_type == "triangle":
+                # Equilateral triangle
+                points = [
+                    [center_x, center_y - size],              # Top
+                    [center_x - int(size * 0.866), center_y + size//2],  # Bottom left
+                    [center_x + int(size * 0.866), center_y + size//2]   # Bottom right
+                ]
+            else:
+                # Default to pentagon
+                points = []
+                for i in range(5):
+                    angle = i * 2 * 3.14159 / 5 - 3.14159/2
+                    x = int(center_x + size * np.cos(angle))
+                    y = int(center_y + size * np.sin(angle))
+                    points.append([x, y])
+
+            # Ensure all points are within image bounds
+            valid_points = []
+            for point in points:
+                x = max(0, min(point[0], width - 1))
+                y = max(0, min(point[1], height - 1))
+                valid_points.append([x, y])
+
+            # Let's define the points using numpy array
+            pts_original = np.array(valid_points, np.int32)
+
+            if filled:
+                cv2.fillPoly(result_image, [pts_original], bgr_color)
+                return f"Filled {polygon_type.title()}: center({center_x},{center_y})"
+            else:
+                # Let's now reshape our points in form required by polylines
+                pts_reshaped = pts_original.reshape((-1, 1, 2))
+                cv2.polylines(result_image, [pts_reshaped], True, bgr_color, thickness)
+                return f"{polygon_type.title()} Outline: center({center_x},{center_y})"
+
+        except (ValueError, TypeError) as poly_error:
+            logger.error(f"Polygon processing error: {poly_error}")
+            return None
+
+    elif shape_type == "arrow":
+        x1 = int(shape.get("x1", 0))
+        y1 = int(shape.get("y1", 0))
+        x2 = int(shape.get("x2", 100))
+        y2 = int(shape.get("y2", 100))
+        tip_length = float(shape.get("tip_length", 0.1))
+
+        # Validate coordinates
+        x1 = max(0, min(x1, width - 1))
+        y1 = max(0, min(y1, height - 1))
+        x2 = max(0, min(x2, width - 1))
+        y2 = max(0, min(y2, height - 1))
+
+        # Validate tip_length
+        tip_length = max(0.05, min(tip_length, 0.5))
+
+        cv2.arrowedLine(result_image, (x1, y1), (x2, y2), bgr_color, thickness, tipLength=tip_length)
+        return f"Arrow: ({x1},{y1}) to ({x2},{y2})"
+
+    else:
+        logger.debug(f"Unknown shape type: {shape_type}")
+        return None
+
+
+def shape_fields(shapes: list, defaults: dict) -> dict:
+    """Numeric shape fields as int64 columns, converted with int() like ``draw_shape`` does.
+
+    Raises ValueError, TypeError or OverflowError when a value does not
+    convert (such as the string "12.7"), so the caller can fall back to
+    drawing the shapes one by one with per-shape error handling.
+    """
+    keys, fallbacks = list(defaults), list(defaults.values())
+    values = np.array(
+        [[int(value) for value in map(shape.get, keys, fallbacks)] for shape in shapes], dtype=np.int64
+    ).reshape(len(shapes), len(keys))
+    return dict(zip(defaults, values.T))
+
+
+def clamped_points(fields: dict, width: int, height: int, *names: str) -> list:
+    """(x, y) columns for each named point, clamped to the image"""
+    return [
+        (np.clip(fields[f"x{name}"], 0, width - 1), np.clip(fields[f"y{name}"], 0, height - 1))
+        for name in names
+    ]
+
+
+def draw_rectangles(result_image: np.ndarray, shapes: list, bgr_color: tuple, thickness: int, filled: bool) -> list:
+    height, width = result_image.shape[:2]
+    fields = shape_fields(shapes, {"x1": 0, "y1": 0, "x2": 100, "y2": 100})
+    (x1, y1), (x2, y2) = clamped_points(fields, width, height, "1", "2")
+
+    # Skip degenerate rectangles (just a line or a point)
+    valid = (x1 != x2) & (y1 != y2)
+    if (~valid).any():
+        logger.debug(f"Skipping {int((~valid).sum())} rectangles with zero width or height")
+    x1, y1, x2, y2 = x1[valid], y1[valid], x2[valid], y2[valid]
+
+    if filled:
+        # cv2.rectangle fills the inclusive box between its corners
+        left, right = np.minimum(x1, x2), np.maximum(x1, x2) + 1
+        top, bottom = np.minimum(y1, y2), np.maximum(y1, y2) + 1
+        for box in zip(top.tolist(), bottom.tolist(), left.tolist(), right.tolist()):
+            result_image[box[0]:box[1], box[2]:box[3]] = bgr_color
+    else:
+        # cv2.rectangle outlines are closed 4-point polylines
+        contours = np.stack([np.stack([x1, y1], 1), np.stack([x2, y1], 1), np.stack([x2, y2], 1), np.stack([x1, y2], 1)], 1)
+        cv2.polylines(result_image, list(contours.astype(np.int32)), True, bgr_color, thickness)
+
+    return [f"Rectangle: ({a},{b}) to ({c},{d})" for a, b, c, d in zip(x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist())]
+
+
+def draw_lines(result_image: np.ndarray, shapes: list, bgr_color: tuple, thickness: int, filled: bool) -> list:
+    height, width = result_image.shape[:2]
+    fields = shape_fields(shapes, {"x1": 0, "y1": 0, "x2": 100, "y2": 100})
+    (x1, y1), (x2, y2) = clamped_points(fields, width, height, "1", "2")
+
+    # A 2-point open polyline is drawn exactly like cv2.line
+    segments = np.stack([np.stack([x1, y1], 1), np.stack([x2, y2], 1)], 1).astype(np.int32)
+    cv2.polylines(result_image, list(segments), False, bgr_color, thickness)
+
+    return [f"Line: ({a},{b}) to ({c},{d})" for a, b, c, d in zip(x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist())]
+
+
+# Unit pentagon, starting from the top, as the per-shape renderer computes it
+PENTAGON_ANGLES = np.array([i * 2 * 3.14159 / 5 - 3.14159/2 for i in range(5)])
+
+
+def draw_polygons(result_image: np.ndarray, shapes: list, bgr_color: tuple, thickness: int, filled: bool) -> list:
+    height, width = result_image.shape[:2]
+    fields = shape_fields(shapes, {"center_x": 150, "center_y": 150, "size": 80})
+    size = fields["size"]
+    center_x = np.maximum(size, np.minimum(fields["center_x"], width - size))
+    center_y = np.maximum(size, np.minimum(fields["center_y"], height - size))
+    triangle = np.array([shape.get("polygon_type", "pentagon") == "triangle" for shape in shapes])
+
+    contours = []
+    for mask, count in ((triangle, 3), (~triangle, 5)):
+        if not mask.any():
+            continue
+        cx, cy, r = center_x[mask, None], center_y[mask, None], size[mask, None]
+        if count == 3:
+            # Equilateral triangle: top, bottom left, bottom right
+            offset = (r * 0.866).astype(np.int64)
+            xs = np.concatenate([cx, cx - offset, cx + offset], 1)
+            ys = np.concatenate([cy - r, cy + r // 2, cy + r // 2], 1)
+        else:
+            xs = (cx + r * np.cos(PENTAGON_ANGLES)).astype(np.int64)
+            ys = (cy + r * np.sin(PENTAGON_ANGLES)).astype(np.int64)
+        points = np.stack([np.clip(xs, 0, width - 1), np.clip(ys, 0, height - 1)], -1).astype(np.int32)
+        contours.extend(zip(np.flatnonzero(mask).tolist(), points))
+    contours = [points for _, points in sorted(contours, key=lambda item: item[0])]
+
+    if filled:
+        # fillPoly fills several polygons with an even-odd rule, which would punch
+        # holes where markers overlap, so each polygon gets its own (cheap) call
+        for points in contours:
+            cv2.fillPoly(result_image, [points], bgr_color)
+    else:
+        cv2.polylines(result_image, contours, True, bgr_color, thickness)
+
+    return [
+        f"{'Filled ' if filled else ''}{shape.get('polygon_type', 'pentagon').title()}"
+        f"{'' if filled else ' Outline'}: center({x},{y})"
+        for shape, x, y in zip(shapes, center_x.tolist(), center_y.tolist())
+    ]
+
+
+# Shape types drawn a run at a time, with one OpenCV call per run where possible
+BULK_SHAPE_RENDERERS = {
+    "rectangle": draw_rectangles,
+    "line": draw_lines,
+    "polygon": draw_polygons
+}
+
+
+@operation("draw-shapes")
+def op_draw_shapes(image: np.ndarray, shapes: Optional[list] = None):
+    """Draw user-defined shapes on image.
+
+    Consecutive shapes sharing a type, colour, thickness and fill are drawn
+    as one run, keeping the paint order. Rectangles, lines and polygons are
+    validated with NumPy, and their outlines drawn with a single polylines
+    call per run; other shapes are drawn one by one. Per-shape details are
+    logged at DEBUG only.
+    """
+    shapes_list = shapes or []
+
+    # Create a copy to draw on
+    result_image = as_bgr(image).copy()
+
+    drawn_shapes = draw_shapes_into(result_image, shapes_list)
+    logger.info(f"Successfully drew {len(drawn_shapes)} shapes")
+
+    return result_image, {
+        "shapes_drawn": drawn_shapes,
+        "total_shapes": len(drawn_shapes),
+        "operation": "draw_custom_shapes"
+    }
+
+def draw_shapes_into(result_image: np.ndarray, shapes_list: list) -> list:
+    """Draw shapes in place and return the descriptions of those drawn.
+
+    On a 4-channel (BGRA annotation) image, shapes are painted opaque.
+    """
+    drawn_shapes = []
+    skipped = 0
+
+    # Runs are cut on the raw style fields, so each run is validated once
+    for _, run in itertools.groupby(shapes_list, key=lambda shape: list(map(shape.get, SHAPE_STYLE_FIELDS))):
+        run = list(run)
+        style = shape_style(run[0])
+        style = (style[0], opaque_color(result_image, style[1]), *style[2:])
+        shape_type = style[0]
+
+        bulk = BULK_SHAPE_RENDERERS.get(shape_type)
+        if bulk is not None and len(run) > 1:
+            try:
+                drawn = bulk(result_image, run, *style[1:])
+                drawn_shapes.extend(drawn)
+                skipped += len(run) - len(drawn)
+                continue
+            except (ValueError, TypeError, AttributeError, OverflowError) as bulk_error:
+                logger.debug(f"Drawing {len(run)} {shape_type} shapes one by one: {bulk_error}")
+
+        for shape in run:
+            logger.debug(f"Processing shape: {shape}")
+            try:
+                description = draw_shape(result_image, shape, *style)
+            except Exception as shape_error:
+                logger.debug(f"Error drawing {shape_type}: {shape_error}, shape data: {shape}")
+                description = None
+
+            if description is None:
+                skipped += 1
+            else:
+                drawn_shapes.append(description)
+
+    if skipped:
+        logger.warning(f"Skipped {skipped} invalid or unknown shapes")
+    return drawn_shapes
+
 @app.post("/api/draw-shapes")
 async def draw_shapes(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     shapes: str = Form(default="[]")
 ):
     """Draw user-defined shapes on image"""
     try:
-        import json
-        image = decode_base64_image(image_data)
-        height, width = image.shape[:2]
-        
-        # Create a copy to draw on
-        result_image = image.copy()
-        
         # Parse shapes from JSON
         try:
             shapes_list = json.loads(shapes) if shapes else []
@@ -308,198 +2158,54 @@ async def draw_shapes(
         except json.JSONDecodeError as e:
             logger.error(f"JSON decode error: {e}")
             shapes_list = []
-        
-        drawn_shapes = []
-        
-        for i, shape in enumerate(shapes_list):
-            logger.info(f"Processing shape {i}: {shape}")
-            
-            shape_type = shape.get("type", "").lower()
-            color = shape.get("color", [255, 255, 255])
-            thickness = shape.get("thickness", 2)
-            filled = shape.get("filled", False)
-            
-            # Validate color format
-            if not isinstance(color, list) or len(color) < 3:
-                logger.warning(f"Invalid color format: {color}, using default")
-                color = [255, 255, 255]
-            
-            # Validate thickness
-            try:
-                thickness = int(thickness)
-                if thickness < 1:
-                    thickness = 1
-            except (ValueError, TypeError):
-                logger.warning(f"Invalid thickness: {thickness}, using default")
-                thickness = 2
-            
-            # Convert RGB to BGR for OpenCV
-            bgr_color = (int(color[2]), int(color[1]), int(color[0]))
-            line_thickness = -1 if filled else thickness
-            
-            try:
-                if shape_type == "rectangle":
-                    # Get and validate coordinates
-                    x1 = int(shape.get("x1", 0))
-                    y1 = int(shape.get("y1", 0))  
-                    x2 = int(shape.get("x2", 100))
-                    y2 = int(shape.get("y2", 100))
-                    
-                    # Ensure coordinates are within image bounds
-                    x1 = max(0, min(x1, width - 1))
-                    y1 = max(0, min(y1, height - 1))
-                    x2 = max(0, min(x2, width - 1))
-                    y2 = max(0, min(y2, height - 1))
-                    
-                    # Ensure we have a valid rectangle (not just a line)
-                    if abs(x2 - x1) > 0 and abs(y2 - y1) > 0:
-                        cv2.rectangle(result_image, (x1, y1), (x2, y2), bgr_color, line_thickness)
-                        drawn_shapes.append(f"Rectangle: ({x1},{y1}) to ({x2},{y2})")
-                    else:
-                        logger.warning(f"Invalid rectangle dimensions: ({x1},{y1}) to ({x2},{y2})")
-                        
-                elif shape_type == "circle":
-                    center_x = int(shape.get("center_x", 50))
-                    center_y = int(shape.get("center_y", 50))
-                    radius = int(shape.get("radius", 25))
-                    
-                    # Validate parameters
-                    center_x = max(0, min(center_x, width - 1))
-                    center_y = max(0, min(center_y, height - 1))
-                    radius = max(1, min(radius, min(width, height) // 2))
-                    
-                    cv2.circle(result_image, (center_x, center_y), radius, bgr_color, line_thickness)
-                    drawn_shapes.append(f"Circle: center({center_x},{center_y}), radius={radius}")
-                    
-                elif shape_type == "ellipse":
-                    center_x = int(shape.get("center_x", 50))
-                    center_y = int(shape.get("center_y", 50))
-                    width_axis = int(shape.get("width", 50))
-                    height_axis = int(shape.get("height", 30))
-                    angle = float(shape.get("angle", 0))
-                    start_angle = float(shape.get("start_angle", 0))
-                    end_angle = float(shape.get("end_angle", 360))
-                    
-                    # Validate parameters
-                    center_x = max(0, min(center_x, width - 1))
-                    center_y = max(0, min(center_y, height - 1))
-                    width_axis = max(1, width_axis)
-                    height_axis = max(1, height_axis)
-                    
-                    cv2.ellipse(result_image, (center_x, center_y), (width_axis, height_axis), 
-                               angle, start_angle, end_angle, bgr_color, line_thickness)
-                    drawn_shapes.append(f"Ellipse: center({center_x},{center_y}), axes({width_axis},{height_axis})")
-                    
-                elif shape_type == "line":
-                    x1 = int(shape.get("x1", 0))
-                    y1 = int(shape.get("y1", 0))
-                    x2 = int(shape.get("x2", 100))
-                    y2 = int(shape.get("y2", 100))
-                    
-                    # Validate coordinates
-                    x1 = max(0, min(x1, width - 1))
-                    y1 = max(0, min(y1, height - 1))
-                    x2 = max(0, min(x2, width - 1))
-                    y2 = max(0, min(y2, height - 1))
-                    
-                    cv2.line(result_image, (x1, y1), (x2, y2), bgr_color, thickness)
-                    drawn_shapes.append(f"Line: ({x1},{y1}) to ({x2},{y2})")
-                    
-                elif shape_type == "polygon":
-                    polygon_type = shape.get("polygon_type", "pentagon")
-                    center_x = int(shape.get("center_x", 150))
-                    center_y = int(shape.get("center_y", 150))
-                    size = int(shape.get("size", 80))
-                    
-                    # Validate center coordinates
-                    center_x = max(size, min(center_x, width - size))
-                    center_y = max(size, min(center_y, height - size))
-                    
-                    try:
-                        # Generate predefined polygon points based on type
-                        if polygon_type == "triangle":
-                            # Equilateral triangle
-                            points = [
-                                [center_x, center_y - size],              # Top
-                                [center_x - int(size * 0.866), center_y + size//2],  # Bottom left
-                                [center_x + int(size * 0.866), center_y + size//2]   # Bottom right
-                            ]
-                        else:
-                            # Default to pentagon
-                            points = []
-                            for i in range(5):
-                                angle = i * 2 * 3.14159 / 5 - 3.14159/2
-                                x = int(center_x + size * np.cos(angle))
-                                y = int(center_y + size * np.sin(angle))
-                                points.append([x, y])
-                        
-                        # Ensure all points are within image bounds
-                        valid_points = []
-                        for point in points:
-                            x = max(0, min(point[0], width - 1))
-                            y = max(0, min(point[1], height - 1))
-                            valid_points.append([x, y])
-                        
-                        # Let's define the points using numpy array
-                        pts_original = np.array(valid_points, np.int32)
-                        
-                        if filled:
-                            cv2.fillPoly(result_image, [pts_original], bgr_color)
-                            drawn_shapes.append(f"Filled {polygon_type.title()}: center({center_x},{center_y})")
-                        else:
-                            # Let's now reshape our points in form required by polylines
-                            pts_reshaped = pts_original.reshape((-1, 1, 2))
-                            cv2.polylines(result_image, [pts_reshaped], True, bgr_color, thickness)
-                            drawn_shapes.append(f"{polygon_type.title()} Outline: center({center_x},{center_y})")
-                            
-                    except (ValueError, TypeError) as poly_error:
-                        logger.error(f"Polygon processing error: {poly_error}")
-                        continue
-                        
-                elif shape_type == "arrow":
-                    x1 = int(shape.get("x1", 0))
-                    y1 = int(shape.get("y1", 0))
-                    x2 = int(shape.get("x2", 100))
-                    y2 = int(shape.get("y2", 100))
-                    tip_length = float(shape.get("tip_length", 0.1))
-                    
-                    # Validate coordinates
-                    x1 = max(0, min(x1, width - 1))
-                    y1 = max(0, min(y1, height - 1))
-                    x2 = max(0, min(x2, width - 1))
-                    y2 = max(0, min(y2, height - 1))
-                    
-                    # Validate tip_length
-                    tip_length = max(0.05, min(tip_length, 0.5))
-                    
-                    cv2.arrowedLine(result_image, (x1, y1), (x2, y2), bgr_color, thickness, tipLength=tip_length)
-                    drawn_shapes.append(f"Arrow: ({x1},{y1}) to ({x2},{y2})")
-                    
-                else:
-                    logger.warning(f"Unknown shape type: {shape_type}")
-                    continue
-                    
-            except Exception as shape_error:
-                logger.error(f"Error drawing {shape_type}: {shape_error}")
-                logger.error(f"Shape data: {shape}")
-                continue
-        
-        logger.info(f"Successfully drew {len(drawn_shapes)} shapes")
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "shapes_drawn": drawn_shapes,
-            "total_shapes": len(drawn_shapes),
-            "operation": "draw_custom_shapes"
-        }
-        
+
+        return await output.run_operation("draw-shapes", image, shapes=shapes_list)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in draw_shapes: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Drawing error: {str(e)}")
 
+def draw_freehand_into(result_image: np.ndarray, points_list: list, bgr_color: tuple, thickness: int, closed: bool):
+    """Draw a freehand stroke in place"""
+    bgr_color = opaque_color(result_image, bgr_color)
+
+    # Convert points to numpy array
+    pts = np.array([[int(p["x"]), int(p["y"])] for p in points_list], np.int32)
+
+    # One call for the whole stroke; open polylines rasterise exactly like a line per segment
+    cv2.polylines(result_image, [pts], closed, bgr_color, thickness)
+
+@operation("draw-freehand")
+def op_draw_freehand(
+    image: np.ndarray,
+    points: Optional[list] = None,  # list of {x, y} coordinates
+    color: Optional[list] = None,  # RGB color
+    thickness: int = 2,
+    closed: bool = False
+):
+    """Draw freehand lines/curves from array of points"""
+    points_list = points or []
+    color_rgb = color or [255, 255, 255]
+    bgr_color = (int(color_rgb[2]), int(color_rgb[1]), int(color_rgb[0]))
+
+    if len(points_list) < 2:
+        raise HTTPException(status_code=400, detail="Need at least 2 points to draw")
+
+    result_image = as_bgr(image).copy()
+    draw_freehand_into(result_image, points_list, bgr_color, thickness, closed)
+
+    return result_image, {
+        "points_count": len(points_list),
+        "closed": closed,
+        "operation": "draw_freehand"
+    }
+
 @app.post("/api/draw-freehand")
 async def draw_freehand(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     points: str = Form(...),  # JSON array of {x, y} coordinates
     color: str = Form(default="[255, 255, 255]"),  # RGB color as JSON
     thickness: int = Form(default=2),
@@ -507,268 +2213,923 @@ async def draw_freehand(
 ):
     """Draw freehand lines/curves from array of points"""
     try:
-        import json
-        image = decode_base64_image(image_data)
-        result_image = image.copy()
-        
-        # Parse points and color
-        points_list = json.loads(points)
-        color_rgb = json.loads(color)
-        bgr_color = (int(color_rgb[2]), int(color_rgb[1]), int(color_rgb[0]))
-        
-        if len(points_list) < 2:
-            raise HTTPException(status_code=400, detail="Need at least 2 points to draw")
-        
-        # Convert points to numpy array
-        pts = np.array([[int(p["x"]), int(p["y"])] for p in points_list], np.int32)
-        
-        if closed:
-            # Draw closed polygon
-            cv2.polylines(result_image, [pts], True, bgr_color, thickness)
+        return await output.run_operation("draw-freehand", image, points=json.loads(points), color=json.loads(color), thickness=thickness, closed=closed)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error drawing freehand: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@operation("draw-text-custom")
+def op_draw_text_custom(image: np.ndarray, text_elements: Optional[list] = None):
+    """Draw multiple custom text elements"""
+    texts = text_elements or []
+    result_image = as_bgr(image).copy()
+    drawn_texts = draw_texts_into(result_image, texts)
+
+    return result_image, {
+        "texts_drawn": drawn_texts,
+        "total_texts": len(drawn_texts),
+        "operation": "draw_custom_text"
+    }
+
+# Map font names to OpenCV constants
+TEXT_FONTS = {
+    "HERSHEY_SIMPLEX": cv2.FONT_HERSHEY_SIMPLEX,
+    "HERSHEY_PLAIN": cv2.FONT_HERSHEY_PLAIN,
+    "HERSHEY_DUPLEX": cv2.FONT_HERSHEY_DUPLEX,
+    "HERSHEY_COMPLEX": cv2.FONT_HERSHEY_COMPLEX,
+    "HERSHEY_TRIPLEX": cv2.FONT_HERSHEY_TRIPLEX,
+    "HERSHEY_COMPLEX_SMALL": cv2.FONT_HERSHEY_COMPLEX_SMALL,
+    "HERSHEY_SCRIPT_SIMPLEX": cv2.FONT_HERSHEY_SCRIPT_SIMPLEX,
+    "HERSHEY_SCRIPT_COMPLEX": cv2.FONT_HERSHEY_SCRIPT_COMPLEX
+}
+
+def validate_int_fields(fields: dict, *names: str):
+    """Raise ValueError if one of the named fields is present but is not an integer"""
+    for name in names:
+        if name in fields:
+            try:
+                int(fields[name])
+            except (TypeError, ValueError):
+                raise ValueError(f"{name} must be an integer, got {fields[name]!r}")
+
+def text_placement(text_elem: dict, width: int, height: int) -> tuple:
+    """(text, font, font_scale, thickness, (x, y) origin, (text_width, text_height), baseline) of a text element.
+
+    The element's own x and y are validated but not used: text is centred on
+    the image, and elements with a malformed x or y are skipped as before.
+    """
+    text = text_elem.get("text", "Sample Text")
+    validate_int_fields(text_elem, "x", "y")
+    font_scale = float(text_elem.get("font_scale", 1.0))
+    thickness = int(text_elem.get("thickness", 2))
+    font = TEXT_FONTS.get(text_elem.get("font", "HERSHEY_SIMPLEX"), cv2.FONT_HERSHEY_SIMPLEX)
+
+    (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    x = (width - text_width) // 2
+    y = (height + text_height) // 2
+    return text, font, font_scale, thickness, (x, y), (text_width, text_height), baseline
+
+def draw_texts_into(result_image: np.ndarray, texts: list) -> list:
+    """Draw text elements in place and return the descriptions of those drawn"""
+    drawn_texts = []
+
+    for text_elem in texts:
+        try:
+            color = text_elem.get("color", [255, 255, 255])
+            h, w = result_image.shape[:2]
+            text, font, font_scale, thickness, (x, y), _, _ = text_placement(text_elem, w, h)
+            bgr_color = (int(color[2]), int(color[1]), int(color[0])) if len(color) >= 3 else (255, 255, 255)
+
+            cv2.putText(result_image, text, (x, y), font, font_scale, opaque_color(result_image, bgr_color), thickness)
+            drawn_texts.append(f"Text: '{text}' at ({x},{y})")
+
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"Skipping invalid text element: {str(e)}")
+            continue
+
+    return drawn_texts
+
+@app.post("/api/draw-text-custom")
+async def draw_text_custom(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    text_elements: str = Form(default="[]")  # JSON array of text objects
+):
+    """Draw multiple custom text elements"""
+    try:
+        # Parse text elements
+        texts = json.loads(text_elements) if text_elements else []
+
+        return await output.run_operation("draw-text-custom", image, text_elements=texts)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error drawing custom text: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ANNOTATION LAYERS
+
+
+def clamp(value: int, low: int, high: int) -> int:
+    return max(low, min(value, high))
+
+
+def shape_bounds(shape: dict, width: int, height: int) -> Optional[tuple]:
+    """Inclusive (x0, y0, x1, y1) box a shape can paint, clamped like the renderers clamp it.
+
+    The box is padded by the line thickness, so it errs on the large side.
+    Returns None for shapes that draw nothing, and the whole image when the
+    geometry cannot be read.
+    """
+    shape_type, _, thickness, _ = shape_style(shape)
+    try:
+        reach = 0.0
+        if shape_type in ("rectangle", "line", "arrow"):
+            xs = [clamp(int(shape.get(key, default)), 0, width - 1) for key, default in (("x1", 0), ("x2", 100))]
+            ys = [clamp(int(shape.get(key, default)), 0, height - 1) for key, default in (("y1", 0), ("y2", 100))]
+            if shape_type == "arrow":
+                # The head is at most half the shaft long
+                reach = 0.5 * math.hypot(xs[1] - xs[0], ys[1] - ys[0])
+        elif shape_type in ("circle", "ellipse"):
+            xs = [clamp(int(shape.get("center_x", 50)), 0, width - 1)]
+            ys = [clamp(int(shape.get("center_y", 50)), 0, height - 1)]
+            if shape_type == "circle":
+                reach = max(1, min(int(shape.get("radius", 25)), min(width, height) // 2))
+            else:
+                reach = max(1, int(shape.get("width", 50)), int(shape.get("height", 30)))
+        elif shape_type == "polygon":
+            size = int(shape.get("size", 80))
+            xs = [max(size, min(int(shape.get("center_x", 150)), width - size))]
+            ys = [max(size, min(int(shape.get("center_y", 150)), height - size))]
+            reach = abs(size)
         else:
-            # Draw connected lines
-            for i in range(len(pts) - 1):
-                cv2.line(result_image, tuple(pts[i]), tuple(pts[i + 1]), bgr_color, thickness)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "points_count": len(points_list),
-            "closed": closed,
-            "operation": "draw_freehand"
+            return None
+    except (ValueError, TypeError):
+        return 0, 0, width - 1, height - 1
+
+    margin = reach + thickness + 2
+    return min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin
+
+
+def stroke_points(stroke: dict) -> np.ndarray:
+    """(n, 2) int32 points of a stroke; raises ValueError unless it has at least two integer {x, y} points"""
+    points = stroke.get("points")
+    if not isinstance(points, list) or len(points) < 2:
+        raise ValueError("Need at least 2 points to draw")
+    try:
+        return np.array([[int(p["x"]), int(p["y"])] for p in points], np.int32)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        raise ValueError("Stroke points must be {x, y} objects with integer coordinates")
+
+
+def stroke_style(stroke: dict) -> tuple:
+    """(bgr_color, thickness, closed) of a stroke; raises ValueError for a malformed colour or thickness"""
+    color = stroke.get("color") or [255, 255, 255]
+    try:
+        bgr_color = (int(color[2]), int(color[1]), int(color[0]))
+        thickness = int(stroke.get("thickness", 2))
+    except (IndexError, KeyError, TypeError, ValueError, OverflowError):
+        raise ValueError("Stroke color must be [r, g, b] and thickness an integer")
+    # cv2.polylines rejects thicknesses outside 1..32767
+    if not 1 <= thickness <= 32767:
+        raise ValueError("Stroke thickness must be between 1 and 32767")
+    return bgr_color, thickness, bool(stroke.get("closed", False))
+
+
+def validate_strokes(strokes: list):
+    """Raise ValueError for the first stroke that cannot be drawn"""
+    for stroke in strokes:
+        stroke_points(stroke)
+        stroke_style(stroke)
+
+
+def stroke_bounds(stroke: dict) -> Optional[tuple]:
+    try:
+        points = stroke_points(stroke)
+        _, thickness, _ = stroke_style(stroke)
+    except ValueError:
+        return None
+    margin = thickness + 2
+    (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    return x0 - margin, y0 - margin, x1 + margin, y1 + margin
+
+
+def text_bounds(text_elem: dict, width: int, height: int) -> Optional[tuple]:
+    try:
+        _, _, _, thickness, (x, y), (text_width, text_height), baseline = text_placement(text_elem, width, height)
+    except (KeyError, ValueError, TypeError):
+        return None
+    return x - thickness - 2, y - text_height - thickness - 2, x + text_width + thickness + 2, y + baseline + thickness + 2
+
+
+def union_bounds(boxes, width: int, height: int) -> Optional[tuple]:
+    """Smallest box covering ``boxes`` (None entries ignored), clipped to the image"""
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    x0, y0 = max(0, int(min(box[0] for box in boxes))), max(0, int(min(box[1] for box in boxes)))
+    x1, y1 = min(width - 1, int(math.ceil(max(box[2] for box in boxes)))), min(height - 1, int(math.ceil(max(box[3] for box in boxes))))
+    return (x0, y0, x1, y1) if x0 <= x1 and y0 <= y1 else None
+
+
+class AnnotationLayer:
+    """Annotations of a stored image, kept apart from the image itself.
+
+    Primitives (draw-shapes shapes, freehand strokes and text elements) are
+    recorded as submitted and rasterised into a BGRA overlay the size of the
+    image. The overlay starts out as untouched zero pages, so memory and
+    drawing cost follow the annotated area rather than the image size, and
+    each batch reports the dirty rectangle it painted. Compositing copies
+    opaque overlay pixels onto the image and blends antialiased edges; the
+    full frame is only composited on export.
+    """
+
+    def __init__(self, height: int, width: int):
+        self.overlay = np.zeros((height, width, 4), np.uint8)
+        self.primitives = []  # [{"kind": "shape" | "stroke" | "text", ...primitive fields}]
+        self.bounds = None  # box covering everything drawn so far
+        self.lock = threading.Lock()
+
+    def add(self, shapes: list, strokes: list, texts: list):
+        """Rasterise a batch of primitives; returns (dirty box or None, descriptions of what was drawn)"""
+        height, width = self.overlay.shape[:2]
+        dirty = union_bounds(
+            [shape_bounds(shape, width, height) for shape in shapes]
+            + [stroke_bounds(stroke) for stroke in strokes]
+            + [text_bounds(text_elem, width, height) for text_elem in texts],
+            width, height
+        )
+
+        with self.lock:
+            drawn = draw_shapes_into(self.overlay, shapes)
+            for stroke in strokes:
+                draw_freehand_into(self.overlay, stroke["points"], *stroke_style(stroke))
+                drawn.append(f"Stroke: {len(stroke['points'])} points")
+            drawn.extend(self.draw_texts(texts))
+
+            self.primitives.extend(
+                [{"kind": "shape", **shape} for shape in shapes]
+                + [{"kind": "stroke", **stroke} for stroke in strokes]
+                + [{"kind": "text", **text_elem} for text_elem in texts]
+            )
+            if dirty is not None:
+                self.bounds = union_bounds([self.bounds, dirty], width, height)
+        return dirty, drawn
+
+    def draw_polyline(self, points: np.ndarray, bgr_color: tuple, thickness: int) -> Optional[tuple]:
+        """Rasterise an open (n, 2) int32 polyline with one cv2.polylines call; returns the dirty box"""
+        height, width = self.overlay.shape[:2]
+        margin = thickness + 2
+        (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+        dirty = union_bounds([(x0 - margin, y0 - margin, x1 + margin, y1 + margin)], width, height)
+
+        with self.lock:
+            cv2.polylines(self.overlay, [points], False, bgr_color + (255,), thickness)
+            if dirty is not None:
+                self.bounds = union_bounds([self.bounds, dirty], width, height)
+        return dirty
+
+    def record(self, kind: str, primitive: dict):
+        """Add an already rasterised primitive to the list"""
+        with self.lock:
+            self.primitives.append({"kind": kind, **primitive})
+
+    def draw_texts(self, texts: list) -> list:
+        """Blend text elements into the overlay as premultiplied colour.
+
+        Text may be antialiased, and OpenCV does not accumulate alpha when it
+        blends into a four-channel image, so each element is rendered as a
+        coverage mask over its own box and blended in here instead.
+        """
+        height, width = self.overlay.shape[:2]
+        drawn_texts = []
+
+        for text_elem in texts:
+            try:
+                color = text_elem.get("color", [255, 255, 255])
+                text, font, font_scale, thickness, (x, y), _, _ = text_placement(text_elem, width, height)
+                bgr_color = (int(color[2]), int(color[1]), int(color[0])) if len(color) >= 3 else (255, 255, 255)
+            except (KeyError, ValueError, TypeError) as e:
+                logger.warning(f"Skipping invalid text element: {str(e)}")
+                continue
+
+            drawn_texts.append(f"Text: '{text}' at ({x},{y})")
+            box = union_bounds([text_bounds(text_elem, width, height)], width, height)
+            if box is None:
+                continue
+            x0, y0, x1, y1 = box
+            coverage = np.zeros((y1 - y0 + 1, x1 - x0 + 1), np.uint8)
+            cv2.putText(coverage, text, (x - x0, y - y0), font, font_scale, 255, thickness)
+
+            region = self.overlay[y0:y1 + 1, x0:x1 + 1]
+            weight = coverage[..., None].astype(np.float32) / 255
+            blended = region * (1 - weight) + np.array(bgr_color + (255,), np.float32) * weight
+            np.copyto(region, np.rint(blended).astype(np.uint8), where=coverage[..., None] > 0)
+
+        return drawn_texts
+
+    def composite(self, image: np.ndarray, box: Optional[tuple] = None) -> np.ndarray:
+        """The image with the overlay painted on, for the whole frame or an inclusive (x0, y0, x1, y1) box"""
+        height, width = self.overlay.shape[:2]
+        x0, y0, x1, y1 = box or (0, 0, width - 1, height - 1)
+        result = as_bgr(image[y0:y1 + 1, x0:x1 + 1]).copy()
+
+        # Only the part of the box that has ever been drawn on needs the overlay
+        painted = union_bounds([self.bounds], width, height)
+        if painted is None:
+            return result
+        left, top = max(x0, painted[0]), max(y0, painted[1])
+        right, bottom = min(x1, painted[2]), min(y1, painted[3])
+        if left > right or top > bottom:
+            return result
+
+        overlay = self.overlay[top:bottom + 1, left:right + 1]
+        target = result[top - y0:bottom - y0 + 1, left - x0:right - x0 + 1]
+        alpha = overlay[..., 3:]
+        edges = (alpha > 0) & (alpha < 255)
+        if edges.any():
+            # Antialiased edges were drawn over transparent black, which leaves premultiplied colour
+            under = (target.astype(np.uint16) * (255 - alpha) + 127) // 255
+            np.copyto(target, np.minimum(overlay[..., :3] + under, 255).astype(np.uint8), where=edges)
+        np.copyto(target, overlay[..., :3], where=alpha == 255)
+        return result
+
+
+def annotation_layer(image_id: str) -> AnnotationLayer:
+    layer = image_store.annotations(image_id)
+    if layer is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id, please reload the image")
+    return layer
+
+
+def parse_annotation_list(name: str, value: str) -> list:
+    try:
+        items = json.loads(value) if value else []
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} JSON: {e}")
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise HTTPException(status_code=400, detail=f"{name} must be a list of objects")
+    return items
+
+
+@app.post("/api/annotations/{image_id}")
+async def add_annotations(
+    image_id: str,
+    output: ImageOutput = Depends(image_output),
+    shapes: str = Form(default="[]"),  # draw-shapes shapes
+    strokes: str = Form(default="[]"),  # [{points: [{x, y}], color, thickness, closed}]
+    texts: str = Form(default="[]")  # draw-text-custom text elements
+):
+    """Add annotations to a loaded image's overlay layer and return only the repainted region"""
+    output.reject_roi("/api/annotations/{image_id}")
+    layer = annotation_layer(image_id)
+    shapes_list = parse_annotation_list("shapes", shapes)
+    strokes_list = parse_annotation_list("strokes", strokes)
+    texts_list = parse_annotation_list("texts", texts)
+    try:
+        validate_strokes(strokes_list)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        dirty, drawn = await cpu_pool.run_local(layer.add, shapes_list, strokes_list, texts_list)
+
+        images = {}
+        metadata = {
+            "image_id": image_id,
+            "drawn": drawn,
+            "primitives": len(layer.primitives),
+            "dirty": None,
+            "operation": "annotate"
         }
+        image = image_store.get(image_id)
+        if dirty is not None and image is not None:
+            x0, y0, x1, y1 = dirty
+            # The patch is the composited image under the dirty rectangle, to paste at (x, y)
+            images["patch"] = await cpu_pool.run_local(layer.composite, image, dirty)
+            metadata["dirty"] = {"x": x0, "y": y0, "width": x1 - x0 + 1, "height": y1 - y0 + 1}
+        return await output.respond(images, metadata)
     except Exception as e:
-        logger.error(f"Error drawing freehand: {str(e)}")
+        logger.error(f"Error adding annotations: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/draw-text-custom")
-async def draw_text_custom(
-    image_data: str = Form(...),
-    text_elements: str = Form(default="[]")  # JSON array of text objects
+@app.get("/api/annotations/{image_id}")
+async def list_annotations(image_id: str):
+    """Recorded annotation primitives of a loaded image"""
+    layer = annotation_layer(image_id)
+    bounds = layer.bounds
+    return {
+        "image_id": image_id,
+        "primitives": layer.primitives,
+        "bounds": None if bounds is None else {"x": bounds[0], "y": bounds[1], "width": bounds[2] - bounds[0] + 1, "height": bounds[3] - bounds[1] + 1}
+    }
+
+@app.delete("/api/annotations/{image_id}")
+async def clear_annotations(image_id: str):
+    """Drop a loaded image's annotation layer"""
+    annotation_layer(image_id)
+    image_store.clear_annotations(image_id)
+    return {"image_id": image_id, "status": "cleared"}
+
+@app.post("/api/annotations/{image_id}/export")
+async def export_annotations(
+    image_id: str,
+    output: ImageOutput = Depends(image_output),
+    layer_only: bool = Form(False)  # the BGRA overlay alone instead of the composited image
 ):
-    """Draw multiple custom text elements"""
+    """Composite a loaded image with its annotation layer"""
+    output.reject_roi("/api/annotations/{image_id}/export")
+    layer = annotation_layer(image_id)
+    image = image_store.get(image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id, please reload the image")
+
     try:
-        import json
-        image = decode_base64_image(image_data)
-        result_image = image.copy()
-        
-        # Parse text elements
-        texts = json.loads(text_elements) if text_elements else []
-        drawn_texts = []
-        
-        for text_elem in texts:
-            try:
-                text = text_elem.get("text", "Sample Text")
-                x, y = int(text_elem.get("x", 50)), int(text_elem.get("y", 50))
-                font_scale = float(text_elem.get("font_scale", 1.0))
-                color = text_elem.get("color", [255, 255, 255])
-                thickness = int(text_elem.get("thickness", 2))
-                font_name = text_elem.get("font", "HERSHEY_SIMPLEX")
-                
-                # Map font names to OpenCV constants
-                font_map = {
-                    "HERSHEY_SIMPLEX": cv2.FONT_HERSHEY_SIMPLEX,
-                    "HERSHEY_PLAIN": cv2.FONT_HERSHEY_PLAIN,
-                    "HERSHEY_DUPLEX": cv2.FONT_HERSHEY_DUPLEX,
-                    "HERSHEY_COMPLEX": cv2.FONT_HERSHEY_COMPLEX,
-                    "HERSHEY_TRIPLEX": cv2.FONT_HERSHEY_TRIPLEX,
-                    "HERSHEY_COMPLEX_SMALL": cv2.FONT_HERSHEY_COMPLEX_SMALL,
-                    "HERSHEY_SCRIPT_SIMPLEX": cv2.FONT_HERSHEY_SCRIPT_SIMPLEX,
-                    "HERSHEY_SCRIPT_COMPLEX": cv2.FONT_HERSHEY_SCRIPT_COMPLEX
-                }
-                
-                font = font_map.get(font_name, cv2.FONT_HERSHEY_SIMPLEX)
-                bgr_color = (int(color[2]), int(color[1]), int(color[0])) if len(color) >= 3 else (255, 255, 255)
-                
-                h, w = result_image.shape[:2]
-                (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
-                x = (w - text_width) // 2
-                y = (h + text_height) // 2
-                
-                cv2.putText(result_image, text, (x, y), font, font_scale, bgr_color, thickness)
-                drawn_texts.append(f"Text: '{text}' at ({x},{y})")
-                
-            except (KeyError, ValueError, TypeError) as e:
-                logger.warning(f"Skipping invalid text element: {str(e)}")
-                continue
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "texts_drawn": drawn_texts,
-            "total_texts": len(drawn_texts),
-            "operation": "draw_custom_text"
-        }
+        metadata = {"image_id": image_id, "primitives": len(layer.primitives), "operation": "annotation_export"}
+        if layer_only:
+            return await output.respond({"annotation_layer": layer.overlay}, metadata)
+        result_image = await cpu_pool.run_local(layer.composite, image)
+        return await output.respond({"processed_image": result_image}, metadata)
     except Exception as e:
-        logger.error(f"Error drawing custom text: {str(e)}")
+        logger.error(f"Error exporting annotations: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def stream_patch(layer: AnnotationLayer, image_id: str, points: np.ndarray, bgr_color: tuple, thickness: int):
+    """Draw one streamed batch and encode the composited dirty region: (dirty box, encoded patch) or None"""
+    dirty = layer.draw_polyline(points, bgr_color, thickness)
+    image = image_store.get(image_id)
+    if dirty is None or image is None:
+        return None
+    return dirty, encode_image(layer.composite(image, dirty))
+
+
+async def receive_stroke_messages(websocket: WebSocket, messages: asyncio.Queue):
+    """Forward client messages to the queue, then None once the client disconnects"""
+    try:
+        while True:
+            await messages.put(await websocket.receive_json())
+    except (WebSocketDisconnect, ValueError):
+        # Malformed JSON ends the stream like a disconnect
+        pass
+    finally:
+        await messages.put(None)
+
+
+@app.websocket("/api/annotations/{image_id}/stream")
+async def stream_annotations(websocket: WebSocket, image_id: str):
+    """Stream freehand strokes into a loaded image's annotation layer.
+
+    Client messages are JSON: {"type": "begin", "color": [r, g, b], "thickness": 2},
+    {"type": "points", "points": [x0, y0, x1, y1, ...]} and {"type": "end"}. Point
+    batches that queue up while one is being drawn are merged, and each merged
+    batch is rasterised with one cv2.polylines call. Every batch is answered with
+    a JSON {"type": "patch", "dirty": {x, y, width, height}} message followed by a
+    binary message holding the encoded composited region. An ended stroke is
+    recorded as a stroke primitive, as if posted to /api/annotations/{image_id}.
+    """
+    await websocket.accept()
+    layer = image_store.annotations(image_id)
+    if layer is None:
+        await websocket.close(code=1008, reason="Unknown or expired image_id, please reload the image")
+        return
+
+    messages = asyncio.Queue()
+    reader = asyncio.create_task(receive_stroke_messages(websocket, messages))
+    stroke = None  # {"color": [r, g, b], "thickness": int, "points": [[x, y], ...]} of the stroke being drawn
+
+    def finish_stroke():
+        if stroke is not None and len(stroke["points"]) >= 2:
+            layer.record("stroke", {
+                "points": [{"x": x, "y": y} for x, y in stroke["points"]],
+                "color": stroke["color"],
+                "thickness": stroke["thickness"],
+                "closed": False
+            })
+
+    pending = []  # a message taken off the queue while merging point batches
+    try:
+        while True:
+            message = pending.pop() if pending else await messages.get()
+            if message is None:
+                break
+            try:
+                kind = message.get("type")
+                if kind == "begin":
+                    finish_stroke()
+                    color = message.get("color") or [255, 255, 255]
+                    stroke = {"color": [int(c) for c in color[:3]], "thickness": max(1, int(message.get("thickness", 2))), "points": []}
+                elif kind == "end":
+                    finish_stroke()
+                    stroke = None
+                    await websocket.send_json({"type": "committed", "primitives": len(layer.primitives)})
+                elif kind == "points":
+                    if stroke is None:
+                        stroke = {"color": [255, 255, 255], "thickness": 2, "points": []}
+                    batch = list(message.get("points") or [])
+                    # Merge the point batches already waiting behind this one
+                    while not messages.empty():
+                        following = messages.get_nowait()
+                        if not isinstance(following, dict) or following.get("type") != "points":
+                            pending.append(following)
+                            break
+                        batch.extend(following.get("points") or [])
+
+                    new_points = np.asarray(batch, np.int32).reshape(-1, 2)
+                    # Connect to the last point already drawn
+                    points = np.concatenate([np.asarray(stroke["points"][-1:], np.int32).reshape(-1, 2), new_points])
+                    stroke["points"].extend(new_points.tolist())
+                    if len(points) >= 2:
+                        red, green, blue = stroke["color"]
+                        patch = await cpu_pool.run_local(stream_patch, layer, image_id, points, (blue, green, red), stroke["thickness"])
+                        if patch is not None:
+                            (x0, y0, x1, y1), encoded = patch
+                            await websocket.send_json({
+                                "type": "patch",
+                                "dirty": {"x": x0, "y": y0, "width": x1 - x0 + 1, "height": y1 - y0 + 1},
+                                "points": len(stroke["points"]),
+                                "encoding": DEFAULT_OUTPUT_POLICY.output_format
+                            })
+                            await websocket.send_bytes(encoded)
+                else:
+                    await websocket.send_json({"type": "error", "detail": f"Unknown message type: {kind}"})
+            except (AttributeError, ValueError, TypeError) as e:
+                await websocket.send_json({"type": "error", "detail": f"Invalid message: {str(e)}"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Error streaming annotations: {str(e)}")
+        await websocket.close(code=1011)
+    finally:
+        finish_stroke()
+        reader.cancel()
+
 
 # TRANSFORMATIONS
 
+# Interpolations by increasing quality, with the source pixels each one reads
+# on either side of a sample point
+INTERPOLATION_REACH = {cv2.INTER_NEAREST: 1, cv2.INTER_LINEAR: 1, cv2.INTER_CUBIC: 2, cv2.INTER_LANCZOS4: 4}
+
 
+def translation(tx: float, ty: float) -> np.ndarray:
+    return np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]], np.float64)
+
+
+def translate_geometry(size: tuple, tx: int = 50, ty: int = 50) -> tuple:
+    return translation(tx, ty), size, cv2.INTER_LINEAR, {
+        "translation_x": tx,
+        "translation_y": ty,
+        "operation": "translation"
+    }
+
+
+@operation("translate", geometry=lambda args, size: translate_geometry(size, **args))
+def op_translate(image: np.ndarray, tx: int = 50, ty: int = 50):
+    """Translate (move) image"""
+    height, width = image.shape[:2]
+    M, size, _, info = translate_geometry((width, height), tx, ty)
+
+    # Apply translation
+    translated_image = cv2.warpAffine(image, M[:2], size)
+
+    return translated_image, info
 @app.post("/api/translate")
 async def translate_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     tx: int = Form(50),
     ty: int = Form(50)
 ):
     """Translate (move) image"""
     try:
-        image = decode_base64_image(image_data)
-        height, width = image.shape[:2]
-        
-        # Create translation matrix
-        M = np.float32([[1, 0, tx], [0, 1, ty]])
-        
-        # Apply translation
-        translated_image = cv2.warpAffine(image, M, (width, height))
-        
-        return {
-            "processed_image": encode_image_to_base64(translated_image),
-            "translation_x": tx,
-            "translation_y": ty,
-            "operation": "translation"
-        }
+        return await output.run_operation("translate", image, tx=tx, ty=ty)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in translation: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def rotate_geometry(size: tuple, angle: float = 45.0, scale: float = 1.0) -> tuple:
+    width, height = size
+    center = (width // 2, height // 2)
+    M = np.vstack([cv2.getRotationMatrix2D(center, angle, scale), [0, 0, 1]])
+    return M, size, cv2.INTER_LINEAR, {
+        "angle": angle,
+        "scale": scale,
+        "operation": "rotation"
+    }
+
+
+@operation("rotate", geometry=lambda args, size: rotate_geometry(size, **args))
+def op_rotate(image: np.ndarray, angle: float = 45.0, scale: float = 1.0):
+    """Rotate image using getRotationMatrix2D"""
+    height, width = image.shape[:2]
+
+    # Get rotation matrix
+    M, size, _, info = rotate_geometry((width, height), angle, scale)
+
+    # Apply rotation
+    rotated_image = cv2.warpAffine(image, M[:2], size)
+
+    return rotated_image, info
 @app.post("/api/rotate")
 async def rotate_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     angle: float = Form(45.0),
     scale: float = Form(1.0)
 ):
     """Rotate image using getRotationMatrix2D"""
     try:
-        image = decode_base64_image(image_data)
-        height, width = image.shape[:2]
-        
-        # Get rotation matrix
-        center = (width // 2, height // 2)
-        M = cv2.getRotationMatrix2D(center, angle, scale)
-        
-        # Apply rotation
-        rotated_image = cv2.warpAffine(image, M, (width, height))
-        
-        return {
-            "processed_image": encode_image_to_base64(rotated_image),
-            "angle": angle,
-            "scale": scale,
-            "operation": "rotation"
-        }
+        return await output.run_operation("rotate", image, angle=angle, scale=scale)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in rotation: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def flip_geometry(size: tuple, flip_code: int = 1) -> tuple:
+    width, height = size
+    # Same convention as cv2.flip: > 0 mirrors columns, 0 rows, < 0 both
+    mirror_x, mirror_y = flip_code != 0, flip_code <= 0
+    M = np.array([
+        [-1 if mirror_x else 1, 0, width - 1 if mirror_x else 0],
+        [0, -1 if mirror_y else 1, height - 1 if mirror_y else 0],
+        [0, 0, 1]
+    ], np.float64)
+
+    flip_type = {0: "vertical", 1: "horizontal", -1: "both"}
+
+    return M, size, cv2.INTER_NEAREST, {
+        "flip_type": flip_type.get(flip_code, "unknown"),
+        "operation": "flip"
+    }
+
+
+@operation("flip", geometry=lambda args, size: flip_geometry(size, **args))
+def op_flip(image: np.ndarray, flip_code: int = 1):  # 0=vertical, 1=horizontal, -1=both
+    """Flip image"""
+    flipped_image = cv2.flip(image, flip_code)
+
+    return flipped_image, flip_geometry((image.shape[1], image.shape[0]), flip_code)[3]
 @app.post("/api/flip")
 async def flip_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     flip_code: int = Form(1)  # 0=vertical, 1=horizontal, -1=both
 ):
     """Flip image"""
     try:
-        image = decode_base64_image(image_data)
-        
-        # Apply flip
-        flipped_image = cv2.flip(image, flip_code)
-        
-        flip_type = {0: "vertical", 1: "horizontal", -1: "both"}
-        
-        return {
-            "processed_image": encode_image_to_base64(flipped_image),
-            "flip_type": flip_type.get(flip_code, "unknown"),
-            "operation": "flip"
-        }
+        return await output.run_operation("flip", image, flip_code=flip_code)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in flip: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def warp_geometry(size: tuple, matrix: Optional[list] = None) -> tuple:
+    M = np.eye(3) if matrix is None else np.array(matrix, np.float64)
+    if M.shape == (2, 3):
+        M = np.vstack([M, [0, 0, 1]])
+    if M.shape != (3, 3) or not np.isfinite(M).all() or abs(np.linalg.det(M)) < 1e-12:
+        raise ValueError("matrix must be an invertible 2x3 affine or 3x3 perspective matrix")
+    return M, size, cv2.INTER_LINEAR, {
+        "matrix": M.tolist(),
+        "perspective": not np.array_equal(M[2], [0, 0, 1]),
+        "operation": "warp"
+    }
+
+
+@operation("warp", geometry=lambda args, size: warp_geometry(size, **args))
+def op_warp(image: np.ndarray, matrix: Optional[list] = None):  # 2x3 affine or 3x3 perspective matrix
+    """Apply an affine or perspective transform, keeping the image size"""
+    M, size, interpolation, info = warp_geometry((image.shape[1], image.shape[0]), matrix)
+    return warp_window(image, M, size, interpolation), info
+
+
+def warp_window(image: np.ndarray, matrix: np.ndarray, size: tuple, interpolation: int) -> np.ndarray:
+    """Resample ``image`` through a 3x3 pixel transform into a ``size`` output window.
+
+    Only the source region the window maps from (plus the interpolation's
+    reach) is read, so the crop's own edges are never sampled and only the
+    image's real border matters. When the window maps past that border the
+    image is padded with black, like the chained cv2.warpAffine of translate
+    and rotate, so edge pixels blend the same way; otherwise edges are
+    replicated, as cv2.resize does.
+    """
+    width, height = size
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Transform output is empty ({width}x{height})")
+    source_height, source_width = image.shape[:2]
+    reach = INTERPOLATION_REACH[interpolation]
+
+    x0, y0, x1, y1 = 0, 0, source_width, source_height
+    outside = True
+    corners = np.linalg.inv(matrix) @ np.array([
+        [-0.5, width - 0.5, width - 0.5, -0.5],
+        [-0.5, -0.5, height - 0.5, height - 0.5],
+        [1, 1, 1, 1]
+    ])
+    # A window reaching past a perspective horizon maps from an unbounded region
+    if (corners[2] > 1e-9).all():
+        xs, ys = corners[0] / corners[2], corners[1] / corners[2]
+        outside = xs.min() < -0.5 or ys.min() < -0.5 or xs.max() > source_width - 0.5 or ys.max() > source_height - 0.5
+        x0, x1 = max(0, math.floor(xs.min()) - reach), min(source_width, math.ceil(xs.max()) + reach + 1)
+        y0, y1 = max(0, math.floor(ys.min()) - reach), min(source_height, math.ceil(ys.max()) + reach + 1)
+    if x0 >= x1 or y0 >= y1:
+        return np.zeros((height, width) + image.shape[2:], image.dtype)
+
+    M = matrix @ translation(x0, y0)
+    if np.array_equal(M[2], [0, 0, 1]):
+        warp, M = cv2.warpAffine, M[:2]
+    else:
+        warp = cv2.warpPerspective
+    border = cv2.BORDER_CONSTANT if outside else cv2.BORDER_REPLICATE
+    return warp(image[y0:y1, x0:x1], M, size, flags=interpolation, borderMode=border)
+
+
+def run_geometry_operations(image: np.ndarray, steps: list):
+    """Apply a run of geometric operations (fn, arguments) as a single warp.
+
+    Each step's transform is composed into one matrix, tracking the size
+    every step would see, so the image is resampled once (with the best
+    interpolation any step asks for) instead of once per step, and crops
+    only narrow the output window. Returns the result and each step's metadata.
+    """
+    size = (image.shape[1], image.shape[0])
+    matrix = np.eye(3)
+    interpolation = cv2.INTER_NEAREST
+    infos = []
+    for fn, arguments in steps:
+        M, size, step_interpolation, info = fn.geometry(arguments, size)
+        matrix = M @ matrix
+        interpolation = max(interpolation, step_interpolation, key=list(INTERPOLATION_REACH).index)
+        infos.append(info)
+
+    return warp_window(image, matrix, size, interpolation), infos
+
+
+@app.post("/api/transform")
+async def transform_image(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    transforms: str = Form(...)  # JSON array of {"operation", "params"} geometric steps
+):
+    """Apply an ordered list of translate, rotate, flip, resize, crop and warp steps with one resampling pass"""
+    output.reject_roi("/api/transform")
+    try:
+        transforms_list = json.loads(transforms)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid transforms JSON: {e}")
+
+    if not isinstance(transforms_list, list) or not transforms_list:
+        raise HTTPException(status_code=400, detail="transforms must be a non-empty list")
+    if len(transforms_list) > MAX_PIPELINE_STEPS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PIPELINE_STEPS} transforms are allowed")
+
+    steps = []
+    for step in transforms_list:
+        if not isinstance(step, dict) or "operation" not in step:
+            raise HTTPException(status_code=400, detail="Each transform needs an operation")
+        fn, kwargs = bind_operation(step["operation"], step.get("params"))
+        if fn.geometry is None:
+            raise HTTPException(status_code=400, detail=f"Not a geometric transform: {step['operation']}")
+        steps.append((fn, operation_arguments(fn, **kwargs)))
+
+    try:
+        result_image, infos = await cpu_pool.run(run_geometry_operations, image, steps)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        return await output.respond({"processed_image": as_bgr(result_image)}, {
+            "steps": infos,
+            "total_steps": len(steps),
+            "output_size": [result_image.shape[1], result_image.shape[0]],
+            "operation": "transform"
+        })
+    except Exception as e:
+        logger.error(f"Error in transform: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 #SCALING, RESIZING, CROPPING
 
 
+# Resize interpolation names
+RESIZE_INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_LANCZOS4
+}
+
+
+def resize_geometry(size: tuple, scale_factor: float = 0.5, interpolation: str = "linear") -> tuple:
+    width, height = size
+    new_width = int(width * scale_factor)
+    new_height = int(height * scale_factor)
+    if new_width <= 0 or new_height <= 0:
+        raise ValueError(f"scale_factor {scale_factor} leaves no pixels of a {width}x{height} image")
+
+    # cv2.resize maps pixel centres onto pixel centres
+    scale_x, scale_y = new_width / width, new_height / height
+    M = np.array([[scale_x, 0, (scale_x - 1) / 2], [0, scale_y, (scale_y - 1) / 2], [0, 0, 1]])
+    return M, (new_width, new_height), RESIZE_INTERPOLATIONS.get(interpolation, cv2.INTER_LINEAR), {
+        "original_size": [width, height],
+        "new_size": [new_width, new_height],
+        "scale_factor": scale_factor,
+        "interpolation": interpolation,
+        "operation": "resize"
+    }
+
+
+@operation("resize", geometry=lambda args, size: resize_geometry(size, **args))
+def op_resize(image: np.ndarray, scale_factor: float = 0.5, interpolation: str = "linear"):
+    """Resize image with different interpolation methods"""
+    height, width = image.shape[:2]
+    _, new_size, interp, info = resize_geometry((width, height), scale_factor, interpolation)
+
+    # Resize image
+    resized_image = cv2.resize(image, new_size, interpolation=interp)
+
+    return resized_image, info
+
 @app.post("/api/resize")
 async def resize_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     scale_factor: float = Form(0.5),
     interpolation: str = Form("linear")
 ):
     """Resize image with different interpolation methods"""
     try:
-        image = decode_base64_image(image_data)
-        height, width = image.shape[:2]
-        
-        # Map interpolation methods
-        interp_methods = {
-            "nearest": cv2.INTER_NEAREST,
-            "linear": cv2.INTER_LINEAR,
-            "cubic": cv2.INTER_CUBIC,
-            "lanczos": cv2.INTER_LANCZOS4
-        }
-        
-        interp = interp_methods.get(interpolation, cv2.INTER_LINEAR)
-        new_width = int(width * scale_factor)
-        new_height = int(height * scale_factor)
-        
-        # Resize image
-        resized_image = cv2.resize(image, (new_width, new_height), interpolation=interp)
-        
-        return {
-            "processed_image": encode_image_to_base64(resized_image),
-            "original_size": [width, height],
-            "new_size": [new_width, new_height],
-            "scale_factor": scale_factor,
-            "interpolation": interpolation,
-            "operation": "resize"
-        }
+        return await output.run_operation("resize", image, scale_factor=scale_factor, interpolation=interpolation)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in resize: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@operation("pyramid")
+def op_pyramid(image: np.ndarray, levels: int = 3):
+    """Create image pyramid"""
+    # Create Gaussian pyramid
+    pyramid = [image]
+    current = image.copy()
+
+    for i in range(levels):
+        current = cv2.pyrDown(current)
+        pyramid.append(current)
+
+    # Create a combined visualization
+    height, width = image.shape[:2]
+    result_image = np.zeros((height * 2, width * 2) + image.shape[2:], dtype=np.uint8)
+
+    # Place original image
+    result_image[:height, :width] = image
+
+    # Place pyramid levels
+    y_offset, x_offset = 0, width
+    for level in pyramid[1:]:
+        h, w = level.shape[:2]
+        if y_offset + h <= height * 2 and x_offset + w <= width * 2:
+            result_image[y_offset:y_offset+h, x_offset:x_offset+w] = level
+            y_offset += h + 10
+
+    return result_image, {
+        "levels": levels,
+        "operation": "image_pyramid"
+    }
+
 @app.post("/api/pyramid")
 async def create_pyramid(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     levels: int = Form(3)
 ):
     """Create image pyramid"""
     try:
-        image = decode_base64_image(image_data)
-        
-        # Create Gaussian pyramid
-        pyramid = [image]
-        current = image.copy()
-        
-        for i in range(levels):
-            current = cv2.pyrDown(current)
-            pyramid.append(current)
-        
-        # Create a combined visualization
-        height, width = image.shape[:2]
-        result_image = np.zeros((height * 2, width * 2, 3), dtype=np.uint8)
-        
-        # Place original image
-        result_image[:height, :width] = image
-        
-        # Place pyramid levels
-        y_offset, x_offset = 0, width
-        for level in pyramid[1:]:
-            h, w = level.shape[:2]
-            if y_offset + h <= height * 2 and x_offset + w <= width * 2:
-                result_image[y_offset:y_offset+h, x_offset:x_offset+w] = level
-                y_offset += h + 10
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "levels": levels,
-            "operation": "image_pyramid"
-        }
+        return await output.run_operation("pyramid", image, levels=levels)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creating pyramid: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def crop_geometry(size: tuple, x: int = 100, y: int = 100, width: int = 200, height: int = 200) -> tuple:
+    img_width, img_height = size
+
+    # Ensure crop coordinates are within image bounds
+    x = max(0, min(x, img_width))
+    y = max(0, min(y, img_height))
+    width = min(width, img_width - x)
+    height = min(height, img_height - y)
+
+    return translation(-x, -y), (width, height), cv2.INTER_NEAREST, {
+        "crop_region": {"x": x, "y": y, "width": width, "height": height},
+        "operation": "crop"
+    }
+
+
+@operation("crop", geometry=lambda args, size: crop_geometry(size, **args))
+def op_crop(image: np.ndarray, x: int = 100, y: int = 100, width: int = 200, height: int = 200):
+    """Crop image to specified region"""
+    _, _, _, info = crop_geometry((image.shape[1], image.shape[0]), x, y, width, height)
+    region = info["crop_region"]
+
+    # Crop image
+    cropped_image = image[region["y"]:region["y"] + region["height"], region["x"]:region["x"] + region["width"]]
+
+    return cropped_image, info
+
 @app.post("/api/crop")
 async def crop_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     x: int = Form(100),
     y: int = Form(100),
     width: int = Form(200),
@@ -776,23 +3137,9 @@ async def crop_image(
 ):
     """Crop image to specified region"""
     try:
-        image = decode_base64_image(image_data)
-        img_height, img_width = image.shape[:2]
-        
-        # Ensure crop coordinates are within image bounds
-        x = max(0, min(x, img_width))
-        y = max(0, min(y, img_height))
-        width = min(width, img_width - x)
-        height = min(height, img_height - y)
-        
-        # Crop image
-        cropped_image = image[y:y+height, x:x+width]
-        
-        return {
-            "processed_image": encode_image_to_base64(cropped_image),
-            "crop_region": {"x": x, "y": y, "width": width, "height": height},
-            "operation": "crop"
-        }
+        return await output.run_operation("crop", image, x=x, y=y, width=width, height=height)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error cropping image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -801,74 +3148,107 @@ async def crop_image(
 # ARITHMETIC AND BITWISE OPERATIONS
 
 
+@operation("arithmetic", halo=lambda args: 0, point=lambda args: "channel")
+def op_arithmetic(image: np.ndarray, operation: str = "add", value: int = 50):
+    """Perform arithmetic operations on image"""
+    if operation == "add":
+        result_image = cv2.add(image, np.ones(image.shape, dtype=np.uint8) * value)
+    elif operation == "subtract":
+        result_image = cv2.subtract(image, np.ones(image.shape, dtype=np.uint8) * value)
+    elif operation == "multiply":
+        result_image = cv2.multiply(image, value / 100.0)  # Scale factor
+    elif operation == "divide":
+        result_image = cv2.divide(image, value / 100.0)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid operation")
+
+    return result_image.astype(np.uint8), {
+        "operation": f"arithmetic_{operation}",
+        "value": value
+    }
+
 @app.post("/api/arithmetic")
 async def arithmetic_operations(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     operation: str = Form("add"),
     value: int = Form(50)
 ):
     """Perform arithmetic operations on image"""
     try:
-        image = decode_base64_image(image_data)
-        
-        if operation == "add":
-            result_image = cv2.add(image, np.ones(image.shape, dtype=np.uint8) * value)
-        elif operation == "subtract":
-            result_image = cv2.subtract(image, np.ones(image.shape, dtype=np.uint8) * value)
-        elif operation == "multiply":
-            result_image = cv2.multiply(image, value / 100.0)  # Scale factor
-        elif operation == "divide":
-            result_image = cv2.divide(image, value / 100.0)
-        else:
-            raise HTTPException(status_code=400, detail="Invalid operation")
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image.astype(np.uint8)),
-            "operation": f"arithmetic_{operation}",
-            "value": value
-        }
+        return await output.run_operation("arithmetic", image, operation=operation, value=value)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def bitwise_mask(height: int, width: int, mask_type: str) -> np.ndarray:
+    """Single-channel mask used by the bitwise operations"""
+    if mask_type == "circular":
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.circle(mask, (width//2, height//2), min(width, height)//4, 255, -1)
+    elif mask_type == "rectangular":
+        mask = np.zeros((height, width), dtype=np.uint8)
+        cv2.rectangle(mask, (width//4, height//4), (3*width//4, 3*height//4), 255, -1)
+    else:
+        mask = np.ones((height, width), dtype=np.uint8) * 255
+    return mask
+
+def bitwise_mask_image(height: int, width: int, mask_type: str,
+                       roi: Optional[RegionOfInterest] = None) -> np.ndarray:
+    """The bitwise mask as a BGR frame, limited to the region of interest if given"""
+    mask = bitwise_mask(height, width, mask_type)
+    if roi is not None:
+        # The operation only applies within the selection, so blend the mask into
+        # an empty frame the same way the result is blended into the input
+        images, _, _ = run_on_region(lambda frame: ({"mask_image": mask}, {}), np.zeros_like(mask), roi, None)
+        return images["mask_image"]
+    return cv2.merge([mask, mask, mask])
+
+@operation("bitwise", point=lambda args: "channel" if args["operation"] == "not" else None)
+def op_bitwise(image: np.ndarray, operation: str = "and", mask_type: str = "circular"):
+    """Perform bitwise operations"""
+    height, width = image.shape[:2]
+
+    # Create mask, with as many channels as the image for or/xor
+    mask = bitwise_mask(height, width, mask_type)
+    mask_channels = mask if image.ndim == 2 else cv2.merge([mask] * image.shape[2])
+
+    # Apply bitwise operation
+    if operation == "and":
+        result_image = cv2.bitwise_and(image, image, mask=mask)
+    elif operation == "or":
+        result_image = cv2.bitwise_or(image, mask_channels)
+    elif operation == "xor":
+        result_image = cv2.bitwise_xor(image, mask_channels)
+    elif operation == "not":
+        result_image = cv2.bitwise_not(image)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid operation")
+
+    return result_image, {
+        "operation": f"bitwise_{operation}",
+        "mask_type": mask_type
+    }
+
 @app.post("/api/bitwise")
 async def bitwise_operations(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     operation: str = Form("and"),
     mask_type: str = Form("circular")
 ):
     """Perform bitwise operations"""
     try:
-        image = decode_base64_image(image_data)
-        height, width = image.shape[:2]
-        
-        # Create mask
-        if mask_type == "circular":
-            mask = np.zeros((height, width), dtype=np.uint8)
-            cv2.circle(mask, (width//2, height//2), min(width, height)//4, 255, -1)
-        elif mask_type == "rectangular":
-            mask = np.zeros((height, width), dtype=np.uint8)
-            cv2.rectangle(mask, (width//4, height//4), (3*width//4, 3*height//4), 255, -1)
-        else:
-            mask = np.ones((height, width), dtype=np.uint8) * 255
-        
-        # Apply bitwise operation
-        if operation == "and":
-            result_image = cv2.bitwise_and(image, image, mask=mask)
-        elif operation == "or":
-            result_image = cv2.bitwise_or(image, cv2.merge([mask, mask, mask]))
-        elif operation == "xor":
-            result_image = cv2.bitwise_xor(image, cv2.merge([mask, mask, mask]))
-        elif operation == "not":
-            result_image = cv2.bitwise_not(image)
-        else:
-            raise HTTPException(status_code=400, detail="Invalid operation")
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "mask_image": encode_image_to_base64(cv2.merge([mask, mask, mask])),
-            "operation": f"bitwise_{operation}",
-            "mask_type": mask_type
-        }
+        result_image, info = await output.run(display_operation, op_bitwise, image, operation, mask_type, roi=output.roi)
+        mask_image = await output.run(bitwise_mask_image, image.shape[0], image.shape[1], mask_type, output.roi)
+
+        return await output.respond({
+            "processed_image": result_image,
+            "mask_image": mask_image
+        }, info)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -876,95 +3256,342 @@ async def bitwise_operations(
 #CONVOLUTIONS, BLURRING, SHARPENING
 
 
+def guided_filter(guide: np.ndarray, src: np.ndarray, radius: int, eps: float) -> np.ndarray:
+    """Edge-preserving guided filter (He et al.) built from box filters.
+
+    Each channel of ``src`` is fitted as a local linear function of the same
+    channel of ``guide`` over (2 * radius + 1)^2 windows; ``eps`` (on a 0-1
+    intensity scale) is the variance below which structure is smoothed away.
+    Every step is a ``cv2.boxFilter``, so the cost does not grow with radius.
+    """
+    self_guided = guide is src
+    guide = guide.astype(np.float32) * (1 / 255)
+    src = guide if self_guided else src.astype(np.float32) * (1 / 255)
+    size = (2 * radius + 1, 2 * radius + 1)
+
+    def mean(x):
+        return cv2.boxFilter(x, -1, size, borderType=cv2.BORDER_REFLECT)
+
+    mean_guide = mean(guide)
+    variance = mean(guide * guide) - mean_guide * mean_guide
+    if self_guided:
+        # Filtering an image by itself: the covariance is the variance
+        mean_src, covariance = mean_guide, variance
+    else:
+        mean_src = mean(src)
+        covariance = mean(guide * src) - mean_guide * mean_src
+    a = covariance / (variance + eps)
+    b = mean_src - a * mean_guide
+
+    result = mean(a) * guide + mean(b)
+    return np.clip(result * 255 + 0.5, 0, 255).astype(np.uint8)
+
+
+# Edge-preserving smoothing engines for the bilateral options: OpenCV's exact
+# bilateral filter, whose cost grows with the kernel area, or the guided filter,
+# whose box-filter passes cost the same at any kernel size
+BILATERAL_ENGINES = ("exact", "guided")
+
+
+def edge_preserving_filter(image: np.ndarray, diameter: int, sigma_color: float, engine: str = "exact") -> np.ndarray:
+    """Bilateral-style smoothing over a diameter-sized window with the chosen engine.
+
+    The guided engine filters each channel guided by itself over the same
+    window, with ``eps`` set from the bilateral colour sigma so both treat
+    the same intensity differences as edges.
+    """
+    if engine == "exact":
+        return cv2.bilateralFilter(image, diameter, sigma_color, sigma_color)
+    if engine == "guided":
+        return guided_filter(image, image, max(1, diameter // 2), (sigma_color / 255) ** 2)
+    raise HTTPException(status_code=400, detail=f"bilateral_engine must be one of: {', '.join(BILATERAL_ENGINES)}")
+
+
+def edge_preserving_halo(diameter: int, engine: str) -> int:
+    # The guided filter averages box means, so it reads two radii out
+    return 2 * max(1, diameter // 2) if engine == "guided" else diameter // 2
+
+
+def blur_halo(args: dict) -> int:
+    kernel_size = args["kernel_size"] | 1
+    if args["blur_type"] == "bilateral":
+        return edge_preserving_halo(kernel_size, args["bilateral_engine"])
+    return kernel_size // 2
+
+
+@operation("blur", halo=blur_halo)
+def op_blur(
+    image: np.ndarray,
+    blur_type: str = "gaussian",
+    kernel_size: int = 15,
+    sigma_x: float = 0,
+    sigma_y: float = 0,
+    bilateral_engine: str = "exact"
+):
+    """Apply various blur effects"""
+    # Ensure kernel size is odd
+    if kernel_size % 2 == 0:
+        kernel_size += 1
+
+    if blur_type == "gaussian":
+        result_image = cv2.GaussianBlur(image, (kernel_size, kernel_size), sigma_x, sigma_y)
+    elif blur_type == "motion":
+        # Create motion blur kernel
+        kernel = np.zeros((kernel_size, kernel_size))
+        kernel[int((kernel_size-1)/2), :] = np.ones(kernel_size)
+        kernel = kernel / kernel_size
+        result_image = cv2.filter2D(image, -1, kernel)
+    elif blur_type == "median":
+        result_image = cv2.medianBlur(image, kernel_size)
+    elif blur_type == "bilateral":
+        result_image = edge_preserving_filter(image, kernel_size, 80, bilateral_engine)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid blur type")
+
+    info = {
+        "blur_type": blur_type,
+        "kernel_size": kernel_size,
+        "operation": "blur"
+    }
+    if blur_type == "bilateral":
+        info["bilateral_engine"] = bilateral_engine
+    return result_image, info
+
 @app.post("/api/blur")
 async def blur_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     blur_type: str = Form("gaussian"),
     kernel_size: int = Form(15),
     sigma_x: float = Form(0),
-    sigma_y: float = Form(0)
+    sigma_y: float = Form(0),
+    bilateral_engine: str = Form("exact")  # "guided" for constant cost at any kernel size
 ):
     """Apply various blur effects"""
+    if bilateral_engine not in BILATERAL_ENGINES:
+        raise HTTPException(status_code=400, detail=f"bilateral_engine must be one of: {', '.join(BILATERAL_ENGINES)}")
+
     try:
-        image = decode_base64_image(image_data)
-        
-        # Ensure kernel size is odd
-        if kernel_size % 2 == 0:
-            kernel_size += 1
-        
-        if blur_type == "gaussian":
-            result_image = cv2.GaussianBlur(image, (kernel_size, kernel_size), sigma_x, sigma_y)
-        elif blur_type == "motion":
-            # Create motion blur kernel
-            kernel = np.zeros((kernel_size, kernel_size))
-            kernel[int((kernel_size-1)/2), :] = np.ones(kernel_size)
-            kernel = kernel / kernel_size
-            result_image = cv2.filter2D(image, -1, kernel)
-        elif blur_type == "median":
-            result_image = cv2.medianBlur(image, kernel_size)
-        elif blur_type == "bilateral":
-            result_image = cv2.bilateralFilter(image, kernel_size, 80, 80)
-        else:
-            raise HTTPException(status_code=400, detail="Invalid blur type")
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "blur_type": blur_type,
-            "kernel_size": kernel_size,
-            "operation": "blur"
-        }
+        return await output.run_operation("blur", image, blur_type=blur_type, kernel_size=kernel_size, sigma_x=sigma_x, sigma_y=sigma_y, bilateral_engine=bilateral_engine)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@operation("sharpen", halo=lambda args: 1)
+def op_sharpen(image: np.ndarray, strength: float = 1.0):
+    """Sharpen image using convolution"""
+    # Define sharpening kernel
+    kernel = np.array([[-1, -1, -1],
+                      [-1, 9, -1],
+                      [-1, -1, -1]]) * strength
+
+    # Apply sharpening filter
+    result_image = cv2.filter2D(image, -1, kernel)
+
+    return result_image, {
+        "strength": strength,
+        "operation": "sharpen"
+    }
+
+@app.post("/api/sharpen")
+async def sharpen_image(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    strength: float = Form(1.0)
+):
+    """Sharpen image using convolution"""
+    try:
+        return await output.run_operation("sharpen", image, strength=strength)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/sharpen")
-async def sharpen_image(
-    image_data: str = Form(...),
-    strength: float = Form(1.0)
-):
-    """Sharpen image using convolution"""
-    try:
-        image = decode_base64_image(image_data)
-        
-        # Define sharpening kernel
-        kernel = np.array([[-1, -1, -1],
-                          [-1, 9, -1],
-                          [-1, -1, -1]]) * strength
-        
-        # Apply sharpening filter
-        result_image = cv2.filter2D(image, -1, kernel)
-        
+# Pixel radius each denoise method reads: NL-means search (21) plus template (7) window
+DENOISE_HALO = {"nlmeans": 21 // 2 + 7 // 2, "bilateral": 9 // 2, "gaussian": 5 // 2}
+
+# NL-means quality tiers, best first, and the downscale factor each one denoises at
+DENOISE_TIERS = {"full": 1, "half": 2, "quarter": 4}
+
+# Full-quality NL-means is spread over the tile workers from this size up
+DENOISE_SPREAD_MP = 1
+
+
+def nlmeans(image: np.ndarray, h: float) -> np.ndarray:
+    if image.ndim == 2:
+        return cv2.fastNlMeansDenoising(image, None, h, 7, 21)
+    return cv2.fastNlMeansDenoisingColored(image, None, h, h, 7, 21)
+
+
+def nlmeans_downscaled(image: np.ndarray, h: float, factor: int) -> np.ndarray:
+    """NL-means on a 1/factor copy, brought back to full size by guided upsampling.
+
+    Area downscaling averages factor^2 pixels, which divides the noise by
+    ``factor``, so the filter strength is scaled the same way. The upsampled
+    clean copy then guides a filter over the full-resolution input, restoring
+    edges the small copy blurred while smoothing the noise in flat areas.
+    """
+    height, width = image.shape[:2]
+    small = cv2.resize(image, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_AREA)
+    clean = cv2.resize(nlmeans(small, h / factor), (width, height), interpolation=cv2.INTER_LINEAR)
+    return guided_filter(clean, image, factor, (h / 255) ** 2)
+
+
+def denoise_halo(args: dict) -> int:
+    if args["method"] == "bilateral":
+        return edge_preserving_halo(9, args["bilateral_engine"])
+    factor = DENOISE_TIERS.get(args.get("quality"), 1)
+    if args["method"] != "nlmeans" or factor == 1:
+        return DENOISE_HALO.get(args["method"], 0)
+    # NL-means window at the reduced scale, the upsampling tap and the two guided
+    # filter box passes, kept a multiple of the factor so tiles downscale aligned
+    return factor * (DENOISE_HALO["nlmeans"] + 3)
+
+
+@operation(
+    "denoise",
+    halo=denoise_halo,
+    tile_threshold=lambda args: DENOISE_SPREAD_MP if args["method"] == "nlmeans" and args["quality"] == "full" else None
+)
+def op_denoise(
+    image: np.ndarray,
+    method: str = "nlmeans",
+    h: float = 10.0,
+    quality: str = "full",
+    bilateral_engine: str = "exact"
+):
+    """Remove noise from image"""
+    if method == "nlmeans":
+        factor = DENOISE_TIERS.get(quality)
+        if factor is None:
+            raise HTTPException(status_code=400, detail="Invalid denoising quality")
+        if factor == 1 or min(image.shape[:2]) < 8 * factor:
+            result_image = nlmeans(image, h)
+        else:
+            result_image = nlmeans_downscaled(image, h, factor)
+    elif method == "bilateral":
+        result_image = edge_preserving_filter(image, 9, 75, bilateral_engine)
+    elif method == "gaussian":
+        result_image = cv2.GaussianBlur(image, (5, 5), 0)
+    else:
+        raise HTTPException(status_code=400, detail="Invalid denoising method")
+
+    info = {
+        "method": method,
+        "quality": quality,
+        "operation": "denoise"
+    }
+    if method == "bilateral":
+        info["bilateral_engine"] = bilateral_engine
+    return result_image, info
+
+
+class DenoiseBudget:
+    """Per-tier NL-means cost estimates, used to fit a denoise into a deadline.
+
+    Costs are kept in milliseconds per megapixel, seeded with single-core
+    measurements and refined with a moving average of observed runs, so the
+    estimates follow this machine's speed, worker count and load.
+    """
+
+    SEED_MS_PER_MP = {"full": 4000.0, "half": 1000.0, "quarter": 300.0}
+    SMOOTHING = 0.3
+
+    def __init__(self):
+        self.costs = dict(self.SEED_MS_PER_MP)
+        self.runs = dict.fromkeys(self.costs, 0)
+
+    def estimate(self, tier: str, megapixels: float) -> float:
+        return self.costs[tier] * megapixels
+
+    def choose(self, megapixels: float, deadline_ms: float, best: str = "full") -> str:
+        """Best tier, no better than ``best``, expected to finish within the deadline (else the fastest)"""
+        tiers = list(DENOISE_TIERS)
+        candidates = tiers[tiers.index(best):]
+        for tier in candidates:
+            if self.estimate(tier, megapixels) <= deadline_ms:
+                return tier
+        return candidates[-1]
+
+    def observe(self, tier: str, megapixels: float, elapsed_ms: float):
+        # Tiny images are dominated by fixed overhead and would skew the per-pixel cost
+        if megapixels < 0.1:
+            return
+        self.costs[tier] += self.SMOOTHING * (elapsed_ms / megapixels - self.costs[tier])
+        self.runs[tier] += 1
+
+    def stats(self) -> dict:
         return {
-            "processed_image": encode_image_to_base64(result_image),
-            "strength": strength,
-            "operation": "sharpen"
+            tier: {"ms_per_megapixel": round(cost, 1), "runs": self.runs[tier]}
+            for tier, cost in self.costs.items()
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+
+denoise_budget = DenoiseBudget()
+
+
+def timed_call(fn, /, *args, **kwargs):
+    """Call ``fn`` and return its result with the call's wall time in milliseconds.
+
+    Runs inside the CPU pool job so the time excludes waiting for a worker.
+    """
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
+
 
 @app.post("/api/denoise")
 async def denoise_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     method: str = Form("nlmeans"),
-    h: float = Form(10.0)
+    h: float = Form(10.0),
+    quality: str = Form("full"),  # NL-means tier: full, half or quarter
+    deadline_ms: Optional[float] = Form(None),  # pick the best tier expected to fit
+    bilateral_engine: str = Form("exact")  # "guided" for the box-filter edge-preserving filter
 ):
     """Remove noise from image"""
+    if quality not in DENOISE_TIERS:
+        raise HTTPException(status_code=400, detail=f"quality must be one of: {', '.join(DENOISE_TIERS)}")
+    if deadline_ms is not None and deadline_ms <= 0:
+        raise HTTPException(status_code=400, detail="deadline_ms must be positive")
+    if bilateral_engine not in BILATERAL_ENGINES:
+        raise HTTPException(status_code=400, detail=f"bilateral_engine must be one of: {', '.join(BILATERAL_ENGINES)}")
+
     try:
-        image = decode_base64_image(image_data)
-        
+        megapixels = image.shape[0] * image.shape[1] / 1_000_000
+        if output.roi is not None:
+            # Budget for the selected rectangle, which is all that gets denoised
+            box = output.roi.bounds(image.shape[1], image.shape[0]) or (0, 0, 0, 0)
+            megapixels = (box[2] - box[0]) * (box[3] - box[1]) / 1_000_000
+        tier = quality
+        budget = {}
+        if method == "nlmeans" and deadline_ms is not None:
+            tier = denoise_budget.choose(megapixels, deadline_ms, quality)
+            budget = {"deadline_ms": deadline_ms, "estimated_ms": round(denoise_budget.estimate(tier, megapixels), 1)}
+
+        fn, kwargs = bind_operation("denoise", {"method": method, "h": h, "quality": tier, "bilateral_engine": bilateral_engine})
+        cache_key = output.cache_key("denoise", kwargs)
+        cached = result_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            # Nothing ran: drop the stored run's timing and report this request's budget
+            encoded, info, encoding = cached
+            info = {k: v for k, v in info.items() if k not in ("denoise_ms", "deadline_ms", "estimated_ms")}
+            return output.build(encoded, {**info, **budget}, encoding, cache_status="HIT")
+
+        # Timed inside the pool job, so queueing for a worker counts against neither
+        # the reported time nor the tier cost estimates
+        (result_image, info), elapsed_ms = await output.run(
+            timed_call, display_operation, fn, image, roi=output.roi, **kwargs
+        )
         if method == "nlmeans":
-            result_image = cv2.fastNlMeansDenoisingColored(image, None, h, h, 7, 21)
-        elif method == "bilateral":
-            result_image = cv2.bilateralFilter(image, 9, 75, 75)
-        elif method == "gaussian":
-            result_image = cv2.GaussianBlur(image, (5, 5), 0)
-        else:
-            raise HTTPException(status_code=400, detail="Invalid denoising method")
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "method": method,
-            "operation": "denoise"
-        }
+            denoise_budget.observe(tier, megapixels, elapsed_ms)
+
+        info = {**info, "denoise_ms": round(elapsed_ms, 1), **budget}
+        return await output.respond({"processed_image": result_image}, info, cache_key)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -972,94 +3599,119 @@ async def denoise_image(
 # THRESHOLDING
 
 
+@operation("threshold", halo=lambda args: 0, point=lambda args: "gray", gray_input=True)
+def op_threshold(
+    image: np.ndarray,
+    threshold_value: int = 127,
+    max_value: int = 255,
+    threshold_type: str = "binary"
+):
+    """Apply binary thresholding"""
+    gray_image = as_gray(image)
+
+    # Map threshold types
+    thresh_types = {
+        "binary": cv2.THRESH_BINARY,
+        "binary_inv": cv2.THRESH_BINARY_INV,
+        "trunc": cv2.THRESH_TRUNC,
+        "tozero": cv2.THRESH_TOZERO,
+        "tozero_inv": cv2.THRESH_TOZERO_INV
+    }
+
+    thresh_type = thresh_types.get(threshold_type, cv2.THRESH_BINARY)
+
+    # Apply threshold
+    _, thresholded = cv2.threshold(gray_image, threshold_value, max_value, thresh_type)
+
+    return thresholded, {
+        "threshold_value": threshold_value,
+        "max_value": max_value,
+        "threshold_type": threshold_type,
+        "operation": "threshold"
+    }
+
 @app.post("/api/threshold")
 async def threshold_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     threshold_value: int = Form(127),
     max_value: int = Form(255),
-    threshold_type: str = Form("binary")
+    threshold_type: str = Form("binary"),
+    preview_size: Optional[int] = Depends(preview_options)
 ):
     """Apply binary thresholding"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Map threshold types
-        thresh_types = {
-            "binary": cv2.THRESH_BINARY,
-            "binary_inv": cv2.THRESH_BINARY_INV,
-            "trunc": cv2.THRESH_TRUNC,
-            "tozero": cv2.THRESH_TOZERO,
-            "tozero_inv": cv2.THRESH_TOZERO_INV
-        }
-        
-        thresh_type = thresh_types.get(threshold_type, cv2.THRESH_BINARY)
-        
-        # Apply threshold
-        _, thresholded = cv2.threshold(gray_image, threshold_value, max_value, thresh_type)
-        
-        # Convert back to 3-channel for display
-        result_image = cv2.cvtColor(thresholded, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "threshold_value": threshold_value,
-            "max_value": max_value,
-            "threshold_type": threshold_type,
-            "operation": "threshold"
-        }
+        return await output.run_operation("threshold", image, preview_size=preview_size, threshold_value=threshold_value, max_value=max_value, threshold_type=threshold_type)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@operation(
+    "adaptive-threshold",
+    scaled_params=("block_size",),
+    halo=lambda args: max(3, args["block_size"] | 1) // 2,
+    gray_input=True
+)
+def op_adaptive_threshold(
+    image: np.ndarray,
+    max_value: int = 255,
+    adaptive_method: str = "mean",
+    threshold_type: str = "binary",
+    block_size: int = 11,
+    c: int = 2
+):
+    """Apply adaptive thresholding"""
+    gray_image = as_gray(image)
+
+    # Ensure block size is odd and >= 3
+    if block_size % 2 == 0:
+        block_size += 1
+    block_size = max(3, block_size)
+
+    # Map adaptive methods
+    adaptive_methods = {
+        "mean": cv2.ADAPTIVE_THRESH_MEAN_C,
+        "gaussian": cv2.ADAPTIVE_THRESH_GAUSSIAN_C
+    }
+
+    thresh_types = {
+        "binary": cv2.THRESH_BINARY,
+        "binary_inv": cv2.THRESH_BINARY_INV
+    }
+
+    adaptive_method_cv = adaptive_methods.get(adaptive_method, cv2.ADAPTIVE_THRESH_MEAN_C)
+    thresh_type = thresh_types.get(threshold_type, cv2.THRESH_BINARY)
+
+    # Apply adaptive threshold
+    thresholded = cv2.adaptiveThreshold(
+        gray_image, max_value, adaptive_method_cv, thresh_type, block_size, c
+    )
+
+    return thresholded, {
+        "adaptive_method": adaptive_method,
+        "threshold_type": threshold_type,
+        "block_size": block_size,
+        "c": c,
+        "operation": "adaptive_threshold"
+    }
+
 @app.post("/api/adaptive-threshold")
 async def adaptive_threshold_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     max_value: int = Form(255),
     adaptive_method: str = Form("mean"),
     threshold_type: str = Form("binary"),
     block_size: int = Form(11),
-    c: int = Form(2)
+    c: int = Form(2),
+    preview_size: Optional[int] = Depends(preview_options)
 ):
     """Apply adaptive thresholding"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Ensure block size is odd and >= 3
-        if block_size % 2 == 0:
-            block_size += 1
-        block_size = max(3, block_size)
-        
-        # Map adaptive methods
-        adaptive_methods = {
-            "mean": cv2.ADAPTIVE_THRESH_MEAN_C,
-            "gaussian": cv2.ADAPTIVE_THRESH_GAUSSIAN_C
-        }
-        
-        thresh_types = {
-            "binary": cv2.THRESH_BINARY,
-            "binary_inv": cv2.THRESH_BINARY_INV
-        }
-        
-        adaptive_method_cv = adaptive_methods.get(adaptive_method, cv2.ADAPTIVE_THRESH_MEAN_C)
-        thresh_type = thresh_types.get(threshold_type, cv2.THRESH_BINARY)
-        
-        # Apply adaptive threshold
-        thresholded = cv2.adaptiveThreshold(
-            gray_image, max_value, adaptive_method_cv, thresh_type, block_size, c
-        )
-        
-        # Convert back to 3-channel for display
-        result_image = cv2.cvtColor(thresholded, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "adaptive_method": adaptive_method,
-            "threshold_type": threshold_type,
-            "block_size": block_size,
-            "c": c,
-            "operation": "adaptive_threshold"
-        }
+        return await output.run_operation("adaptive-threshold", image, preview_size=preview_size, max_value=max_value, adaptive_method=adaptive_method, threshold_type=threshold_type, block_size=block_size, c=c)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1067,156 +3719,787 @@ async def adaptive_threshold_image(
 # TOPIC 10: MORPHOLOGICAL OPERATIONS AND EDGE DETECTION
 # =============================================================================
 
+@operation("dilation", halo=lambda args: args["kernel_size"] // 2 * args["iterations"], gray_input=True)
+def op_dilation(image: np.ndarray, kernel_size: int = 5, iterations: int = 1):
+    """Apply morphological dilation"""
+    # Create structuring element
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+
+    # Apply dilation
+    dilated = cv2.dilate(as_gray(image), kernel, iterations=iterations)
+
+    return dilated, {
+        "kernel_size": kernel_size,
+        "iterations": iterations,
+        "operation": "dilation"
+    }
+
 @app.post("/api/dilation")
 async def dilate_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     kernel_size: int = Form(5),
     iterations: int = Form(1)
 ):
     """Apply morphological dilation"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Create structuring element
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-        
-        # Apply dilation
-        dilated = cv2.dilate(gray_image, kernel, iterations=iterations)
-        
-        # Convert back to 3-channel
-        result_image = cv2.cvtColor(dilated, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "kernel_size": kernel_size,
-            "iterations": iterations,
-            "operation": "dilation"
-        }
+        return await output.run_operation("dilation", image, kernel_size=kernel_size, iterations=iterations)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@operation("erosion", halo=lambda args: args["kernel_size"] // 2 * args["iterations"], gray_input=True)
+def op_erosion(image: np.ndarray, kernel_size: int = 5, iterations: int = 1):
+    """Apply morphological erosion"""
+    # Create structuring element
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+
+    # Apply erosion
+    eroded = cv2.erode(as_gray(image), kernel, iterations=iterations)
+
+    return eroded, {
+        "kernel_size": kernel_size,
+        "iterations": iterations,
+        "operation": "erosion"
+    }
+
 @app.post("/api/erosion")
 async def erode_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     kernel_size: int = Form(5),
     iterations: int = Form(1)
 ):
     """Apply morphological erosion"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Create structuring element
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-        
-        # Apply erosion
-        eroded = cv2.erode(gray_image, kernel, iterations=iterations)
-        
-        # Convert back to 3-channel
-        result_image = cv2.cvtColor(eroded, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "kernel_size": kernel_size,
-            "iterations": iterations,
-            "operation": "erosion"
-        }
+        return await output.run_operation("erosion", image, kernel_size=kernel_size, iterations=iterations)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@operation("opening", halo=lambda args: 2 * (args["kernel_size"] // 2) * args["iterations"], gray_input=True)
+def op_opening(image: np.ndarray, kernel_size: int = 5, iterations: int = 1):
+    """Apply morphological opening (erosion followed by dilation)"""
+    # Create structuring element
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+
+    # Apply opening
+    opened = cv2.morphologyEx(as_gray(image), cv2.MORPH_OPEN, kernel, iterations=iterations)
+
+    return opened, {
+        "kernel_size": kernel_size,
+        "iterations": iterations,
+        "operation": "opening"
+    }
+
 @app.post("/api/opening")
 async def opening_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     kernel_size: int = Form(5),
     iterations: int = Form(1)
 ):
     """Apply morphological opening (erosion followed by dilation)"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Create structuring element
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-        
-        # Apply opening
-        opened = cv2.morphologyEx(gray_image, cv2.MORPH_OPEN, kernel, iterations=iterations)
-        
-        # Convert back to 3-channel
-        result_image = cv2.cvtColor(opened, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "kernel_size": kernel_size,
-            "iterations": iterations,
-            "operation": "opening"
-        }
+        return await output.run_operation("opening", image, kernel_size=kernel_size, iterations=iterations)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@operation("closing", halo=lambda args: 2 * (args["kernel_size"] // 2) * args["iterations"], gray_input=True)
+def op_closing(image: np.ndarray, kernel_size: int = 5, iterations: int = 1):
+    """Apply morphological closing (dilation followed by erosion)"""
+    # Create structuring element
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+
+    # Apply closing
+    closed = cv2.morphologyEx(as_gray(image), cv2.MORPH_CLOSE, kernel, iterations=iterations)
+
+    return closed, {
+        "kernel_size": kernel_size,
+        "iterations": iterations,
+        "operation": "closing"
+    }
+
 @app.post("/api/closing")
 async def closing_image(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     kernel_size: int = Form(5),
     iterations: int = Form(1)
 ):
     """Apply morphological closing (dilation followed by erosion)"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Create structuring element
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-        
-        # Apply closing
-        closed = cv2.morphologyEx(gray_image, cv2.MORPH_CLOSE, kernel, iterations=iterations)
-        
-        # Convert back to 3-channel
-        result_image = cv2.cvtColor(closed, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "kernel_size": kernel_size,
-            "iterations": iterations,
-            "operation": "closing"
-        }
+        return await output.run_operation("closing", image, kernel_size=kernel_size, iterations=iterations)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@operation("edge-detection", scaled_params=("blur_size",), gray_input=True)
+def op_edge_detection(
+    image: np.ndarray,
+    low_threshold: int = 50,
+    high_threshold: int = 150,
+    aperture_size: int = 3,
+    l2_gradient: bool = False,
+    blur_size: int = 5
+):
+    """Apply Canny edge detection"""
+    gray_image = as_gray(image)
+
+    # Apply Gaussian blur to reduce noise
+    blurred = cv2.GaussianBlur(gray_image, (blur_size, blur_size), 0)
+
+    # Apply Canny edge detection
+    edges = cv2.Canny(blurred, low_threshold, high_threshold,
+                     apertureSize=aperture_size, L2gradient=l2_gradient)
+
+    return edges, {
+        "low_threshold": low_threshold,
+        "high_threshold": high_threshold,
+        "aperture_size": aperture_size,
+        "l2_gradient": l2_gradient,
+        "operation": "edge_detection"
+    }
+
 @app.post("/api/edge-detection")
 async def edge_detection(
-    image_data: str = Form(...),
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
     low_threshold: int = Form(50),
     high_threshold: int = Form(150),
     aperture_size: int = Form(3),
-    l2_gradient: bool = Form(False)
+    l2_gradient: bool = Form(False),
+    preview_size: Optional[int] = Depends(preview_options)
 ):
     """Apply Canny edge detection"""
     try:
-        image = decode_base64_image(image_data)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray_image, (5, 5), 0)
-        
-        # Apply Canny edge detection
-        edges = cv2.Canny(blurred, low_threshold, high_threshold, 
-                         apertureSize=aperture_size, L2gradient=l2_gradient)
-        
-        # Convert to 3-channel for display
-        result_image = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-        
-        return {
-            "processed_image": encode_image_to_base64(result_image),
-            "low_threshold": low_threshold,
-            "high_threshold": high_threshold,
-            "aperture_size": aperture_size,
-            "l2_gradient": l2_gradient,
-            "operation": "edge_detection"
+        return await output.run_operation("edge-detection", image, preview_size=preview_size, low_threshold=low_threshold, high_threshold=high_threshold, aperture_size=aperture_size, l2_gradient=l2_gradient)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# PIPELINE
+
+
+def run_pipeline_steps(image: np.ndarray, bound: list):
+    """Apply bound (name, fn, kwargs, emit) steps in order on one image.
+
+    Runs of consecutive point operations are fused into one lookup table
+    pass, and runs of geometric operations into one warp; an emitted step
+    ends its run so its result can be returned.
+    """
+    current = image
+    images = {}
+    step_info = []
+
+    index = 0
+    while index < len(bound):
+        run = []
+        geometry_run = []
+        for name, fn, kwargs, emit in bound[index:]:
+            arguments = operation_arguments(fn, **kwargs)
+            if fn.point is None or not fn.point(arguments):
+                break
+            run.append((fn, arguments))
+            if emit:
+                break
+        if not run:
+            for name, fn, kwargs, emit in bound[index:]:
+                if fn.geometry is None:
+                    break
+                geometry_run.append((fn, operation_arguments(fn, **kwargs)))
+                if emit:
+                    break
+
+        if run:
+            current, infos = run_point_operations(current, run)
+            step_info.extend(infos)
+            index += len(run)
+        elif len(geometry_run) > 1:
+            current, infos = run_geometry_operations(current, geometry_run)
+            step_info.extend(infos)
+            index += len(geometry_run)
+        else:
+            current, info = apply_operation(bound[index][1], current, **bound[index][2])
+            step_info.append(info)
+            index += 1
+
+        if bound[index - 1][3]:
+            images[f"step_{index - 1}"] = as_bgr(current)
+
+    images["processed_image"] = as_bgr(current)
+    return images, step_info
+
+
+def run_pipeline_on_region(image: np.ndarray, bound: list, roi: RegionOfInterest):
+    """Run bound pipeline steps on a region of interest only; the halos of the steps add up"""
+    halo = 0
+    for _, fn, kwargs, _ in bound:
+        step_halo = operation_halo(fn, operation_arguments(fn, **kwargs))
+        if step_halo is None:
+            halo = None
+            break
+        halo += step_halo
+    return run_on_region(lambda region: run_pipeline_steps(region, bound), image, roi, halo)
+
+@app.post("/api/pipeline")
+async def run_pipeline(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    steps: str = Form(...)  # JSON array of {"operation", "params", "emit"} objects
+):
+    """Run a chain of operations in memory with a single decode and encode.
+
+    Only the final result is encoded, plus the intermediate result of every
+    step marked with ``"emit": true`` (returned as ``step_<index>``).
+    """
+    try:
+        steps_list = json.loads(steps)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid steps JSON: {e}")
+
+    if not isinstance(steps_list, list) or not steps_list:
+        raise HTTPException(status_code=400, detail="steps must be a non-empty list")
+    if len(steps_list) > MAX_PIPELINE_STEPS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PIPELINE_STEPS} steps are allowed")
+
+    # Validate the whole chain before running any of it
+    bound = []
+    for step in steps_list:
+        if not isinstance(step, dict) or "operation" not in step:
+            raise HTTPException(status_code=400, detail="Each step needs an operation")
+        fn, kwargs = bind_operation(step["operation"], step.get("params"))
+        bound.append((step["operation"], fn, kwargs, bool(step.get("emit", False))))
+
+    try:
+        metadata = {}
+        if output.roi is not None:
+            images, step_info, metadata["roi"] = await output.run(run_pipeline_on_region, image, bound, output.roi)
+        else:
+            images, step_info = await cpu_pool.run(run_pipeline_steps, image, bound)
+
+        return await output.respond(images, {
+            "steps": step_info,
+            "total_steps": len(bound),
+            "operation": "pipeline",
+            **metadata
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in pipeline: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# VARIANTS
+
+MAX_VARIANTS = 32
+CONTACT_SHEET_LABEL_HEIGHT = 24
+
+
+def build_contact_sheet(images: list, labels: list, cell_size: int, columns: int) -> np.ndarray:
+    """Lay images out on a grid of labelled cell_size squares, each scaled down to fit"""
+    rows = -(-len(images) // columns)
+    row_height = cell_size + CONTACT_SHEET_LABEL_HEIGHT
+    sheet = np.full((rows * row_height, columns * cell_size, 3), 32, dtype=np.uint8)
+
+    for index, (image, label) in enumerate(zip(images, labels)):
+        row, column = divmod(index, columns)
+        top, left = row * row_height, column * cell_size
+
+        height, width = image.shape[:2]
+        scale = min(cell_size / width, cell_size / height, 1.0)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if scale < 1.0:
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+        y = top + CONTACT_SHEET_LABEL_HEIGHT + (cell_size - size[1]) // 2
+        x = left + (cell_size - size[0]) // 2
+        sheet[y:y + size[1], x:x + size[0]] = as_bgr(image)
+        cv2.putText(sheet, label[:48], (left + 6, top + 17), cv2.FONT_HERSHEY_SIMPLEX, 0.45,
+                    (230, 230, 230), 1, cv2.LINE_AA)
+
+    return sheet
+
+@app.post("/api/variants")
+async def render_variants(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    variants: str = Form(...),  # JSON array of {"operation", "params", "label"} objects
+    contact_sheet: bool = Form(False),
+    cell_size: int = Form(320),
+    columns: int = Form(0)
+):
+    """Render several operations or parameterisations of one image in parallel.
+
+    The input is decoded once, and converted to grayscale once for all the
+    variants whose operation works on gray. Results are returned as
+    ``variant_<index>``, or laid out on one labelled ``contact_sheet``.
+    """
+    try:
+        variants_list = json.loads(variants)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid variants JSON: {e}")
+
+    if not isinstance(variants_list, list) or not variants_list:
+        raise HTTPException(status_code=400, detail="variants must be a non-empty list")
+    if len(variants_list) > MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_VARIANTS} variants are allowed")
+    if not 32 <= cell_size <= 2048:
+        raise HTTPException(status_code=400, detail="cell_size must be between 32 and 2048")
+
+    bound = []
+    for variant in variants_list:
+        if not isinstance(variant, dict) or "operation" not in variant:
+            raise HTTPException(status_code=400, detail="Each variant needs an operation")
+        fn, kwargs = bind_operation(variant["operation"], variant.get("params"))
+        label = variant.get("label") or " ".join(
+            [variant["operation"]] + [f"{key}={value}" for key, value in kwargs.items()]
+        )
+        bound.append((variant["operation"], fn, kwargs, str(label)))
+
+    try:
+        gray_image = None
+        # A selection is blended back into the colour frame, so it cannot start from the shared gray copy
+        if image.ndim == 3 and output.roi is None and any(fn.gray_input for _, fn, _, _ in bound):
+            gray_image = await cpu_pool.run(as_gray, image)
+
+        results = await asyncio.gather(*(
+            output.run(
+                display_operation, fn, gray_image if fn.gray_input and gray_image is not None else image,
+                roi=output.roi, **kwargs
+            )
+            for _, fn, kwargs, _ in bound
+        ))
+
+        metadata = {
+            "variants": [
+                {"label": label, **info} for (_, _, _, label), (_, info) in zip(bound, results)
+            ],
+            "total_variants": len(bound),
+            "operation": "variants"
+        }
+
+        if contact_sheet:
+            columns = columns if columns > 0 else int(np.ceil(np.sqrt(len(bound))))
+            sheet = await cpu_pool.run(
+                build_contact_sheet, [result for result, _ in results], [label for *_, label in bound], cell_size, columns
+            )
+            metadata["layout"] = {
+                "columns": columns,
+                "cell_size": cell_size,
+                "label_height": CONTACT_SHEET_LABEL_HEIGHT
+            }
+            return await output.respond({"contact_sheet": sheet}, metadata)
+
+        return await output.respond(
+            {f"variant_{index}": result for index, (result, _) in enumerate(results)}, metadata
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rendering variants: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# PARAMETER SWEEPS
+
+MAX_SWEEP_CELLS = 64
+
+# Operations that can be swept, and the parameters that may vary across the grid
+SWEEP_PARAMS = {
+    "edge-detection": ("low_threshold", "high_threshold"),
+    "adaptive-threshold": ("block_size", "c")
+}
+
+
+def sweep_values(name: str, spec) -> list:
+    """Expand a sweep axis: a list of values, or {"start", "stop", "step"} with stop included"""
+    if isinstance(spec, dict):
+        try:
+            start, stop, step = float(spec["start"]), float(spec["stop"]), float(spec.get("step", 1))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Range for {name} needs numeric start and stop")
+        if not step or (stop - start) / step < 0:
+            raise HTTPException(status_code=400, detail=f"Invalid step for {name}")
+        count = int((stop - start) / step + 1e-9) + 1
+        if count > MAX_SWEEP_CELLS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_SWEEP_CELLS} cells are allowed")
+        values = [start + index * step for index in range(count)]
+    elif isinstance(spec, list):
+        values = spec
+    else:
+        raise HTTPException(status_code=400, detail=f"Range for {name} must be a list or a start/stop/step object")
+
+    if not values:
+        raise HTTPException(status_code=400, detail=f"Range for {name} is empty")
+    return values
+
+
+def canny_sweep_source(gray_image: np.ndarray, blur_size: int, aperture_size: int):
+    """Work shared by every Canny cell: the pre-blur and, for 3x3 and 5x5 apertures, the gradients.
+
+    cv2.Canny computes the same BORDER_REPLICATE Sobel derivatives internally,
+    so cells built from them match /api/edge-detection exactly. 7x7 apertures
+    rescale the thresholds inside Canny, so those cells start from the blur.
+    """
+    blurred = cv2.GaussianBlur(gray_image, (blur_size, blur_size), 0)
+    if aperture_size == 7:
+        return blurred, None
+    dx = cv2.Sobel(blurred, cv2.CV_16S, 1, 0, ksize=aperture_size, borderType=cv2.BORDER_REPLICATE)
+    dy = cv2.Sobel(blurred, cv2.CV_16S, 0, 1, ksize=aperture_size, borderType=cv2.BORDER_REPLICATE)
+    return dx, dy
+
+
+def canny_sweep_cell(source: tuple, low_threshold: int, high_threshold: int, aperture_size: int, l2_gradient: bool):
+    dx, dy = source
+    if dy is None:
+        return cv2.Canny(dx, low_threshold, high_threshold, apertureSize=aperture_size, L2gradient=l2_gradient)
+    return cv2.Canny(dx, dy, low_threshold, high_threshold, L2gradient=l2_gradient)
+
+
+def adaptive_sweep_source(gray_image: np.ndarray, block_size: int, adaptive_method: str):
+    """Work shared by every mean adaptive-threshold cell of one block size: source minus local mean.
+
+    This is the comparison cv2.adaptiveThreshold makes, so only the offset c
+    is left per cell. The Gaussian mean is computed differently across OpenCV
+    versions, so Gaussian cells run cv2.adaptiveThreshold on the shared gray.
+    """
+    if adaptive_method != "mean":
+        return gray_image
+    mean = cv2.boxFilter(gray_image, -1, (block_size, block_size), normalize=True,
+                         borderType=cv2.BORDER_REPLICATE | cv2.BORDER_ISOLATED)
+    return cv2.subtract(gray_image, mean, dtype=cv2.CV_16S)
+
+
+def adaptive_sweep_cell(source: np.ndarray, max_value: int, adaptive_method: str, threshold_type: str, block_size: int, c: int):
+    if adaptive_method != "mean":
+        return op_adaptive_threshold(source, max_value, adaptive_method, threshold_type, block_size, c)[0]
+
+    # Same integer rounding of c as cv2.adaptiveThreshold
+    if threshold_type == "binary_inv":
+        passed = source <= -int(np.floor(c))
+    else:
+        passed = source > -int(np.ceil(c))
+    return np.where(passed, np.uint8(min(max(max_value, 0), 255)), np.uint8(0))
+
+
+def fit_cell(image: np.ndarray, cell_size: int) -> np.ndarray:
+    """Scale a cell down so its longest side is at most cell_size (0 keeps it full size), as BGR for display"""
+    height, width = image.shape[:2]
+    scale = cell_size / max(height, width) if cell_size else 1.0
+    if scale < 1.0:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return as_bgr(image)
+
+@app.post("/api/sweep")
+async def sweep_parameters(
+    output: ImageOutput = Depends(image_output),
+    image: np.ndarray = Depends(input_image),
+    operation: str = Form(...),  # edge-detection or adaptive-threshold
+    ranges: str = Form(...),  # JSON object: parameter -> list of values or {"start", "stop", "step"}
+    params: str = Form("{}"),  # JSON object of fixed parameters
+    cell_size: int = Form(0),
+    contact_sheet: bool = Form(False)
+):
+    """Evaluate a grid of parameter values for Canny or adaptive thresholding.
+
+    One or two parameters vary (rows follow the first, columns the second).
+    The grayscale conversion and the work shared by every cell are computed
+    once, cells are evaluated in parallel and optionally scaled down to
+    ``cell_size``, and come back as ``cell_<row>_<column>`` or on a contact sheet.
+    """
+    output.reject_roi("/api/sweep")
+    if operation not in SWEEP_PARAMS:
+        raise HTTPException(status_code=400, detail=f"operation must be one of: {', '.join(SWEEP_PARAMS)}")
+    try:
+        ranges_dict = json.loads(ranges)
+        params_dict = json.loads(params)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid sweep JSON: {e}")
+    if not isinstance(ranges_dict, dict) or not 1 <= len(ranges_dict) <= 2 or not isinstance(params_dict, dict):
+        raise HTTPException(status_code=400, detail="ranges must name one or two parameters")
+
+    unknown = set(ranges_dict) - set(SWEEP_PARAMS[operation])
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{operation} can sweep {', '.join(SWEEP_PARAMS[operation])}, not {', '.join(sorted(unknown))}"
+        )
+    if cell_size < 0:
+        raise HTTPException(status_code=400, detail="cell_size must not be negative")
+
+    axes = [(name, sweep_values(name, spec)) for name, spec in ranges_dict.items()]
+    if len(axes) == 1:
+        axes.append((None, [None]))
+    (row_name, row_values), (column_name, column_values) = axes
+    if len(row_values) * len(column_values) > MAX_SWEEP_CELLS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SWEEP_CELLS} cells are allowed")
+
+    # Bind every cell up front, so type errors are reported before any work starts
+    grid = []
+    for row_value in row_values:
+        for column_value in column_values:
+            cell_params = {**params_dict, row_name: row_value}
+            if column_name is not None:
+                cell_params[column_name] = column_value
+            fn, kwargs = bind_operation(operation, cell_params)
+            grid.append(operation_arguments(fn, **kwargs))
+
+    try:
+        gray_image = await cpu_pool.run(as_gray, image)
+
+        if operation == "edge-detection":
+            fixed = grid[0]
+            source = await cpu_pool.run(canny_sweep_source, gray_image, fixed["blur_size"], fixed["aperture_size"])
+            cells = await asyncio.gather(*(
+                cpu_pool.run(canny_sweep_cell, source, args["low_threshold"], args["high_threshold"],
+                             args["aperture_size"], args["l2_gradient"])
+                for args in grid
+            ))
+        else:
+            for args in grid:
+                # Normalise block sizes the way op_adaptive_threshold does
+                args["block_size"] = max(3, args["block_size"] + 1 if args["block_size"] % 2 == 0 else args["block_size"])
+            block_sizes = sorted({args["block_size"] for args in grid})
+            sources = dict(zip(block_sizes, await asyncio.gather(*(
+                cpu_pool.run(adaptive_sweep_source, gray_image, block_size, grid[0]["adaptive_method"])
+                for block_size in block_sizes
+            ))))
+            cells = await asyncio.gather(*(
+                cpu_pool.run(adaptive_sweep_cell, sources[args["block_size"]], args["max_value"],
+                             args["adaptive_method"], args["threshold_type"], args["block_size"], args["c"])
+                for args in grid
+            ))
+
+        cells = await asyncio.gather(*(cpu_pool.run(fit_cell, cell, cell_size) for cell in cells))
+
+        metadata = {
+            "rows": {"parameter": row_name, "values": row_values},
+            "columns": {"parameter": column_name, "values": column_values if column_name else []},
+            "params": {key: value for key, value in grid[0].items() if key not in (row_name, column_name)},
+            "operation": f"sweep_{operation.replace('-', '_')}"
         }
+
+        if contact_sheet:
+            labels = [" ".join(f"{key}={args[key]}" for key in (row_name, column_name) if key) for args in grid]
+            sheet = await cpu_pool.run(
+                build_contact_sheet, cells, labels, cell_size or max(image.shape[:2]), len(column_values)
+            )
+            return await output.respond({"contact_sheet": sheet}, metadata)
+
+        return await output.respond({
+            f"cell_{index // len(column_values)}_{index % len(column_values)}": cell
+            for index, cell in enumerate(cells)
+        }, metadata)
     except Exception as e:
+        logger.error(f"Error in parameter sweep: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# INTERACTIVE SESSIONS
+
+# Totals over all interactive sessions, reported by /health
+session_totals = {"open": 0, "updates": 0, "replaced": 0, "cancelled": 0, "discarded": 0, "frames": 0}
+
+
+class InteractiveSession:
+    """Latest-wins parameter updates for one image.
+
+    Only the newest update not yet started is kept: an update still waiting
+    when a newer one arrives is replaced. A computation that goes stale is
+    cancelled if it is still queued in the CPU pool; one already running is
+    left to finish, so a session holds at most one pool job, and its result is
+    discarded before it is encoded or sent.
+    """
+
+    def __init__(self):
+        self.latest = None  # newest update not yet started
+        self.sequence = 0  # updates received so far
+        self.closed = False
+        self.updated = asyncio.Event()
+
+    def push(self, update: dict):
+        if self.latest is not None:
+            session_totals["replaced"] += 1
+        self.latest = update
+        self.sequence += 1
+        session_totals["updates"] += 1
+        self.updated.set()
+
+    def close(self):
+        self.closed = True
+        self.updated.set()
+
+    async def next(self) -> Optional[tuple]:
+        """(sequence, update) of the newest update, or None once the client is gone"""
+        while self.latest is None and not self.closed:
+            await self.updated.wait()
+            self.updated.clear()
+        if self.closed:
+            return None
+        # Updates may have arrived before this call; outcome() must only wake for newer ones
+        self.updated.clear()
+        update, self.latest = self.latest, None
+        return self.sequence, update
+
+    def stale(self, sequence: int) -> bool:
+        return self.closed or self.sequence != sequence
+
+    async def outcome(self, job, sequence: int):
+        """Result of a pool job, or None when a newer update made it stale"""
+        result = asyncio.wrap_future(job)
+        newer = asyncio.ensure_future(self.updated.wait())
+        try:
+            await asyncio.wait({result, newer}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            newer.cancel()
+
+        if self.stale(sequence) and job.cancel():
+            session_totals["cancelled"] += 1
+            return None
+        value = await result
+        if self.stale(sequence):
+            session_totals["discarded"] += 1
+            return None
+        return value
+
+
+async def receive_session_updates(websocket: WebSocket, session: InteractiveSession):
+    try:
+        while True:
+            session.push(await websocket.receive_json())
+    except (WebSocketDisconnect, ValueError):
+        pass
+    finally:
+        session.close()
+
+
+async def session_frame(websocket: WebSocket, session: InteractiveSession, image_id: str,
+                        policy: OutputPolicy, sequence: int, update: dict):
+    """Process one update and send its frame, unless a newer update overtakes it"""
+    name = update.get("operation")
+    fn, kwargs = bind_operation(name, update.get("params"))
+    preview_size = None
+    if update.get("preview"):
+        preview_size = int(update.get("preview_max_size", PREVIEW_MAX_SIZE))
+        if preview_size < 16:
+            raise HTTPException(status_code=400, detail="preview_max_size must be at least 16")
+    roi = RegionOfInterest(parse_roi_rect(update["roi"])) if update.get("roi") else None
+
+    image = image_store.get(image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id, please reload the image")
+
+    # Same key as a POST with this image_id, so sessions and endpoints share results
+    digest = image_store.digest(image_id)
+    cache_key = operation_cache_key(digest and f"{digest}@1/L0", name, kwargs, policy, preview_size, roi)
+    cached = result_cache.get(cache_key) if cache_key is not None else None
+
+    if cached is not None:
+        encoded, metadata, encoding = cached
+        cache_status = "HIT"
+    else:
+        if preview_size:
+            source_size = (image.shape[1], image.shape[0])
+            level = image_store.closest_level(image_id, preview_size)
+            if level > 0:
+                image = await stored_level(image_id, level)
+            job = cpu_pool.submit(preview_operation, fn, image, preview_size, source_size, roi=roi, **kwargs)
+        else:
+            job = cpu_pool.submit(display_operation, fn, image, roi=roi, **kwargs)
+
+        result = await session.outcome(job, sequence)
+        if result is None:
+            return
+        result_image, metadata = result
+
+        started = time.perf_counter()
+        encoded = {"processed_image": await cpu_pool.run(encode_image, result_image, policy)}
+        encoding = {
+            **policy.describe(),
+            "sizes": {"processed_image": len(encoded["processed_image"])},
+            "encode_ms": round((time.perf_counter() - started) * 1000, 2)
+        }
+        if cache_key is not None:
+            result_cache.put(cache_key, encoded, metadata, encoding)
+        cache_status = "MISS"
+
+    if session.stale(sequence):
+        session_totals["discarded"] += 1
+        return
+    await websocket.send_text(json_header({
+        "type": "frame",
+        "seq": update.get("seq"),
+        **metadata,
+        "encoding": encoding,
+        "cache": cache_status
+    }))
+    await websocket.send_bytes(encoded["processed_image"])
+    session_totals["frames"] += 1
+
+
+@app.websocket("/api/session/{image_id}")
+async def interactive_session(websocket: WebSocket, image_id: str):
+    """Interactive editing of a loaded image over one WebSocket.
+
+    The client sends JSON updates: {"operation": "threshold", "params": {...},
+    "preview": true, "preview_max_size": 1280, "seq": 17}, optionally with a
+    "roi": {"x", "y", "width", "height"} rectangle. Only the newest
+    update is processed (see InteractiveSession), and each processed update is
+    answered with a JSON {"type": "frame", "seq": 17, ...metadata} message
+    followed by a binary message holding the encoded result. Results come from
+    and go to the result cache like the equivalent POST requests. The output
+    policy is taken from the output_format, output_quality and png_compression
+    query parameters.
+    """
+    await websocket.accept()
+    if image_store.get(image_id) is None:
+        await websocket.close(code=1008, reason="Unknown or expired image_id, please reload the image")
+        return
+
+    query = websocket.query_params
+    try:
+        policy = DEFAULT_OUTPUT_POLICY
+        if any(key in query for key in ("output_format", "output_quality", "png_compression")):
+            policy = OutputPolicy(
+                query.get("output_format", policy.output_format),
+                int(query.get("output_quality", policy.quality)),
+                int(query.get("png_compression", policy.png_compression))
+            )
+    except (HTTPException, ValueError) as e:
+        await websocket.close(code=1008, reason=getattr(e, "detail", str(e)))
+        return
+
+    session = InteractiveSession()
+    reader = asyncio.create_task(receive_session_updates(websocket, session))
+    session_totals["open"] += 1
+    try:
+        while True:
+            latest = await session.next()
+            if latest is None:
+                break
+            sequence, update = latest
+            try:
+                await session_frame(websocket, session, image_id, policy, sequence, update)
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "seq": update.get("seq"), "detail": e.detail})
+            except (AttributeError, ValueError, TypeError) as e:
+                await websocket.send_json({"type": "error", "detail": f"Invalid update: {str(e)}"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Error in interactive session: {str(e)}")
+        await websocket.close(code=1011)
+    finally:
+        session_totals["open"] -= 1
+        reader.cancel()
+
+
 #
 # BATCH PROCESSING
 
@@ -1225,11 +4508,20 @@ async def edge_detection(
 async def batch_process(
     files: List[UploadFile] = File(...),
     operation: str = Form(...),
-    parameters: str = Form(default="{}")
+    parameters: str = Form(default="{}"),
+    thumbnail_size: int = Form(0),  # > 0: return thumbnails of at most this many pixels per side
+    policy: OutputPolicy = Depends(thumbnail_policy)
 ):
-    """Process multiple images with the same operation"""
+    """Process multiple images with the same operation.
+
+    In thumbnail mode each file is decoded at the smallest sufficient scale,
+    processed as a preview proxy (kernel sizes scaled to match) and returned
+    as a small JPEG or WebP.
+    """
+    if thumbnail_size and not 16 <= thumbnail_size <= 2048:
+        raise HTTPException(status_code=400, detail="thumbnail_size must be between 16 and 2048")
+
     try:
-        import json
         params = json.loads(parameters) if parameters else {}
         results = []
         
@@ -1237,8 +4529,9 @@ async def batch_process(
             try:
                 # Read file content
                 contents = await file.read()
+                decode_scale = thumbnail_decode_scale(contents, thumbnail_size) if thumbnail_size else 1
                 nparr = np.frombuffer(contents, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+                image = await cpu_pool.run(cv2.imdecode, nparr, DECODE_FLAGS[decode_scale])
                 
                 if image is None:
                     results.append({
@@ -1248,26 +4541,27 @@ async def batch_process(
                     })
                     continue
                 
-                # Apply the operation based on type
+                # Apply the operation through the shared registry
                 processed_image = None
-                if operation == "grayscale":
-                    processed_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                elif operation == "blur":
-                    blur_type = params.get("blur_type", "gaussian")
-                    kernel_size = int(params.get("kernel_size", 15))
-                    if blur_type == "gaussian":
-                        processed_image = cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
-                    elif blur_type == "median":
-                        processed_image = cv2.medianBlur(image, kernel_size)
-                # Add more operations as needed
+                if operation in OPERATIONS:
+                    fn, kwargs = bind_operation(operation, params, strict=False)
+                    if thumbnail_size:
+                        # Kernel sizes are scaled against the full-resolution size the reduced decode stands for
+                        source_size = (image.shape[1] * decode_scale, image.shape[0] * decode_scale)
+                        processed_image, _ = await cpu_pool.run(preview_operation, fn, image, thumbnail_size, source_size, **kwargs)
+                    else:
+                        processed_image, _ = await cpu_pool.run(display_operation, fn, image, **kwargs)
                 
                 if processed_image is not None:
-                    results.append({
+                    result = {
                         "filename": file.filename,
                         "status": "success",
-                        "image": encode_image_to_base64(processed_image),
+                        "image": await cpu_pool.run(encode_image_to_base64, processed_image, policy if thumbnail_size else None),
                         "operation": operation
-                    })
+                    }
+                    if thumbnail_size:
+                        result["thumbnail"] = {"width": int(processed_image.shape[1]), "height": int(processed_image.shape[0]), "format": policy.output_format}
+                    results.append(result)
                 else:
                     results.append({
                         "filename": file.filename,
@@ -119,6 +119,229 @@ class ImageProcessingService {
     }
   }
 
+  // Apply an operation to a selection only: roi is {x, y, width, height} in image
+  // pixels, roiMask an optional base64 grayscale mask (white selects)
+  async processRegion(operation, imageData, roi, parameters = {}, roiMask = null) {
+    const regionParameters = { ...parameters };
+    if (roi) regionParameters.roi = JSON.stringify(roi);
+    if (roiMask) regionParameters.roi_mask = roiMask;
+    return this.processImage(operation, imageData, regionParameters);
+  }
+
+  // Process an image previously uploaded through loadImage, referenced by its image_id
+  async processStoredImage(operation, imageId, parameters = {}) {
+    try {
+      const formData = new FormData();
+      formData.append("image_id", imageId);
+
+      Object.entries(parameters).forEach(([key, value]) => {
+        formData.append(key, value);
+      });
+
+      const response = await this.api.post(`/api/${operation}`, formData, {
+        headers: {
+          "Content-Type": "multipart/form-data",
+        },
+      });
+
+      return response.data;
+    } catch (error) {
+      console.error(`Error processing ${operation}:`, error);
+      throw new Error(
+        error.response?.data?.detail || `Processing failed: ${error.message}`
+      );
+    }
+  }
+
+  // Binary transport: upload a File/Blob and receive the processed PNG as a Blob,
+  // with the operation metadata parsed from the X-Image-Metadata header
+  async processImageBinary(operation, imageBlob, parameters = {}) {
+    try {
+      const formData = new FormData();
+      formData.append("image_file", imageBlob);
+
+      Object.entries(parameters).forEach(([key, value]) => {
+        formData.append(key, value);
+      });
+
+      const response = await this.api.post(`/api/${operation}`, formData, {
+        headers: {
+          "Content-Type": "multipart/form-data",
+          Accept: "image/png",
+        },
+        responseType: "blob",
+      });
+
+      const metadata = response.headers["x-image-metadata"];
+      return {
+        image: response.data,
+        metadata: metadata ? JSON.parse(metadata) : {},
+      };
+    } catch (error) {
+      console.error(`Error processing ${operation}:`, error);
+      throw new Error(`Processing failed: ${error.message}`);
+    }
+  }
+
+  async releaseImage(imageId) {
+    try {
+      const response = await this.api.delete(`/api/images/${imageId}`);
+      return response.data;
+    } catch (error) {
+      console.warn("Error releasing image:", error);
+      return null;
+    }
+  }
+
+  // Annotation layer of a loaded image: each call draws only the new primitives
+  // and returns a `patch` image to paste at dirty.x / dirty.y over the current view
+  async addAnnotations(imageId, { shapes = [], strokes = [], texts = [] } = {}) {
+    return this.postAnnotations(`/api/annotations/${imageId}`, {
+      shapes: JSON.stringify(shapes),
+      strokes: JSON.stringify(strokes),
+      texts: JSON.stringify(texts),
+    });
+  }
+
+  // Full image with the annotations composited, or the RGBA layer alone
+  async exportAnnotations(imageId, layerOnly = false) {
+    return this.postAnnotations(`/api/annotations/${imageId}/export`, {
+      layer_only: layerOnly,
+    });
+  }
+
+  // Live freehand drawing: points are sent as they are drawn and onPatch receives
+  // ({ dirty, blob }) with the repainted region for each batch the server draws
+  openStrokeStream(imageId, onPatch) {
+    const socket = new WebSocket(
+      `${BACKEND_URL.replace(/^http/, "ws")}/api/annotations/${imageId}/stream`
+    );
+    socket.binaryType = "blob";
+    const pending = [];
+    let header = null;
+
+    socket.onmessage = (event) => {
+      if (typeof event.data !== "string") {
+        onPatch({ dirty: header.dirty, blob: event.data });
+        return;
+      }
+      const message = JSON.parse(event.data);
+      if (message.type === "patch") {
+        header = message;
+      } else if (message.type === "error") {
+        console.warn("Stroke stream error:", message.detail);
+      }
+    };
+    const send = (message) => {
+      if (socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify(message));
+      } else {
+        pending.push(message);
+      }
+    };
+    socket.onopen = () => pending.splice(0).forEach(send);
+
+    return {
+      begin: (color = [255, 255, 255], thickness = 2) =>
+        send({ type: "begin", color, thickness }),
+      // points: [{ x, y }, ...] drawn since the last call
+      addPoints: (points) =>
+        send({ type: "points", points: points.flatMap(({ x, y }) => [x, y]) }),
+      end: () => send({ type: "end" }),
+      close: () => socket.close(),
+    };
+  }
+
+  // Interactive editing of a loaded image: send an update on every slider tick and
+  // the server processes only the newest one. onFrame receives ({ metadata, blob })
+  // for each result and onError the detail of rejected updates.
+  openSession(imageId, onFrame, onError = console.warn) {
+    const socket = new WebSocket(
+      `${BACKEND_URL.replace(/^http/, "ws")}/api/session/${imageId}`
+    );
+    socket.binaryType = "blob";
+    let pending = null;
+    let metadata = null;
+    let seq = 0;
+
+    socket.onmessage = (event) => {
+      if (typeof event.data !== "string") {
+        // Frames can still arrive for updates the client has since replaced
+        if (metadata.seq === seq) onFrame({ metadata, blob: event.data });
+        return;
+      }
+      const message = JSON.parse(event.data);
+      if (message.type === "frame") {
+        metadata = message;
+      } else if (message.type === "error") {
+        onError(message.detail);
+      }
+    };
+    // Updates made before the socket opens collapse into the latest one
+    socket.onopen = () => {
+      if (pending) socket.send(JSON.stringify(pending));
+      pending = null;
+    };
+
+    return {
+      update: (operation, params = {}, { preview = false, previewMaxSize, roi } = {}) => {
+        const message = { operation, params, preview, seq: ++seq };
+        if (previewMaxSize) message.preview_max_size = previewMaxSize;
+        if (roi) message.roi = roi;
+        if (socket.readyState === WebSocket.OPEN) {
+          socket.send(JSON.stringify(message));
+        } else {
+          pending = message;
+        }
+      },
+      close: () => socket.close(),
+    };
+  }
+
+  async clearAnnotations(imageId) {
+    const response = await this.api.delete(`/api/annotations/${imageId}`);
+    return response.data;
+  }
+
+  async postAnnotations(url, parameters) {
+    try {
+      const formData = new FormData();
+      Object.entries(parameters).forEach(([key, value]) => {
+        formData.append(key, value);
+      });
+
+      const response = await this.api.post(url, formData, {
+        headers: {
+          "Content-Type": "multipart/form-data",
+        },
+      });
+
+      return response.data;
+    } catch (error) {
+      console.error("Error updating annotations:", error);
+      throw new Error(
+        error.response?.data?.detail || `Annotation failed: ${error.message}`
+      );
+    }
+  }
+
+  // Chain several operations server-side with a single decode and encode.
+  // steps: [{ operation: "blur", params: { kernel_size: 5 }, emit: false }, ...]
+  async runPipeline(imageData, steps) {
+    return this.processImage("pipeline", imageData, {
+      steps: JSON.stringify(steps),
+    });
+  }
+
+  // Render several [{ operation, params, label }] variants of one image,
+  // optionally laid out on a single contact sheet
+  async renderVariants(imageData, variants, contactSheet = false) {
+    return this.processImage("variants", imageData, {
+      variants: JSON.stringify(variants),
+      contact_sheet: contactSheet,
+    });
+  }
+
   async loadImage(file) {
     try {
       const formData = new FormData();
@@ -139,6 +362,29 @@ class ImageProcessingService {
     }
   }
 
+  // Small preview of a File/Blob, decoded at reduced scale and cached server-side
+  async getThumbnail(file, maxSize = 256, format = "jpeg") {
+    try {
+      const formData = new FormData();
+      formData.append("file", file);
+      formData.append("max_size", maxSize);
+      formData.append("thumbnail_format", format);
+
+      const response = await this.api.post("/api/thumbnail", formData, {
+        headers: {
+          "Content-Type": "multipart/form-data",
+        },
+      });
+
+      return `data:image/${format};base64,${response.data.thumbnail}`;
+    } catch (error) {
+      console.error("Error creating thumbnail:", error);
+      throw new Error(
+        error.response?.data?.detail || `Thumbnail failed: ${error.message}`
+      );
+    }
+  }
+
   async getDimensions(imageData) {
     try {
       const formData = new FormData();
@@ -160,7 +406,7 @@ class ImageProcessingService {
     }
   }
 
-  async batchProcess(files, operation, parameters = {}) {
+  async batchProcess(files, operation, parameters = {}, thumbnailSize = 0) {
     try {
       console.log(
         `Starting batch processing: ${files.length} files with ${operation}`
@@ -211,6 +457,11 @@ class ImageProcessingService {
       // Also include parameters as JSON for backward compatibility
       formData.append("parameters", JSON.stringify(parameters));
 
+      // Small JPEG previews instead of full-resolution PNGs
+      if (thumbnailSize > 0) {
+        formData.append("thumbnail_size", thumbnailSize);
+      }
+
       console.log("Sending batch request with operation:", operation);
       console.log("Parameters being sent:", parameters);
 
@@ -258,6 +509,54 @@ class ImageProcessingService {
     return new Blob([byteArray], { type: mimeType });
   }
 
+  // Colour one compact single-channel plane on a canvas: each pixel becomes
+  // value * tint / 255, or palette[value] when a 256-entry palette is given
+  colorizeChannelPlane(base64Plane, { tint, palette }) {
+    return new Promise((resolve, reject) => {
+      const img = new Image();
+
+      img.onload = () => {
+        const canvas = document.createElement("canvas");
+        canvas.width = img.width;
+        canvas.height = img.height;
+        const ctx = canvas.getContext("2d");
+        ctx.drawImage(img, 0, 0);
+
+        const pixels = ctx.getImageData(0, 0, img.width, img.height);
+        const data = pixels.data;
+        for (let i = 0; i < data.length; i += 4) {
+          const value = data[i];
+          const color = palette
+            ? palette[value]
+            : tint.map((channel) => (value * channel) / 255);
+          data[i] = color[0];
+          data[i + 1] = color[1];
+          data[i + 2] = color[2];
+        }
+        ctx.putImageData(pixels, 0, 0);
+
+        resolve(canvas.toDataURL("image/png").split(",")[1]);
+      };
+      img.onerror = reject;
+
+      img.src = `data:image/png;base64,${base64Plane}`;
+    });
+  }
+
+  // Expand the planes of a compact rgb-channels / hsv-convert result in place
+  async expandChannelPlanes(result) {
+    const coloring = [
+      ...Object.entries(result.tints || {}).map(([name, tint]) => [name, { tint }]),
+      ...Object.entries(result.palettes || {}).map(([name, palette]) => [name, { palette }]),
+    ];
+    await Promise.all(
+      coloring.map(async ([name, options]) => {
+        result[name] = await this.colorizeChannelPlane(result[name], options);
+      })
+    );
+    return result;
+  }
+
   async getAvailableOperations() {
     try {
       const response = await this.api.get("/api/operations");
@@ -284,11 +583,13 @@ class ImageProcessingService {
   }
 
   async extractRGBChannels(imageData) {
-    return this.processImage("rgb-channels", imageData);
+    const result = await this.processImage("rgb-channels", imageData, { compact: true });
+    return this.expandChannelPlanes(result);
   }
 
   async convertToHSV(imageData) {
-    return this.processImage("hsv-convert", imageData);
+    const result = await this.processImage("hsv-convert", imageData, { compact: true });
+    return this.expandChannelPlanes(result);
   }
 
   async rotateImage(imageData, angle = 45, scale = 1.0) {
@@ -340,6 +641,15 @@ class ImageProcessingService {
     return this.processImage("flip", imageData, { flip_code: flipCode });
   }
 
+  // Ordered geometric steps, e.g. [{ operation: "rotate", params: { angle: 15 } },
+  // { operation: "crop", params: { x: 0, y: 0, width: 640, height: 480 } }],
+  // applied server-side with a single resampling pass
+  async transformImage(imageData, transforms) {
+    return this.processImage("transform", imageData, {
+      transforms: JSON.stringify(transforms),
+    });
+  }
+
   async drawShapes(imageData) {
     return this.processImage("draw-shapes", imageData);
   }
@@ -376,8 +686,12 @@ class ImageProcessingService {
     return this.processImage("sharpen", imageData, { strength });
   }
 
-  async denoiseImage(imageData, method = "nlmeans", h = 10.0) {
-    return this.processImage("denoise", imageData, { method, h });
+  // quality: "full", "half" or "quarter"; deadlineMs lets the server pick the
+  // best tier expected to fit
+  async denoiseImage(imageData, method = "nlmeans", h = 10.0, quality = "full", deadlineMs = null) {
+    const params = { method, h, quality };
+    if (deadlineMs) params.deadline_ms = deadlineMs;
+    return this.processImage("denoise", imageData, params);
   }
 
   async adaptiveThreshold(